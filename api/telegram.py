@@ -1,24 +1,796 @@
 import os
 import json
 import re
+import time
+import asyncio
+import sqlite3
+import gzip
+import shutil
+import hashlib
+import random
+import zlib
+import contextvars
+import threading
+import multiprocessing
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from queue import Empty, Full
 from fastapi import FastAPI, Request
 from fastapi.responses import PlainTextResponse
 import httpx
 
-app = FastAPI()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# --- В памяти ---
-sessions = {}
-feed = {}
-stats = {}
-feedback_sessions = {}
-ai_chat_sessions = {}  # Новое: сессии для ИИ-чата
+try:
+    import h2  # noqa: F401  (нужен httpx для HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# ---- Жизненный цикл приложения ----
+# Фоновые подсистемы регистрируют здесь свои функции запуска/остановки.
+startup_hooks = []
+shutdown_hooks = []
+
+async def run_startup_hooks():
+    for hook in startup_hooks:
+        await hook()
+
+async def run_shutdown_hooks():
+    for hook in reversed(shutdown_hooks):
+        await hook()
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_startup_hooks()
+    try:
+        yield
+    finally:
+        await run_shutdown_hooks()
+
+app = FastAPI(lifespan=lifespan)
 
 # --- Переменные окружения ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY") or ""
 OWNER_ID = str(os.getenv("MY_TELEGRAM_ID") or "")
 TELEGRAM_SEND_MAX = 3900
+# Что владелец получает о чужих апдейтах: full — JSON целиком, compact — строка
+# на апдейт, digest — сводка раз в OWNER_DIGEST_INTERVAL секунд, off — ничего
+OWNER_FORWARD_MODE = os.getenv("OWNER_FORWARD_MODE") or "full"
+OWNER_DIGEST_INTERVAL = float(os.getenv("OWNER_DIGEST_INTERVAL") or 300)
+# Полный JSON апдейтов — в локальный журнал JSON Lines с ротацией (пусто — не писать)
+UPDATE_ARCHIVE_PATH = os.getenv("UPDATE_ARCHIVE_PATH") or ""
+UPDATE_ARCHIVE_MAX_BYTES = int(os.getenv("UPDATE_ARCHIVE_MAX_BYTES") or 10 * 1024 * 1024)
+UPDATE_ARCHIVE_BACKUPS = int(os.getenv("UPDATE_ARCHIVE_BACKUPS") or 5)
+UPDATE_ARCHIVE_COMPRESS = (os.getenv("UPDATE_ARCHIVE_COMPRESS") or "1") == "1"
+# memory — словари в процессе; sqlite — файл, общий для воркеров, переживает рестарт
+STATE_BACKEND = os.getenv("STATE_BACKEND") or "memory"
+STATE_PATH = os.getenv("STATE_PATH") or "bot_state.sqlite3"
+STATE_BATCH_SIZE = int(os.getenv("STATE_BATCH_SIZE") or 100)
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL") or 1)
+# Сколько мс ждать блокировку SQLite: запросы идут прямо в event loop, и всё это время он стоит
+STATE_BUSY_TIMEOUT = int(os.getenv("STATE_BUSY_TIMEOUT") or 250)
+# Лимиты состояния в памяти: число записей, простой в секундах (0 — без лимита)
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES") or 50000)
+STATE_IDLE_TTL = float(os.getenv("STATE_IDLE_TTL") or 24 * 3600)
+STATE_TRACK_BYTES = (os.getenv("STATE_TRACK_BYTES") or "0") == "1"
+STATE_CACHE_MAX_ENTRIES = int(os.getenv("STATE_CACHE_MAX_ENTRIES") or 10000)
+AI_CHAT_MAX_ENTRIES = int(os.getenv("AI_CHAT_MAX_ENTRIES") or 5000)
+AI_CHAT_IDLE_TTL = float(os.getenv("AI_CHAT_IDLE_TTL") or 6 * 3600)
+AI_CHAT_MAX_BYTES = int(os.getenv("AI_CHAT_MAX_BYTES") or 64 * 1024 * 1024)
+# Статистика игр: счётчики, итоги и топы — в хранилище состояния; хранилище в памяти
+# сохраняет их в STATS_SNAPSHOT_PATH раз в STATS_SNAPSHOT_INTERVAL секунд (пусто — не сохранять);
+# размер таблицы лидеров по каждой игре и число закэшированных ответов /stats
+STATS_SNAPSHOT_PATH = os.getenv("STATS_SNAPSHOT_PATH") or ""
+STATS_SNAPSHOT_INTERVAL = float(os.getenv("STATS_SNAPSHOT_INTERVAL") or 60)
+STATS_TOP_SIZE = int(os.getenv("STATS_TOP_SIZE") or 10)
+STATS_RENDER_CACHE = int(os.getenv("STATS_RENDER_CACHE") or 10000)
+# Запас готовых вопросов/раундов на каждую тему и игру (0 — генерировать по запросу)
+CONTENT_POOL_DEPTH = int(os.getenv("CONTENT_POOL_DEPTH") or 2)
+CONTENT_POOL_CONCURRENCY = int(os.getenv("CONTENT_POOL_CONCURRENCY") or 2)
+CONTENT_POOL_RETRY_DELAY = float(os.getenv("CONTENT_POOL_RETRY_DELAY") or 30)
+# Потоковые ответы ИИ-помощника с редактированием сообщения по ходу генерации
+AI_STREAMING = (os.getenv("AI_STREAMING") or "1") == "1"
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL") or 1.0)
+# inline — обработка прямо в webhook; queue — ответ сразу, обработка воркерами;
+# sharded — ответ сразу, обработка в SHARD_WORKERS процессах, чат всегда в одном и том же
+INGEST_MODE = os.getenv("INGEST_MODE") or "inline"
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS") or 8)
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX") or 1000)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS") or os.cpu_count() or 1)
+SHARD_QUEUE_MAX = int(os.getenv("SHARD_QUEUE_MAX") or 1000)
+UPDATE_DEDUP_WINDOW = float(os.getenv("UPDATE_DEDUP_WINDOW") or 600)
+# Лимиты исходящих сообщений (сообщений в секунду и размер всплеска)
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE") or 1)
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST") or 3)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE") or 30)
+OUTBOUND_GLOBAL_BURST = float(os.getenv("OUTBOUND_GLOBAL_BURST") or 30)
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES") or 3)
+# Сколько секунд суммарно сообщение может ждать по 429, прежде чем считаться неотправленным
+OUTBOUND_MAX_RATE_LIMIT_WAIT = float(os.getenv("OUTBOUND_MAX_RATE_LIMIT_WAIT") or 120)
+LLM_MODEL = os.getenv("LLM_MODEL") or "openai/gpt-3.5-turbo"
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS") or 1000)
+# Формат ответов для тестов и игр: json_schema, json_object или off (только просьба в промпте)
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT") or "json_schema"
+# Модели на случай отказа основной, через запятую в порядке очерёдности
+LLM_FALLBACK_MODELS = [m.strip() for m in (os.getenv("LLM_FALLBACK_MODELS") or "").split(",") if m.strip()]
+# Общий срок на запрос к LLM со всеми повторами, число повторов и пауза между ними
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE") or 30)
+LLM_RETRIES = int(os.getenv("LLM_RETRIES") or 2)
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE") or 0.5)
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX") or 5)
+# Дублирующий запрос, если ответа нет дольше LLM_HEDGE_PERCENTILE недавних задержек
+LLM_HEDGE_ENABLED = (os.getenv("LLM_HEDGE_ENABLED") or "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE") or 95)
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES") or 20)
+# Автомат: после LLM_BREAKER_FAILURES сбоев подряд модель пропускается LLM_BREAKER_COOLDOWN секунд
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES") or 5)
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN") or 30)
+# Бюджет истории ИИ-чата в токенах; сверх него старые реплики сворачиваются в резюме
+AI_HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET") or 1500)
+AI_SUMMARY_MAX_TOKENS = int(os.getenv("AI_SUMMARY_MAX_TOKENS") or 300)
+# Одновременных запросов к OpenRouter и ожидающих слота; сверх — ответ "подожди"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY") or 8)
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING") or 32)
+# off — без кэша; deterministic — только temperature <= LLM_CACHE_MAX_TEMPERATURE;
+# chat — плюс запросы ИИ-чата (игры и тесты не кэшируются никогда)
+LLM_CACHE_POLICY = os.getenv("LLM_CACHE_POLICY") or "chat"
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE") or 0.3)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES") or 2000)
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL") or 24 * 3600)
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES") or 16 * 1024 * 1024)
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH") or ""
+# Дисковый кэш: записи сверх стольких удаляются (старые первыми) раз в LLM_CACHE_PRUNE_INTERVAL секунд
+LLM_CACHE_DISK_MAX_ENTRIES = int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES") or 50000)
+LLM_CACHE_PRUNE_INTERVAL = float(os.getenv("LLM_CACHE_PRUNE_INTERVAL") or 600)
+# Long polling (python -m api.telegram): ожидание getUpdates в секундах и размер пачки
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT") or 30)
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT") or 100)
+# Трассировка апдейтов: JSON-строка со спанами в stdout для доли TRACE_SAMPLE_RATE апдейтов
+TRACE_SPANS = (os.getenv("TRACE_SPANS") or "0") == "1"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE") or 1)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE") or "https://api.telegram.org"
+OPENROUTER_API_BASE = os.getenv("OPENROUTER_API_BASE") or "https://openrouter.ai/api/v1"
+
+# --- Настройки HTTP-клиентов ---
+HTTP2_ENABLED = HTTP2_AVAILABLE and (os.getenv("HTTP2_ENABLED") or "1") != "0"
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT") or 5)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY") or 30)
+# Отдельный пул на каждый хост: лимиты соединений и таймауты чтения у них разные.
+HTTP_HOSTS = {
+    "telegram": {
+        "timeout": float(os.getenv("TELEGRAM_TIMEOUT") or 10),
+        "max_connections": int(os.getenv("TELEGRAM_MAX_CONNECTIONS") or 50),
+        "max_keepalive": int(os.getenv("TELEGRAM_MAX_KEEPALIVE") or 20),
+    },
+    "openrouter": {
+        "timeout": float(os.getenv("OPENROUTER_TIMEOUT") or 60),
+        "max_connections": int(os.getenv("OPENROUTER_MAX_CONNECTIONS") or 20),
+        "max_keepalive": int(os.getenv("OPENROUTER_MAX_KEEPALIVE") or 10),
+    },
+}
+
+# ---- Метрики и трассировка ----
+# Счётчики и гистограммы живут в памяти процесса и отдаются на /metrics в
+# текстовом формате Prometheus. Запись — пара операций со словарём, поэтому
+# метрики не выключаются.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+metrics = []
+metric_sources = []  # (префикс, функция снимка) — счётчики подсистем из их snapshot()
+
+def format_metric_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if isinstance(value, bool) else str(value)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # кортеж значений меток -> значение
+        metrics.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {format_metric_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) - 1
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=METRIC_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        item = self.values.get(labels)
+        if item is None:
+            item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def render(self):
+        lines = self.header()
+        names = self.labels + ("le",)
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, key + (format_metric_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+def snapshot_metric_lines(prefix, snapshot, lines):
+    # Числа — gauge bot_<префикс>_<ключ>; словарь чисел — тот же gauge с меткой key
+    for key, value in snapshot.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, (int, float)):
+            lines.append(f"{name} {format_metric_value(value)}")
+        elif isinstance(value, dict):
+            if all(v is None or isinstance(v, (int, float)) for v in value.values()):
+                for label, v in value.items():
+                    if v is not None:
+                        lines.append(f"{name}{format_labels(('key',), (label,))} {format_metric_value(v)}")
+            else:
+                snapshot_metric_lines(name, value, lines)
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for prefix, snapshot in metric_sources:
+        try:
+            snapshot_metric_lines("bot_" + prefix, snapshot(), lines)
+        except Exception as e:
+            print("metrics snapshot error:", prefix, e)
+    return "\n".join(lines) + "\n"
+
+WEBHOOK_SECONDS = Histogram("bot_webhook_seconds", "Время ответа webhook", ("result",))
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Полная обработка апдейта", ("kind",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчика process_game_logic", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+TELEGRAM_SECONDS = Histogram("bot_telegram_api_seconds", "Запросы к Bot API", ("method",))
+TELEGRAM_ERRORS = Counter("bot_telegram_api_errors_total", "Неуспешные ответы Bot API (status=429 — лимит)", ("method", "status"))
+TELEGRAM_IN_FLIGHT = Gauge("bot_telegram_api_in_flight", "Запросы к Bot API в процессе", ("method",))
+OUTBOUND_WAIT_SECONDS = Histogram("bot_outbound_wait_seconds", "Ожидание сообщения в очереди планировщика", ("kind",))
+LLM_SECONDS = Histogram("bot_llm_seconds", "Запросы к OpenRouter", ("mode",))
+LLM_FIRST_TOKEN_SECONDS = Histogram("bot_llm_first_token_seconds", "Время до первого куска потокового ответа")
+LLM_SLOT_WAIT_SECONDS = Histogram("bot_llm_slot_wait_seconds", "Ожидание слота LLMLimiter")
+LLM_ERRORS = Counter("bot_llm_errors_total", "Неуспешные запросы к OpenRouter", ("mode", "status"))
+LLM_ATTEMPTS = Counter("bot_llm_attempts_total", "Отдельные попытки запроса к OpenRouter", ("model", "status"))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Спаны одного апдейта; при завершении пишутся в stdout одной JSON-строкой."""
+
+    __slots__ = ("started", "fields", "spans", "done")
+
+    def __init__(self, **fields):
+        self.started = time.perf_counter()
+        self.fields = fields
+        self.spans = []
+        self.done = False
+
+    def finish(self, **fields):
+        self.done = True
+        record = {
+            "trace": self.fields,
+            "ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "spans": self.spans,
+            **fields,
+        }
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+def start_trace(**fields):
+    if not TRACE_SPANS or random.random() >= TRACE_SAMPLE_RATE:
+        return None, None
+    trace = Trace(**fields)
+    return trace, current_trace.set(trace)
+
+def finish_trace(trace, token, **fields):
+    if trace is None:
+        return
+    current_trace.reset(token)
+    trace.finish(**fields)
+
+def trace_span(name, started, elapsed, **fields):
+    # Без активной трассировки — один ContextVar.get()
+    # Фоновые задачи, запущенные во время апдейта, наследуют его трассировку —
+    # после завершения апдейта их спаны не пишем.
+    trace = current_trace.get()
+    if trace is not None and not trace.done:
+        trace.spans.append({
+            "name": name,
+            "at_ms": round((started - trace.started) * 1000, 3),
+            "ms": round(elapsed * 1000, 3),
+            **fields,
+        })
+
+# ---- Хранилище состояния ----
+# Значения — JSON-совместимые структуры. Обработчики не меняют их на месте,
+# а записывают новое значение через set/update, иначе изменение не попадёт в SQLite.
+MISSING = object()
+NOT_CACHED = object()
+
+def value_size(value):
+    """Примерный объём значения в байтах: строки в UTF-8 плюс накладные расходы контейнеров."""
+    if isinstance(value, str):
+        return 49 + len(value.encode())
+    if isinstance(value, dict):
+        return 64 + sum(value_size(k) + value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(8 + value_size(v) for v in value)
+    return 32
+
+class BoundedState:
+    """Словарь с вытеснением: LRU по числу записей, по времени простоя и по объёму.
+
+    Порядок OrderedDict — порядок последнего обращения, поэтому и LRU, и
+    просроченные по ttl записи всегда находятся в начале.
+    """
+
+    def __init__(self, max_entries=0, ttl=0, max_bytes=0, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (value_size if max_bytes else None)
+        self.items = OrderedDict()  # key -> [value, touched, size]
+        self.bytes = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self.evicted_bytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        item = self.items.get(key)
+        if item is None:
+            return default
+        now = time.monotonic()
+        if self.ttl and now - item[1] > self.ttl:
+            self.remove(key)
+            self.evicted_ttl += 1
+            return default
+        item[1] = now
+        self.items.move_to_end(key)
+        return item[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self.items[key] = [value, time.monotonic(), size]
+        self.bytes += size
+        while self.max_entries and len(self.items) > self.max_entries:
+            self.remove(next(iter(self.items)))
+            self.evicted_lru += 1
+        # Последнюю запись не вытесняем, даже если она одна больше лимита
+        while self.max_bytes and self.bytes > self.max_bytes and len(self.items) > 1:
+            self.remove(next(iter(self.items)))
+            self.evicted_bytes += 1
+
+    def remove(self, key):
+        item = self.items.pop(key)
+        self.bytes -= item[2]
+        return item[0]
+
+    def pop(self, key, default=None):
+        if key not in self.items:
+            return default
+        return self.remove(key)
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def sweep(self):
+        if not self.ttl:
+            return
+        now = time.monotonic()
+        while self.items:
+            key, item = next(iter(self.items.items()))
+            if now - item[1] <= self.ttl:
+                break
+            self.remove(key)
+            self.evicted_ttl += 1
+
+    def snapshot(self):
+        return {
+            "entries": len(self.items),
+            "bytes": self.bytes if self.sizeof else None,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "max_bytes": self.max_bytes,
+            "evicted_lru": self.evicted_lru,
+            "evicted_ttl": self.evicted_ttl,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+STATE_LIMITS = {
+    "sessions": {"max_entries": STATE_MAX_ENTRIES, "ttl": STATE_IDLE_TTL},
+    "feed": {"max_entries": STATE_MAX_ENTRIES, "ttl": 3600},
+    "feedback_sessions": {"max_entries": STATE_MAX_ENTRIES, "ttl": 3600},
+    # Статистика — не кэш: не вытесняется ни по LRU, ни по простою
+    # (в памяти переживает рестарт через STATS_SNAPSHOT_PATH)
+    "stats": {"max_entries": 0, "ttl": 0},
+    "stats_totals": {"max_entries": 0, "ttl": 0},
+    "ai_chat_sessions": {
+        "max_entries": AI_CHAT_MAX_ENTRIES,
+        "ttl": AI_CHAT_IDLE_TTL,
+        "max_bytes": AI_CHAT_MAX_BYTES,
+    },
+}
+
+def make_bounded_state(limits):
+    return BoundedState(
+        max_entries=limits.get("max_entries", 0),
+        ttl=limits.get("ttl", 0),
+        max_bytes=limits.get("max_bytes", 0),
+        sizeof=value_size if STATE_TRACK_BYTES else None,
+    )
+
+class StateView:
+    """Словарный интерфейс к одному пространству имён хранилища."""
+
+    def __init__(self, store, ns):
+        self.store = store
+        self.ns = ns
+
+    def get(self, key, default=None):
+        return self.store.get(self.ns, key, default)
+
+    def __getitem__(self, key):
+        value = self.store.get(self.ns, key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.set(self.ns, key, value)
+
+    def __delitem__(self, key):
+        self.store.delete(self.ns, key)
+
+    def __contains__(self, key):
+        return self.store.get(self.ns, key, MISSING) is not MISSING
+
+    def pop(self, key, default=None):
+        value = self.store.get(self.ns, key, MISSING)
+        if value is MISSING:
+            return default
+        self.store.delete(self.ns, key)
+        return value
+
+    def update(self, key, fn, default=None):
+        return self.store.update(self.ns, key, fn, default)
+
+class StateStore:
+    persistent = False  # переживает ли рестарт
+
+    def view(self, ns):
+        return StateView(self, ns)
+
+    def flush(self):
+        pass
+
+    def sweep(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class MemoryStateStore(StateStore):
+    """Состояние в памяти процесса: теряется при рестарте, один воркер.
+
+    Каждое пространство имён ограничено по STATE_LIMITS.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = STATE_LIMITS if limits is None else limits
+        self.data = {}
+
+    def namespace(self, ns):
+        data = self.data.get(ns)
+        if data is None:
+            data = self.data[ns] = make_bounded_state(self.limits.get(ns, {}))
+        return data
+
+    def get(self, ns, key, default=None):
+        return self.namespace(ns).get(key, default)
+
+    def set(self, ns, key, value):
+        self.namespace(ns)[key] = value
+
+    def delete(self, ns, key):
+        self.namespace(ns).pop(key, None)
+
+    def scan(self, ns):
+        """Все пары (key, value) пространства имён, не трогая порядок LRU."""
+        return [(key, item[0]) for key, item in self.namespace(ns).items.items()]
+
+    def update(self, ns, key, fn, default=None):
+        # Без await внутри — атомарно относительно других корутин
+        value = fn(self.get(ns, key, default))
+        if value is None:
+            self.delete(ns, key)
+        else:
+            self.set(ns, key, value)
+        return value
+
+    def sweep(self):
+        for data in self.data.values():
+            data.sweep()
+
+    def footprint(self):
+        return {ns: data.snapshot() for ns, data in self.data.items()}
+
+class SQLiteStateStore(StateStore):
+    """Состояние в SQLite (WAL), общее для всех воркеров на одной машине.
+
+    Записи копятся в буфере и фиксируются одной транзакцией в flush().
+    Прочитанные значения кэшируются; кэш сбрасывается, когда PRAGMA
+    data_version показывает, что базу изменил другой процесс. update()
+    выполняется в BEGIN IMMEDIATE и потому атомарен между процессами.
+
+    Запросы идут прямо из event loop, поэтому блокировку ждём не дольше
+    busy_timeout мс. Если база так и осталась занята, буфер не теряется:
+    flush() повторит запись в следующий раз, update() поднимет ошибку,
+    оставив прежнее значение.
+    """
+
+    persistent = True
+
+    def __init__(self, path, batch_size=100, cache_size=10000, busy_timeout=250):
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self.cache = make_bounded_state({"max_entries": cache_size})
+        self.dirty = {}
+        self.data_version = None
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def sync(self):
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self.data_version:
+            self.cache.clear()
+            self.data_version = version
+
+    def load(self, ns, key):
+        row = self.db.execute("SELECT value FROM state WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        return json.loads(row[0]) if row else MISSING
+
+    def get(self, ns, key, default=None):
+        k = (ns, key)
+        value = self.dirty.get(k, MISSING)
+        if value is MISSING:
+            self.sync()
+            value = self.cache.get(k, NOT_CACHED)
+            if value is NOT_CACHED:
+                value = self.cache[k] = self.load(ns, key)
+        return default if value is MISSING else value
+
+    def set(self, ns, key, value):
+        self.dirty[(ns, key)] = value
+        if len(self.dirty) >= self.batch_size:
+            try:
+                self.flush()
+            except sqlite3.OperationalError as e:
+                # База занята другим воркером — записи остались в буфере, допишет фоновый flush
+                print("state flush deferred:", e)
+
+    def delete(self, ns, key):
+        self.set(ns, key, MISSING)
+
+    def write(self, items):
+        upserts = [(ns, key, json.dumps(v, ensure_ascii=False)) for (ns, key), v in items if v is not MISSING]
+        deletes = [(ns, key) for (ns, key), v in items if v is MISSING]
+        if upserts:
+            self.db.executemany(
+                "INSERT INTO state (ns, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value",
+                upserts,
+            )
+        if deletes:
+            self.db.executemany("DELETE FROM state WHERE ns = ? AND key = ?", deletes)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        began = False
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+            began = True
+            self.write(dirty.items())
+            self.db.execute("COMMIT")
+        except Exception:
+            if began and self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            # Не теряем записи: вернём их в буфер, если их не перезаписали
+            dirty.update(self.dirty)
+            self.dirty = dirty
+            self.flush_errors += 1
+            raise
+        for k, value in dirty.items():
+            self.cache[k] = value
+        self.flushes += 1
+
+    def update(self, ns, key, fn, default=None):
+        k = (ns, key)
+        began = False
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+            began = True
+            current = self.dirty.get(k, MISSING)
+            if current is MISSING:
+                current = self.load(ns, key)
+            value = fn(default if current is MISSING else current)
+            stored = MISSING if value is None else value
+            self.write([(k, stored)])
+            self.db.execute("COMMIT")
+        except Exception:
+            if began and self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+        # Из буфера убираем только после COMMIT — иначе при сбое значение пропало бы
+        self.dirty.pop(k, None)
+        self.cache[k] = stored
+        return value
+
+    def sweep(self):
+        self.cache.sweep()
+
+    def footprint(self):
+        return {
+            "cache": self.cache.snapshot(),
+            "dirty": len(self.dirty),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+        }
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def open_state_store(backend):
+    if backend == "sqlite":
+        return SQLiteStateStore(STATE_PATH, STATE_BATCH_SIZE, STATE_CACHE_MAX_ENTRIES, STATE_BUSY_TIMEOUT)
+    return MemoryStateStore()
+
+state = open_state_store(STATE_BACKEND)
+sessions = state.view("sessions")
+feed = state.view("feed")
+stats = state.view("stats")
+stats_totals = state.view("stats_totals")
+feedback_sessions = state.view("feedback_sessions")
+ai_chat_sessions = state.view("ai_chat_sessions")
+
+async def start_state_flusher():
+    async def flush_periodically():
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                state.flush()
+                state.sweep()
+            except Exception as e:
+                print("state flush error:", e)
+    global state_flusher
+    state_flusher = asyncio.create_task(flush_periodically())
+
+async def stop_state_flusher():
+    if state_flusher:
+        state_flusher.cancel()
+    state.close()
+
+state_flusher = None
+startup_hooks.append(start_state_flusher)
+shutdown_hooks.append(stop_state_flusher)
+
+# ---- HTTP-клиенты ----
+# Один клиент на хост на всё время жизни приложения: keep-alive пул вместо
+# нового TCP+TLS рукопожатия на каждый запрос.
+http_clients = {}
+
+def make_http_client(host):
+    cfg = HTTP_HOSTS[host]
+    return httpx.AsyncClient(
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=cfg["max_connections"],
+            max_keepalive_connections=cfg["max_keepalive"],
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(cfg["timeout"], connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+def get_http_client(host):
+    # Лениво: в serverless-окружении lifespan может не вызываться.
+    client = http_clients.get(host)
+    if client is None or client.is_closed:
+        client = http_clients[host] = make_http_client(host)
+    return client
+
+async def open_http_clients():
+    for host in HTTP_HOSTS:
+        get_http_client(host)
+
+async def close_http_clients():
+    clients = list(http_clients.values())
+    http_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+startup_hooks.append(open_http_clients)
+shutdown_hooks.append(close_http_clients)
+
+async def telegram_api(method, payload, timeout=None):
+    kwargs = {"timeout": timeout} if timeout else {}
+    started = time.perf_counter()
+    status = "exception"
+    TELEGRAM_IN_FLIGHT.inc(method)
+    try:
+        res = await get_http_client("telegram").post(
+            f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}/{method}",
+            json=payload,
+            **kwargs
+        )
+        status = res.status_code
+        return res
+    finally:
+        elapsed = time.perf_counter() - started
+        TELEGRAM_IN_FLIGHT.dec(method)
+        TELEGRAM_SECONDS.observe(elapsed, method)
+        if status != 200:
+            TELEGRAM_ERRORS.inc(method, status)
+        trace_span(method, started, elapsed, status=status)
 
 # ---- Утилиты ----
 async def read_raw_body(request: Request):
@@ -27,39 +799,277 @@ async def read_raw_body(request: Request):
 def chunk_string(text: str, size=TELEGRAM_SEND_MAX):
     return [text[i:i+size] for i in range(0, len(text), size)]
 
-def safe_json(obj):
-    try:
-        return json.dumps(obj, ensure_ascii=False, indent=2)
-    except Exception:
-        return str(obj)
+# ---- Планировщик исходящих сообщений ----
+# Telegram ограничивает ~1 сообщение/с в чат и ~30 сообщений/с на бота;
+# все sendMessage идут через общий планировщик с token bucket'ами.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
 
-async def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown"):
-    body = {"chat_id": str(chat_id), "text": str(text)}
-    if reply_markup:
-        body["reply_markup"] = reply_markup
-    if parse_mode:
-        body["parse_mode"] = parse_mode
-    async with httpx.AsyncClient() as client:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        # Сколько секунд ждать до появления целого токена
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class OutboundMessage:
+    __slots__ = ("chat_id", "text", "reply_markup", "parse_mode", "wrap", "future", "attempts", "limited_for",
+                 "queued_at")
+
+    def __init__(self, chat_id, text, reply_markup, parse_mode, wrap, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.wrap = wrap
+        self.future = future
+        self.attempts = 0
+        self.limited_for = 0.0  # сколько секунд велели ждать ответы 429
+        self.queued_at = time.perf_counter()
+
+    def body(self):
+        text = self.wrap.format(self.text) if self.wrap else self.text
+        body = {"chat_id": self.chat_id, "text": text}
+        if self.reply_markup:
+            body["reply_markup"] = self.reply_markup
+        if self.parse_mode:
+            body["parse_mode"] = self.parse_mode
+        return body
+
+class OutboundScheduler:
+    """Очередь sendMessage с лимитами на чат и глобально.
+
+    Внутри чата сообщения уходят строго по порядку. Подряд идущие сообщения
+    с одинаковой обёрткой wrap (например, пересылки владельцу) склеиваются
+    в сообщения размером до TELEGRAM_SEND_MAX. На 429 сообщение возвращается
+    в начало очереди чата и ждёт retry_after, пока суммарное ожидание не
+    превысит max_rate_limit_wait; тогда оно считается неотправленным, и
+    send_message получает ответ 429. Сообщения, не ушедшие до конца stop(),
+    тоже завершаются — ожидающим send_message достаётся None.
+    """
+
+    def __init__(self, chat_rate, chat_burst, global_rate, global_burst, max_retries, max_rate_limit_wait=120):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.max_retries = max_retries
+        self.max_rate_limit_wait = max_rate_limit_wait
+        self.queues = {}
+        self.buckets = {}
+        self.chat_limits = {}  # chat_id -> (rate, burst), если не как у всех
+        self.blocked_until = {}
+        self.in_flight = set()
+        self.tasks = set()
+        self.wakeup = None
+        self.runner = None
+        self.last_prune = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self):
+        if self.runner is None or self.runner.done():
+            self.wakeup = asyncio.Event()
+            self.runner = asyncio.create_task(self.run())
+
+    def enqueue(self, chat_id, text, reply_markup=None, parse_mode="Markdown", wrap=None, wait=False):
+        self.start()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        msg = OutboundMessage(str(chat_id), str(text), reply_markup, parse_mode, wrap, future)
+        self.queues.setdefault(msg.chat_id, deque()).append(msg)
+        self.wakeup.set()
+        return future
+
+    def pending(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            rate, burst = self.chat_limits.get(chat_id, (self.chat_rate, self.chat_burst))
+            bucket = self.buckets[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def limit_chat(self, chat_id, rate, burst):
+        self.chat_limits[chat_id] = (rate, burst)
+        self.buckets.pop(chat_id, None)
+
+    def next_message(self, chat_id):
+        queue = self.queues[chat_id]
+        msg = queue.popleft()
+        if not msg.wrap:
+            return msg
+        limit = TELEGRAM_SEND_MAX - len(msg.wrap.format(""))
+        # Склеиваем соседние сообщения с той же обёрткой
+        while (queue and queue[0].wrap == msg.wrap and queue[0].parse_mode == msg.parse_mode
+               and queue[0].future is None and msg.future is None
+               and len(msg.text) < limit):
+            msg.text += "\n\n" + queue.popleft().text
+            self.coalesced += 1
+        if len(msg.text) > limit:
+            rest = OutboundMessage(msg.chat_id, msg.text[limit:], msg.reply_markup, msg.parse_mode, msg.wrap, None)
+            rest.queued_at = msg.queued_at
+            msg.text = msg.text[:limit]
+            queue.appendleft(rest)
+        return msg
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            sleep_for = None
+            for chat_id in list(self.queues):
+                if chat_id in self.in_flight:
+                    continue
+                wait = max(
+                    self.blocked_until.get(chat_id, 0) - now,
+                    self.bucket(chat_id).delay(now),
+                    self.global_bucket.delay(now),
+                )
+                if wait > 0:
+                    sleep_for = wait if sleep_for is None else min(sleep_for, wait)
+                    continue
+                msg = self.next_message(chat_id)
+                self.bucket(chat_id).take()
+                self.global_bucket.take()
+                # Обслуженный чат уходит в конец — честная очередь между чатами
+                queue = self.queues.pop(chat_id)
+                if queue:
+                    self.queues[chat_id] = queue
+                self.in_flight.add(chat_id)
+                task = asyncio.create_task(self.deliver(msg))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            if now - self.last_prune > 60:
+                self.prune(now)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def prune(self, now):
+        self.last_prune = now
+        for chat_id in [c for c, b in self.buckets.items() if c not in self.queues and b.idle(now)]:
+            del self.buckets[chat_id]
+        for chat_id in [c for c, t in self.blocked_until.items() if t <= now]:
+            del self.blocked_until[chat_id]
+
+    def retry(self, msg, delay):
+        msg.attempts += 1
+        self.retried += 1
+        self.blocked_until[msg.chat_id] = time.monotonic() + delay
+        self.queues.setdefault(msg.chat_id, deque()).appendleft(msg)
+
+    async def deliver(self, msg):
+        # Пересылки владельцу (wrap) и ответы пользователям ждут в очереди по-разному
+        OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - msg.queued_at, "forward" if msg.wrap else "reply")
         try:
-            await client.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                json=body
-            )
+            res = await telegram_api("sendMessage", msg.body())
         except Exception as e:
+            res = None
             print("send_message error:", e)
+        finally:
+            self.in_flight.discard(msg.chat_id)
+            self.wakeup.set()
+        if res is not None and res.status_code == 429:
+            self.rate_limited += 1
+            try:
+                retry_after = float(res.json().get("parameters", {}).get("retry_after") or 1)
+            except Exception:
+                retry_after = float(res.headers.get("Retry-After") or 1)
+            # Telegram сам говорит, когда можно; ждём, но не бесконечно
+            if msg.limited_for + retry_after <= self.max_rate_limit_wait:
+                msg.limited_for += retry_after
+                self.retry(msg, retry_after)
+                return
+            self.blocked_until[msg.chat_id] = time.monotonic() + retry_after
+        elif (res is None or res.status_code >= 500) and msg.attempts < self.max_retries:
+            self.retry(msg, 0.5 * 2 ** msg.attempts)
+            return
+        if res is not None and res.status_code == 200:
+            self.sent += 1
+        else:
+            self.failed += 1
+            if res is not None:
+                print("send_message error:", res.status_code, res.text[:200])
+        if msg.future and not msg.future.done():
+            msg.future.set_result(res)
+
+    async def stop(self, timeout=10):
+        if self.runner is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.queues or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.runner.cancel()
+        await asyncio.gather(self.runner, *self.tasks, return_exceptions=True)
+        self.runner = None
+        # Не успевшие уйти сообщения не должны оставить send_message ждать вечно
+        dropped = [msg for queue in self.queues.values() for msg in queue]
+        self.queues.clear()
+        for msg in dropped:
+            if msg.future and not msg.future.done():
+                msg.future.set_result(None)
+        if dropped:
+            self.dropped += len(dropped)
+            print("outbound: dropped", len(dropped), "messages on shutdown")
+
+    def snapshot(self):
+        return {
+            "pending": self.pending(),
+            "chats": len(self.queues),
+            "in_flight": len(self.in_flight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+outbound = OutboundScheduler(
+    chat_rate=OUTBOUND_CHAT_RATE,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    global_burst=OUTBOUND_GLOBAL_BURST,
+    max_retries=OUTBOUND_MAX_RETRIES,
+    max_rate_limit_wait=OUTBOUND_MAX_RATE_LIMIT_WAIT,
+)
+shutdown_hooks.append(outbound.stop)
+
+def queue_message(chat_id, text, reply_markup=None, parse_mode="Markdown", wrap=None):
+    """Поставить сообщение в очередь, не дожидаясь отправки."""
+    outbound.enqueue(chat_id, text, reply_markup, parse_mode, wrap)
+
+async def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown"):
+    started = time.perf_counter()
+    try:
+        return await outbound.enqueue(chat_id, text, reply_markup, parse_mode, wait=True)
+    except Exception as e:
+        print("send_message error:", e)
+    finally:
+        trace_span("send_message", started, time.perf_counter() - started)
 
 async def answer_callback_query(callback_query_id):
-    async with httpx.AsyncClient() as client:
-        try:
-            await client.post(
-                f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/answerCallbackQuery",
-                json={"callback_query_id": callback_query_id}
-            )
-        except Exception as e:
-            print("answer_callback_query error:", e)
-async def ask_gpt(prompt, chat_history=None):
-    
-    system_prompt = """
+    try:
+        await telegram_api("answerCallbackQuery", {"callback_query_id": callback_query_id})
+    except Exception as e:
+        print("answer_callback_query error:", e)
+AI_SYSTEM_PROMPT = """
 Ты - ворчливый, но забавный ИИ. Твой характер:
 
 ОСОБЕННОСТИ ХАРАКТЕРА:
@@ -95,418 +1105,2884 @@ async def ask_gpt(prompt, chat_history=None):
 Вопрос: "Помоги с домашкой"
 Ответ: "😤 Ненавижу домашку! Ладно, показывай свою пытку..."
 """
-    if not OPENROUTER_API_KEY:
-        return "Ошибка: нет OPENROUTER_API_KEY"
-    
-    try:
-        # Формируем историю сообщений для контекста
-        messages = []
-        
-        # Добавляем системный промпт для ИИ-помощника
-        if chat_history:
-            messages.append({
-                "role": "system", 
-                "content": system_prompt
-            })
-            # Добавляем историю диалога
-            messages.extend(chat_history)
-        
-        # Добавляем текущий запрос пользователя
-        messages.append({"role": "user", "content": prompt})
-        
-        async with httpx.AsyncClient() as client:
-            res = await client.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "openai/gpt-3.5-turbo",
-                    "messages": messages,
-                    "temperature": 1,
-                    "max_tokens": 1000
-                }
-            )
-            data = res.json()
-            if res.status_code != 200:
-                print("OpenRouter API error:", data)
-                return "Ошибка генерации: " + str(data.get("error", {}).get("message", "неизвестная ошибка"))
-            return data.get("choices", [{}])[0].get("message", {}).get("content", "Ошибка генерации.")
-    except Exception as e:
-        print("ask_gpt error:", e)
-        return "Ошибка генерации."
 
-# ---- Игровая логика ----
-async def process_game_logic(chat_id, text, first_name):
-    session = sessions.get(chat_id, {})
+def build_messages(prompt, chat_history=None):
+    # Формируем историю сообщений для контекста
+    messages = []
     
-    def update_stats(local_chat_id, game, win):
-        if local_chat_id not in stats:
-            stats[local_chat_id] = {}
-        if game not in stats[local_chat_id]:
-            stats[local_chat_id][game] = {"played": 0, "wins": 0}
-        stats[local_chat_id][game]["played"] += 1
-        if win:
-            stats[local_chat_id][game]["wins"] += 1
+    # Добавляем системный промпт для ИИ-помощника
+    if chat_history:
+        messages.append({
+            "role": "system", 
+            "content": AI_SYSTEM_PROMPT
+        })
+        # Добавляем историю диалога
+        messages.extend(chat_history)
+    
+    # Добавляем текущий запрос пользователя
+    messages.append({"role": "user", "content": prompt})
+    return messages
 
-    try:
-            # ==== ИИ-помощник ====
-        if text == "/ai" or text == "🤖 ИИ-помощник":
-            # Начинаем сессию с ИИ
-            ai_chat_sessions[chat_id] = []
-            await send_message(chat_id, 
-                "🤖 Привет! Я твой ИИ-помощник. Задай мне любой вопрос, и я постараюсь помочь!\n\n"
-                "Можешь спросить о чем угодно: учеба, программирование, советы по разным темам и т.д.\n\n"
-                "Чтобы закончить диалог, напиши /stop или нажми кнопку 'Закончить диалог'", 
-                {
-                    "keyboard": [[{"text": "Закончить диалог"}]],
-                    "resize_keyboard": True
-                }
+def openrouter_headers():
+    return {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+# ---- Подсчёт токенов ----
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def approx_tokens(text):
+    """Примерное число токенов без токенизатора модели.
+
+    Латиница в BPE-словарях GPT — около 4 символов на токен, кириллица
+    заметно дороже — около 2.5; знаки препинания и эмодзи — по токену.
+    """
+    tokens = 0
+    for word in TOKEN_RE.findall(text):
+        chars = 4 if word.isascii() else 2.5
+        tokens += max(1, -int(-len(word) // chars))
+    return tokens
+
+def message_tokens(messages):
+    # ~4 служебных токена на сообщение в формате chat completions
+    return sum(4 + approx_tokens(m["content"]) for m in messages)
+
+prompt_token_stats = {"requests": 0, "approx_total": 0, "approx_max": 0, "actual_requests": 0, "actual_total": 0}
+
+def record_prompt_tokens(messages):
+    tokens = message_tokens(messages)
+    prompt_token_stats["requests"] += 1
+    prompt_token_stats["approx_total"] += tokens
+    prompt_token_stats["approx_max"] = max(prompt_token_stats["approx_max"], tokens)
+    return tokens
+
+def record_usage(data):
+    # OpenRouter возвращает точный счёт в usage — сохраняем для сверки с оценкой
+    prompt_tokens = (data.get("usage") or {}).get("prompt_tokens")
+    if prompt_tokens:
+        prompt_token_stats["actual_requests"] += 1
+        prompt_token_stats["actual_total"] += prompt_tokens
+
+def prompt_token_snapshot():
+    requests = prompt_token_stats["requests"]
+    actual = prompt_token_stats["actual_requests"]
+    return {
+        **prompt_token_stats,
+        "approx_avg": round(prompt_token_stats["approx_total"] / requests, 1) if requests else 0.0,
+        "actual_avg": round(prompt_token_stats["actual_total"] / actual, 1) if actual else 0.0,
+    }
+
+# ---- Кэш ответов LLM ----
+def normalize_prompt(text):
+    # "Привет!", "привет" и "  ПРИВЕТ " — один и тот же вопрос
+    normalized = " ".join(re.sub(r"[^\w\s]", " ", text.lower().replace("ё", "е")).split())
+    return normalized or text.strip()
+
+def llm_cacheable(cacheable, temperature):
+    if LLM_CACHE_POLICY == "off":
+        return False
+    if temperature <= LLM_CACHE_MAX_TEMPERATURE:
+        return True
+    # chat — кэшируем ещё и ИИ-чат; игры с temperature=1 должны каждый раз отличаться
+    return LLM_CACHE_POLICY == "chat" and cacheable
+
+class LLMCache:
+    """Кэш ответов: в памяти (LRU + ttl + объём) и опционально на диске (SQLite).
+
+    Ключ — нормализованный запрос, вся отправляемая история (вместе со
+    сводкой старых реплик) и параметры модели: ответ из одного диалога не
+    должен достаться другому. Чтение с диска идёт в потоке. Записи на диск копятся и раз в
+    flush_interval секунд уходят одной транзакцией в отдельном потоке и
+    через своё соединение; там же раз в prune_interval удаляются
+    просроченные записи и всё сверх disk_max_entries.
+    """
+
+    def __init__(self, max_entries, ttl, max_bytes, path="", disk_max_entries=0, prune_interval=600,
+                 flush_interval=1):
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self.prune_interval = prune_interval
+        self.flush_interval = flush_interval
+        self.memory = BoundedState(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes)
+        self.db = None
+        self.writer = None
+        self.reading = threading.Lock()  # self.db читают из потоков пула по одному
+        self.pending = {}  # key -> (value, created), ещё не на диске
+        self.task = None
+        self.writing = None
+        self.pruned_at = 0.0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.skipped = 0
+        self.disk_writes = 0
+        self.disk_pruned = 0
+        self.disk_errors = 0
+        if path:
+            self.db = self.connect(path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
             )
-            return
+            self.db.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created)")
+            self.writer = self.connect(path)
+            self.prune()
 
-        # ==== Обработка вопросов к ИИ ====
-        if chat_id in ai_chat_sessions and text not in ["/stop", "Закончить диалог", "Назад"]:
-            # Показываем, что бот печатает
-            async with httpx.AsyncClient() as client:
-                await client.post(
-                    f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendChatAction",
-                    json={"chat_id": chat_id, "action": "typing"}
-                )
-            
-            # Получаем ответ от ИИ
-            ai_response = await ask_gpt(text, ai_chat_sessions[chat_id])
-            
-            # Обновляем историю диалога (сохраняем последние 10 сообщений)
-            ai_chat_sessions[chat_id].append({"role": "user", "content": text})
-            ai_chat_sessions[chat_id].append({"role": "assistant", "content": ai_response})
-            
-            # Ограничиваем историю 10 сообщениями (5 пар вопрос-ответ)
-            if len(ai_chat_sessions[chat_id]) > 10:
-                ai_chat_sessions[chat_id] = ai_chat_sessions[chat_id][-10:]
-            
-            await send_message(chat_id, ai_response, {
-                "keyboard": [[{"text": "Закончить диалог"}]],
-                "resize_keyboard": True
-            })
-            return
+    @staticmethod
+    def connect(path):
+        db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
 
-        # ==== Завершение диалога с ИИ ====
-        if text in ["/stop", "Закончить диалог"] and chat_id in ai_chat_sessions:
-            ai_chat_sessions.pop(chat_id)
-            await send_message(chat_id, "✅ Диалог с ИИ-помощником завершен. Чем еще могу помочь?", {
-                "keyboard": [
-                    [{"text": "История"}, {"text": "Математика"}],
-                    [{"text": "Английский"}, {"text": "Игры 🎲"}],
-                    [{"text": "🤖 ИИ-помощник"}, {"text": "/feedback"}],
-                    [{"text": "📤 Поделиться контактом", "request_contact": True}]
-                ],
-                "resize_keyboard": True
-            })
-            return
-        #--------------------
-        # ==== Контакт ====
-        if text == "/contact":
-            feed[chat_id] = True
-            await send_message(chat_id, "📱 Пожалуйста, поделитесь своим номером телефона:", {
-                "keyboard": [[{"text": "📤 Поделиться контактом", "request_contact": True}], [{"text": "Назад"}]],
-                "resize_keyboard": True,
-                "one_time_keyboard": True
-            })
-            return
+    def key(self, prompt, chat_history, model, temperature, max_tokens):
+        history = [(m["role"], normalize_prompt(m["content"])) for m in chat_history or []]
+        raw = json.dumps(
+            [model, temperature, max_tokens, history, normalize_prompt(prompt)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode()).hexdigest()
 
-        # ==== Feedback ====
-        if text == "/feedback":
-            feedback_sessions[chat_id] = True
-            await send_message(chat_id, "📝 Пожалуйста, введите ваш комментарий одним сообщением:")
-            return
-        if feedback_sessions.get(chat_id):
-            feedback_sessions.pop(chat_id)
-            fn = session.get("firstName")
-            username = session.get("username")
-            await send_message(OWNER_ID, f"💬 Отзыв от {fn or 'Без имени'} (@{username or 'нет'})\nID: {chat_id}\nТекст: {text}")
-            await send_message(OWNER_ID, f"/reply {chat_id}")
-            await send_message(chat_id, "✅ Ваш комментарий отправлен, скоро с вами свяжутся!")
-            return
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            self.hits += 1
+            return entry[0]
+        if self.db is not None:
+            row = self.pending.get(key)
+            if row is None:
+                row = await asyncio.get_running_loop().run_in_executor(None, self.read, key)
+            if row and time.time() - row[1] < self.ttl:
+                self.memory[key] = (row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+        self.misses += 1
+        return None
 
-        # ==== /start / Назад ====
-        if text in ["/start"]:
-            sessions[chat_id] = {"firstName": first_name}
-            await send_message(chat_id, f"👋 Привет, {first_name or 'друг'}! Выбери тему для теста или игру:", {
-                "keyboard": [[{"text": "🤖 ИИ-помощник"}],
-                    [{"text": "История"}, {"text": "Математика"}],
-                    [{"text": "Английский"}, {"text": "Игры 🎲"}],
-                    [{"text": "/feedback"}, {"text": "📤 Поделиться контактом", "request_contact": True}]
-                ],
-                "resize_keyboard": True
-            })
-            return
-        
-        
-        
-        if text in ["Назад"]:
-            sessions[chat_id] = {"firstName": first_name}
-            await send_message(chat_id, f"{first_name or 'друг'}!, Выбери тему для теста или игру:", {
-                "keyboard": [[{"text": "🤖 ИИ-помощник"}],
-                    [{"text": "История"}, {"text": "Математика"}],
-                    [{"text": "Английский"}, {"text": "Игры 🎲"}],
-                    [{"text": "/feedback"}, {"text": "📤 Поделиться контактом", "request_contact": True}]
-                ],
-                "resize_keyboard": True
-            })
-            return
+    def read(self, key):
+        with self.reading:
+            return self.db.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
 
-        
-        
+    def put(self, key, value):
+        created = time.time()
+        self.memory[key] = (value, created)
+        self.stores += 1
+        if self.db is not None:
+            self.pending[key] = (value, created)
+            if self.task is None or self.task.done():
+                self.task = asyncio.create_task(self.run())
 
-        # ==== /stats ====
-        if text == "/stats":
-            user_stats = stats.get(chat_id)
-            if not user_stats:
-                await send_message(chat_id, "Ты ещё не играл ни в одну игру.")
-                return
-            msg = "📊 Твоя статистика:\n\n"
-            for game, s in user_stats.items():
-                msg += f"• {game}: сыграно {s['played']}, побед {s['wins']}\n"
-            await send_message(chat_id, msg)
-            return
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
 
-        # ==== Игры ====
-        if text == "Игры 🎲":
-            await send_message(chat_id, "Выбери игру:", {
-                "keyboard": [
-                    [{"text": "Угадай слово"}, {"text": "Найди ложь"}],
-                    [{"text": "Продолжи историю"}, {"text": "Шарада"}],
-                    [{"text": "Назад"}, {"text": "/stats"}]
-                ],
-                "resize_keyboard": True
-            })
+    async def flush(self):
+        await self.wait_writing()
+        prune = time.monotonic() - self.pruned_at >= self.prune_interval
+        if not self.pending and not prune:
             return
+        rows, self.pending = self.pending, {}
+        self.writing = asyncio.get_running_loop().run_in_executor(None, self.write, rows, prune)
+        await self.wait_writing()
 
-        # ==== Тесты по темам ====
-        if text in ["История", "Математика", "Английский"]:
-            topic = text
-            prompt = f"""
-Задай один тестовый вопрос с 4 вариантами ответа по теме "{topic}".
-Формат:
-Вопрос: ...
-A) ...
-B) ...
-C) ...
-D) ...
-
-Правильный ответ: ... [A-D]
-            """.strip()
-            reply = await ask_gpt(prompt)
-            match = re.search(r"Правильный ответ:\s*([A-D])", reply, re.I)
-            correct_answer = match.group(1).upper() if match else None
-            if not correct_answer:
-                await send_message(chat_id, "⚠️ Не удалось сгенерировать вопрос. Попробуй снова.")
-                return
-            question_without_answer = re.sub(r"Правильный ответ:\s*(.+)", "", reply, flags=re.I).strip()
-            sessions[chat_id] = {"correctAnswer": correct_answer}
-            await send_message(chat_id, f"📚 Вопрос по теме *{topic}*:\n\n{question_without_answer}", {
-                "keyboard": [
-                    [{"text": "A"}, {"text": "B"}],
-                    [{"text": "C"}, {"text": "D"}]
-                
-                ],
-                "resize_keyboard": True
-            })
+    async def wait_writing(self):
+        if self.writing is None:
             return
+        try:
+            await asyncio.shield(self.writing)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.disk_errors += 1
+            print("llm cache write error:", e)
+        self.writing = None
 
-        # ==== Проверка ответа на тест ====
-        if session.get("correctAnswer"):
-            user_answer = text.strip().upper()
-            correct = session.pop("correctAnswer").upper()
-            win = user_answer == correct
-            update_stats(chat_id, "Тест", win)
-            reply_text = "✅ Правильно! Хочешь ещё вопрос?" if win else f"❌ Неправильно. Правильный ответ: {correct}\nПопробуешь ещё?"
-            await send_message(chat_id, reply_text, {
-                "keyboard": [[{"text": "🤖 ИИ-помощник"}],
-                    [{"text": "История"}, {"text": "Математика"}],
-                    [{"text": "Английский"}, {"text": "Игры 🎲"}]
-                ],
-                "resize_keyboard": True
-            })
-            return
+    def write(self, rows, prune=False):
+        if rows:
+            self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                self.writer.executemany(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created) VALUES (?, ?, ?)",
+                    [(key, value, created) for key, (value, created) in rows.items()],
+                )
+                self.writer.execute("COMMIT")
+            except Exception:
+                self.writer.execute("ROLLBACK")
+                raise
+            self.disk_writes += len(rows)
+        if prune:
+            self.prune()
 
-        # ==== Общий обработчик игр ====
-        games_prompts = {
-            "Угадай слово": """
-Загадай одно существительное. Опиши его так, чтобы пользователь попытался угадать. В конце добавь: "Загаданное слово: ...".
-Формат:
-Описание: ...
-Загаданное слово: ...
-            """,
-            "Найди ложь": """
-Придумай три коротких утверждения на любые темы. Два из них правдивые, одно ложное. В конце укажи, какое из них ложь (например: "Ложь: №2").
-Формат:
-1. ...
-2. ...
-3. ...
-Ложь: №...
-            """,
-            "Продолжи историю": """
-Придумай короткое начало истории и три возможных продолжения. Варианты продолжения пронумеруй.
-Формат:
-Начало: ...
-1. ...
-2. ...
-3. ...
-            """,
-            "Шарада": """
-Придумай одну шараду (загадку), которая состоит из трех частей, каждая часть даёт подсказку, чтобы угадать слово. В конце напиши ответ.
-Формат:
-1) ...
-2) ...
-3) ...
-Ответ: ...
-            """
+    def prune(self):
+        db = self.writer or self.db
+        deleted = db.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,)).rowcount
+        if self.disk_max_entries:
+            deleted += db.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.disk_max_entries,),
+            ).rowcount
+        self.pruned_at = time.monotonic()
+        self.disk_pruned += deleted
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.db is not None:
+            await self.flush()
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            "policy": LLM_CACHE_POLICY,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "skipped": self.skipped,
+            "memory": self.memory.snapshot(),
+            "disk": self.db is not None,
+            "disk_pending": len(self.pending),
+            "disk_writes": self.disk_writes,
+            "disk_pruned": self.disk_pruned,
+            "disk_errors": self.disk_errors,
         }
 
-        if text in games_prompts:
-            reply = await ask_gpt(games_prompts[text])
-            answer, description = None, reply
-            if text == "Угадай слово":
-                match = re.search(r"Загаданное слово:\s*(.+)", reply, re.I)
-                answer = match.group(1).strip().upper() if match else None
-                description = re.sub(r"Загаданное слово:\s*.+", "", reply, flags=re.I).replace("Описание:", "").strip()
-                if not answer:
-                    await send_message(chat_id, "⚠️ Не удалось сгенерировать слово. Попробуй ещё.")
-                    return
-                sessions[chat_id] = {"game": text, "answer": answer}
-                await send_message(chat_id, f"🧠 {text}:\n\n{description}")
-                return
-            elif text == "Найди ложь":
-                match = re.search(r"Ложь:\s*№?([1-3])", reply, re.I)
-                answer = match.group(1) if match else None
-                description = re.sub(r"Ложь:\s*№?[1-3]", "", reply, flags=re.I).strip()
-                if not answer:
-                    await send_message(chat_id, "⚠️ Не удалось сгенерировать утверждения. Попробуй ещё.")
-                    return
-                sessions[chat_id] = {"game": text, "answer": answer}
-                await send_message(chat_id, f"🕵️ {text}:\n\n{description}\n\nОтвет введи цифрой (1, 2 или 3).")
-                return
-            elif text == "Продолжи историю":
-                sessions[chat_id] = {"game": text, "answer": None}
-                await send_message(chat_id, f"📖 {text}:\n\n{reply}\n\nВыбери номер продолжения (1, 2 или 3).")
-                return
-            elif text == "Шарада":
-                match = re.search(r"Ответ:\s*(.+)", reply, re.I)
-                answer = match.group(1).strip().upper() if match else None
-                description = re.sub(r"Ответ:\s*.+", "", reply, flags=re.I).strip()
-                if not answer:
-                    await send_message(chat_id, "⚠️ Не удалось сгенерировать шараду. Попробуй ещё.")
-                    return
-                sessions[chat_id] = {"game": text, "answer": answer}
-                await send_message(chat_id, f"🧩 {text}:\n\n{description}\n\nНапиши свой ответ.")
-                return
+llm_cache = LLMCache(
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_TTL,
+    LLM_CACHE_MAX_BYTES,
+    LLM_CACHE_PATH,
+    disk_max_entries=LLM_CACHE_DISK_MAX_ENTRIES,
+    prune_interval=LLM_CACHE_PRUNE_INTERVAL,
+)
+shutdown_hooks.append(llm_cache.stop)
 
-        # ==== Ответ на активную игру ====
-        if session.get("game"):
-            game = session.get("game")
-            correct = session.get("answer")
-            user_input = text.strip().upper()
-            win = False
-            if game in ["Продолжи историю"]:
-                # Любой выбор 1-3 считается успешным
-                win = user_input in ["1", "2", "3"]
-            else:
-                win = correct and user_input == correct.upper()
-            update_stats(chat_id, game, win)
-            sessions.pop(chat_id, None)
-            reply_text = f"🎉 Верно!" if win else f"❌ Неправильно. Было: {correct}" if correct else "❌ Попробуй снова."
-            await send_message(chat_id, reply_text, {
-                "keyboard": [[{"text": "Игры 🎲"}], [{"text": "/stats"}], [{"text": "Назад"}]],
-                "resize_keyboard": True
-            })
-            return
+def llm_cache_key(prompt, chat_history, temperature, cacheable):
+    if not llm_cacheable(cacheable, temperature):
+        llm_cache.skipped += 1
+        return None
+    return llm_cache.key(prompt, chat_history, LLM_MODEL, temperature, LLM_MAX_TOKENS)
 
-        # ==== Фоллбек ====
-        await send_message(chat_id, "⚠️ Напиши /start, чтобы начать сначала или выбери команду из меню.")
+# ---- Ограничение запросов к OpenRouter ----
+class LLMBusy(Exception):
+    """Все слоты OpenRouter заняты, и очередь ожидания полна."""
 
-    except Exception as e:
-        print("process_game_logic error:", e)
-        await send_message(chat_id, "⚠️ Произошла ошибка. Попробуй снова.")
+class LLMLimiter:
+    """Не больше max_concurrent одновременных запросов к OpenRouter и
+    не больше max_waiting ожидающих; сверх этого — сразу LLMBusy."""
 
-# ---- Webhook обработчик ----
-@app.post("/api/telegram")
-async def telegram_webhook(request: Request):
-    raw = await read_raw_body(request)
-    try:
-        update = json.loads(raw)
-    except Exception as e:
-        print("Bad JSON:", e)
-        return PlainTextResponse("Bad JSON", status_code=400)
+    def __init__(self, max_concurrent, max_waiting):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.semaphore = None
+        self.active = 0
+        self.waiting = 0
+        self.calls = 0
+        self.queued = 0
+        self.rejected = 0
 
-    from_id = str(
-        update.get("message", {}).get("from", {}).get("id") or
-        update.get("edited_message", {}).get("from", {}).get("id") or
-        update.get("callback_query", {}).get("from", {}).get("id") or
-        update.get("inline_query", {}).get("from", {}).get("id") or ""
-    )
-    is_owner = from_id and OWNER_ID and from_id == OWNER_ID
+    @asynccontextmanager
+    async def slot(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        if self.semaphore.locked():
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise LLMBusy()
+            self.queued += 1
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        LLM_SLOT_WAIT_SECONDS.observe(time.perf_counter() - started)
+        self.active += 1
+        self.calls += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
 
-    msg_text = (
-        update.get("message", {}).get("text") or
-        update.get("edited_message", {}).get("text") or
-        update.get("callback_query", {}).get("data") or
-        update.get("inline_query", {}).get("query") or ""
-    )
+    def snapshot(self):
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_waiting": self.max_waiting,
+            "active": self.active,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
 
-    # ---- /reply для владельца ----
-    if is_owner and isinstance(msg_text, str) and msg_text.startswith("/reply "):
-        parts = msg_text.split(" ")
-        target_id = parts[1] if len(parts) > 1 else None
-        reply_text = " ".join(parts[2:]) if len(parts) > 2 else ""
-        if not target_id or not reply_text:
-            await send_message(OWNER_ID, "⚠ Формат: /reply <chat_id> <текст>")
-        else:
-            await send_message(target_id, reply_text)
-            await send_message(OWNER_ID, f"✅ Сообщение отправлено пользователю {target_id}")
-        return PlainTextResponse("ok")
-
-    # ---- Пересылка JSON владельцу ----
-    if not is_owner and OWNER_ID:
-        header = f"📡 Новое событие (update_id: {update.get('update_id', '—')})\nСодержимое апдейта (JSON):\n"
-        payload = header + safe_json(update)
-        for chunk in chunk_string(payload):
-            await send_message(OWNER_ID, f"```json\n{chunk}\n```", parse_mode="Markdown")
-
-    chat_id = (
-        update.get("message", {}).get("chat", {}).get("id") or
-        update.get("edited_message", {}).get("chat", {}).get("id") or
-        update.get("callback_query", {}).get("message", {}).get("chat", {}).get("id")
-    )
+llm_limiter = LLMLimiter(LLM_MAX_CONCURRENCY, LLM_MAX_WAITING)
 
-    # ---- CallbackQuery ----
-    if update.get("callback_query"):
-        cqid = update["callback_query"].get("id")
-        if cqid:
-            await answer_callback_query(cqid)
-
-    if chat_id:
-        chat_id_str = str(chat_id)
-        first_name = (
-            update.get("message", {}).get("from", {}).get("first_name") or
-            update.get("edited_message", {}).get("from", {}).get("first_name") or
-            update.get("callback_query", {}).get("from", {}).get("first_name") or
-            ""
-        )
+# ---- Клиент OpenRouter ----
+# Срок на весь вызов, повторы с джиттером, дублирующие запросы на хвосте,
+# запасные модели и автомат, который не шлёт запросы больной модели.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+FATAL_STATUSES = {401, 402, 403}  # ключ или баланс — другая модель не поможет
 
-        # Контакт
-        contact = update.get("message", {}).get("contact")
+class LLMError(Exception):
+    """Запрос к OpenRouter не удался; detail — сообщение самого API, если оно есть."""
+
+    def __init__(self, status, detail=None, retry_after=None):
+        super().__init__(f"{status}: {detail}" if detail else str(status))
+        self.status = status
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return not isinstance(self.status, int) or self.status in RETRYABLE_STATUSES
+
+def api_error(res, data):
+    error = data.get("error") if isinstance(data, dict) else None
+    error = error if isinstance(error, dict) else {}
+    status = res.status_code if res.status_code != 200 else error.get("code") or 500
+    try:
+        retry_after = float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        retry_after = None
+    return LLMError(status, error.get("message"), retry_after)
+
+class CircuitBreaker:
+    """closed → open после failures сбоев подряд; через cooldown пропускает
+    один пробный запрос (half-open) и по его итогу закрывается или открывается снова."""
+
+    def __init__(self, failures, cooldown):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing or time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # Пробный запрос отменён, не успев ничего показать
+        self.probing = False
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+class LLMClient:
+    def __init__(self, models, deadline, retries, backoff_base, backoff_max,
+                 hedge, hedge_percentile, hedge_min_samples, breaker_failures, breaker_cooldown):
+        self.models = models
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breakers = {model: CircuitBreaker(breaker_failures, breaker_cooldown) for model in models}
+        self.latencies = deque(maxlen=200)  # успешные обычные запросы, секунды
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.short_circuited = 0
+        self.deadline_exceeded = 0
+
+    def backoff(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    async def call(self, attempt, payload, deadline):
+        """Перебрать модели по порядку, повторяя attempt на каждой в пределах срока."""
+        expires = time.monotonic() + (deadline or self.deadline)
+        last_error = None
+        for index, model in enumerate(self.models):
+            breaker = self.breakers[model]
+            if not breaker.allow():
+                self.short_circuited += 1
+                continue
+            if index and last_error is not None:
+                self.fallbacks += 1
+            for retry in range(self.retries + 1):
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    breaker.release()
+                    self.deadline_exceeded += 1
+                    raise LLMError("timeout", "превышен срок ожидания ответа")
+                try:
+                    result = await attempt(model, payload, remaining)
+                except LLMError as e:
+                    LLM_ATTEMPTS.inc(model, e.status)
+                    last_error = e
+                    if e.status in FATAL_STATUSES:
+                        breaker.release()
+                        raise
+                    if not e.retryable:
+                        # 400/404 и т.п. — возможно, дело в модели: пробуем следующую
+                        breaker.release()
+                        break
+                    breaker.failure()
+                    delay = self.backoff(retry, e.retry_after)
+                    if retry == self.retries or not breaker.allow() or time.monotonic() + delay >= expires:
+                        break
+                    self.retried += 1
+                    await asyncio.sleep(delay)
+                    continue
+                except BaseException:
+                    breaker.release()
+                    raise
+                LLM_ATTEMPTS.inc(model, 200)
+                breaker.success()
+                return result
+        if last_error is None:
+            raise LLMError("circuit_open", "ИИ временно недоступен")
+        raise last_error
+
+    async def post(self, model, payload, timeout):
+        started = time.monotonic()
+        try:
+            res = await asyncio.wait_for(get_http_client("openrouter").post(
+                f"{OPENROUTER_API_BASE}/chat/completions",
+                headers=openrouter_headers(),
+                json={**payload, "model": model},
+            ), timeout)
+        except asyncio.TimeoutError:
+            raise LLMError("timeout")
+        except httpx.HTTPError as e:
+            raise LLMError("exception", str(e) or type(e).__name__)
+        try:
+            data = res.json()
+        except ValueError:
+            data = {}
+        if res.status_code != 200 or not isinstance(data, dict) or data.get("error"):
+            raise api_error(res, data)
+        self.latencies.append(time.monotonic() - started)
+        return data
+
+    async def post_hedged(self, model, payload, timeout):
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return await self.post(model, payload, timeout)
+        first = asyncio.create_task(self.post(model, payload, timeout))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Ответ задерживается дольше обычного — второй такой же запрос, берём первый ответ
+                self.hedged += 1
+                tasks.add(asyncio.create_task(self.post(model, payload, timeout - delay)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def open_stream(self, model, payload, timeout):
+        client = get_http_client("openrouter")
+        request = client.build_request(
+            "POST",
+            f"{OPENROUTER_API_BASE}/chat/completions",
+            headers=openrouter_headers(),
+            json={**payload, "model": model, "stream": True},
+        )
+        try:
+            res = await asyncio.wait_for(client.send(request, stream=True), timeout)
+        except asyncio.TimeoutError:
+            raise LLMError("timeout")
+        except httpx.HTTPError as e:
+            raise LLMError("exception", str(e) or type(e).__name__)
+        if res.status_code != 200:
+            try:
+                data = json.loads(await res.aread() or b"{}")
+            except Exception:
+                data = {}
+            finally:
+                await res.aclose()
+            raise api_error(res, data)
+        return res
+
+    async def complete(self, payload, deadline=None):
+        return await self.call(self.post_hedged, payload, deadline)
+
+    @asynccontextmanager
+    async def stream(self, payload, deadline=None):
+        """Открытый SSE-ответ со статусом 200; срок и повторы — только до начала ответа."""
+        res = await self.call(self.open_stream, payload, deadline)
+        try:
+            yield res
+        finally:
+            await res.aclose()
+
+    def snapshot(self):
+        return {
+            "models": len(self.models),
+            "breakers": {model: BREAKER_STATES[b.state] for model, b in self.breakers.items()},
+            "breaker_opened": {model: b.opened for model, b in self.breakers.items()},
+            "hedge_delay_ms": round((self.hedge_delay() or 0) * 1000, 1),
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+            "short_circuited": self.short_circuited,
+            "deadline_exceeded": self.deadline_exceeded,
+        }
+
+llm_client = LLMClient(
+    models=[LLM_MODEL] + [m for m in LLM_FALLBACK_MODELS if m != LLM_MODEL],
+    deadline=LLM_DEADLINE,
+    retries=LLM_RETRIES,
+    backoff_base=LLM_BACKOFF_BASE,
+    backoff_max=LLM_BACKOFF_MAX,
+    hedge=LLM_HEDGE_ENABLED,
+    hedge_percentile=LLM_HEDGE_PERCENTILE,
+    hedge_min_samples=LLM_HEDGE_MIN_SAMPLES,
+    breaker_failures=LLM_BREAKER_FAILURES,
+    breaker_cooldown=LLM_BREAKER_COOLDOWN,
+)
+
+def llm_error_text(error):
+    return "Ошибка генерации: " + str(error.detail) if error.detail else "Ошибка генерации."
+
+async def ask_gpt(prompt, chat_history=None, temperature=1, cacheable=False, deadline=None, response_format=None,
+                  raise_errors=False):
+    """Ответ модели или текст ошибки для пользователя; с raise_errors=True ошибка — LLMError."""
+    if not OPENROUTER_API_KEY:
+        if raise_errors:
+            raise LLMError("no_key", "нет OPENROUTER_API_KEY")
+        return "Ошибка: нет OPENROUTER_API_KEY"
+    
+    cache_key = llm_cache_key(prompt, chat_history, temperature, cacheable)
+    if cache_key:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    async with llm_limiter.slot():
+        started = time.perf_counter()
+        status = "exception"
+        try:
+            messages = build_messages(prompt, chat_history)
+            record_prompt_tokens(messages)
+
+            payload = {
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": LLM_MAX_TOKENS
+            }
+            if response_format:
+                payload["response_format"] = response_format
+            data = await llm_client.complete(payload, deadline)
+            status = 200
+            record_usage(data)
+            content = data.get("choices", [{}])[0].get("message", {}).get("content")
+            if not content:
+                raise LLMError("empty")
+            if cache_key:
+                llm_cache.put(cache_key, content)
+            return content
+        except LLMError as e:
+            status = e.status
+            print("OpenRouter API error:", e)
+            if raise_errors:
+                raise
+            return llm_error_text(e)
+        except Exception as e:
+            print("ask_gpt error:", e)
+            if raise_errors:
+                raise LLMError("exception", str(e)) from e
+            return "Ошибка генерации."
+        finally:
+            elapsed = time.perf_counter() - started
+            LLM_SECONDS.observe(elapsed, "complete")
+            if status != 200:
+                LLM_ERRORS.inc("complete", status)
+            trace_span("openrouter", started, elapsed, status=status)
+
+async def ask_gpt_stream(prompt, chat_history=None, temperature=1, cacheable=False, deadline=None):
+    """Как ask_gpt, но отдаёт ответ кусками по мере генерации (SSE OpenRouter)."""
+    if not OPENROUTER_API_KEY:
+        yield "Ошибка: нет OPENROUTER_API_KEY"
+        return
+
+    cache_key = llm_cache_key(prompt, chat_history, temperature, cacheable)
+    if cache_key:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    streamed = False
+    parts = []
+    messages = build_messages(prompt, chat_history)
+    record_prompt_tokens(messages)
+    async with llm_limiter.slot():
+        started = time.perf_counter()
+        status = "exception"
+        try:
+            async with llm_client.stream({
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": LLM_MAX_TOKENS
+            }, deadline) as res:
+                status = res.status_code
+                async for line in res.aiter_lines():
+                    # Строки-комментарии (": OPENROUTER PROCESSING") и пустые пропускаем
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if chunk.get("error"):
+                        status = "stream_error"
+                        yield "Ошибка генерации: " + str(chunk["error"].get("message", "неизвестная ошибка"))
+                        return
+                    delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+                    if delta:
+                        if not streamed:
+                            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started)
+                        streamed = True
+                        parts.append(delta)
+                        yield delta
+        except LLMError as e:
+            status = e.status
+            print("OpenRouter API error:", e)
+            yield ("\n\n" if streamed else "") + llm_error_text(e)
+            return
+        except Exception as e:
+            status = "exception"
+            print("ask_gpt_stream error:", e)
+            yield ("\n\n" if streamed else "") + "Ошибка генерации."
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            LLM_SECONDS.observe(elapsed, "stream")
+            if status != 200:
+                LLM_ERRORS.inc("stream", status)
+            trace_span("openrouter_stream", started, elapsed, status=status)
+        if cache_key and parts:
+            llm_cache.put(cache_key, "".join(parts))
+
+# ---- Потоковые ответы ИИ ----
+ai_stream_stats = {"replies": 0, "ttft_total": 0.0, "ttft_max": 0.0, "total_total": 0.0, "total_max": 0.0, "edits": 0}
+
+async def edit_message(chat_id, message_id, text, parse_mode=None):
+    body = {"chat_id": str(chat_id), "message_id": message_id, "text": text}
+    if parse_mode:
+        body["parse_mode"] = parse_mode
+    try:
+        res = await telegram_api("editMessageText", body)
+        return res.status_code == 200
+    except Exception as e:
+        print("edit_message error:", e)
+        return False
+
+def message_id_of(res):
+    try:
+        return res.json()["result"]["message_id"]
+    except Exception:
+        return None
+
+def split_point(text, limit):
+    # Режем по переводу строки, если он не слишком далеко от границы
+    cut = text.rfind("\n", 0, limit)
+    return cut + 1 if cut > limit // 2 else limit
+
+async def keep_typing(chat_id):
+    while True:
+        try:
+            await telegram_api("sendChatAction", {"chat_id": chat_id, "action": "typing"})
+        except Exception as e:
+            print("sendChatAction error:", e)
+        await asyncio.sleep(4)  # индикатор в Telegram гаснет через ~5 с
+
+async def seal_stream_message(chat_id, text, offset, message_id, shown):
+    """Пока текст от offset не влезает в сообщение, дописать текущее до границы
+    и перейти к следующему; возвращает новые (offset, message_id, shown)."""
+    while message_id is not None and len(text) - offset > TELEGRAM_SEND_MAX:
+        cut = offset + split_point(text[offset:], TELEGRAM_SEND_MAX)
+        if text[offset:cut] != shown:
+            await edit_message(chat_id, message_id, text[offset:cut])
+        offset = cut
+        message_id, shown = None, ""
+    return offset, message_id, shown
+
+async def stream_ai_reply(chat_id, prompt, chat_history, reply_markup):
+    """Отправить ответ ИИ по мере генерации и вернуть его полный текст.
+
+    Первый кусок уходит отдельным сообщением, дальше оно редактируется не
+    чаще раза в AI_STREAM_EDIT_INTERVAL; при переходе через TELEGRAM_SEND_MAX
+    текущее сообщение фиксируется и начинается следующее.
+    """
+    started = time.monotonic()
+    ttft = None
+    typing = asyncio.create_task(keep_typing(chat_id))
+    text = ""
+    offset = 0          # начало текущего сообщения в text
+    message_id = None
+    shown = ""          # что сейчас видно в текущем сообщении
+    last_edit = 0.0
+    try:
+        async for delta in ask_gpt_stream(prompt, chat_history, cacheable=True):
+            if ttft is None:
+                ttft = time.monotonic() - started
+            text += delta
+            sent = False
+            # Один кусок может быть длиннее нескольких сообщений (ответ из кэша приходит целиком)
+            while True:
+                offset, message_id, shown = await seal_stream_message(chat_id, text, offset, message_id, shown)
+                if message_id is not None:
+                    break
+                cut = len(text) if len(text) - offset <= TELEGRAM_SEND_MAX else offset + split_point(text[offset:], TELEGRAM_SEND_MAX)
+                res = await send_message(chat_id, text[offset:cut], reply_markup, parse_mode=None)
+                message_id = message_id_of(res)
+                if message_id is None:
+                    break
+                shown, last_edit, sent = text[offset:cut], time.monotonic(), True
+            if sent or message_id is None:
+                continue
+            now = time.monotonic()
+            if now - last_edit >= AI_STREAM_EDIT_INTERVAL and text[offset:] != shown:
+                if await edit_message(chat_id, message_id, text[offset:]):
+                    ai_stream_stats["edits"] += 1
+                    shown = text[offset:]
+                last_edit = now
+    finally:
+        typing.cancel()
+
+    if not text:
+        text = "Ошибка генерации."
+    offset, message_id, shown = await seal_stream_message(chat_id, text, offset, message_id, shown)
+    if message_id is None:
+        # Ни одно сообщение не ушло — отправляем остаток обычным способом
+        for chunk in chunk_string(text[offset:]):
+            await send_message(chat_id, chunk, reply_markup)
+    elif not await edit_message(chat_id, message_id, text[offset:], parse_mode="Markdown"):
+        # Разметка модели не всегда валидна — оставляем простой текст
+        if text[offset:] != shown:
+            await edit_message(chat_id, message_id, text[offset:])
+
+    total = time.monotonic() - started
+    ai_stream_stats["replies"] += 1
+    ai_stream_stats["ttft_total"] += ttft or total
+    ai_stream_stats["ttft_max"] = max(ai_stream_stats["ttft_max"], ttft or total)
+    ai_stream_stats["total_total"] += total
+    ai_stream_stats["total_max"] = max(ai_stream_stats["total_max"], total)
+    return text
+
+# ---- История ИИ-чата ----
+# Старые реплики не выбрасываются, а сворачиваются в краткое содержание,
+# которое хранится первым сообщением истории с ролью system.
+SUMMARY_PREFIX = "Краткое содержание предыдущего диалога:\n"
+history_tasks = {}  # chat_id -> задача сворачивания
+
+def split_summary(history):
+    if history and history[0]["role"] == "system" and history[0]["content"].startswith(SUMMARY_PREFIX):
+        return history[0]["content"][len(SUMMARY_PREFIX):], history[1:]
+    return "", history
+
+def with_summary(summary, turns):
+    if not summary:
+        return turns
+    return [{"role": "system", "content": SUMMARY_PREFIX + summary}] + turns
+
+def plan_fold(history):
+    """Какие старые реплики свернуть, чтобы история снова влезла в бюджет."""
+    summary, turns = split_summary(history)
+    if message_tokens(history) <= AI_HISTORY_TOKEN_BUDGET:
+        return None
+    remaining = message_tokens(turns)
+    count = 0
+    # Сворачиваем до половины бюджета, но последний обмен репликами оставляем как есть
+    while count < len(turns) - 2 and remaining > AI_HISTORY_TOKEN_BUDGET // 2:
+        remaining -= 4 + approx_tokens(turns[count]["content"])
+        count += 1
+    if count % 2 and count < len(turns) - 2:
+        count += 1  # целыми парами вопрос-ответ
+    if not count:
+        return None
+    return summary, turns[:count]
+
+def trim_history(history):
+    """Жёсткий предел на случай, если сворачивание отстаёт или не работает."""
+    summary, turns = split_summary(history)
+    limit = AI_HISTORY_TOKEN_BUDGET * 3
+    while len(turns) > 2 and message_tokens(turns) > limit:
+        turns = turns[2:]
+    return with_summary(summary, turns)
+
+def local_summary(summary, fold):
+    lines = [summary] if summary else []
+    for m in fold:
+        who = "Пользователь" if m["role"] == "user" else "ИИ"
+        lines.append(f"{who}: {m['content'][:200]}")
+    text = "\n".join(lines)
+    while approx_tokens(text) > AI_SUMMARY_MAX_TOKENS and "\n" in text:
+        text = text.split("\n", 1)[1]
+    return text
+
+async def summarize_turns(summary, fold):
+    dialog = "\n".join(f"{'Пользователь' if m['role'] == 'user' else 'ИИ'}: {m['content']}" for m in fold)
+    prompt = f"""
+Сожми диалог пользователя с ИИ-помощником в краткое содержание: темы, факты о пользователе, договорённости.
+Не длиннее {AI_SUMMARY_MAX_TOKENS // 2} слов, без вступлений.
+
+Краткое содержание до этого: {summary or "нет"}
+
+Новые реплики:
+{dialog}
+    """.strip()
+    try:
+        result = await ask_gpt(prompt, temperature=0.2)
+    except LLMBusy:
+        result = None
+    if not result or result.startswith("Ошибка"):
+        return local_summary(summary, fold)
+    return result.strip()
+
+async def fold_history(chat_id, summary, fold):
+    try:
+        new_summary = await summarize_turns(summary, fold)
+
+        def apply(history):
+            if not history:
+                return history
+            _, turns = split_summary(history)
+            # Пока шло сворачивание, диалог могли начать заново — тогда ничего не трогаем
+            if turns[:len(fold)] != fold:
+                return history
+            return with_summary(new_summary, turns[len(fold):])
+
+        ai_chat_sessions.update(chat_id, apply)
+        state.flush()
+    except Exception as e:
+        print("fold_history error:", e)
+    finally:
+        history_tasks.pop(chat_id, None)
+
+def schedule_history_fold(chat_id, history):
+    if chat_id in history_tasks:
+        return
+    plan = plan_fold(history)
+    if plan:
+        history_tasks[chat_id] = asyncio.create_task(fold_history(chat_id, *plan))
+
+async def stop_history_tasks():
+    tasks = list(history_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+shutdown_hooks.append(stop_history_tasks)
+
+# ---- Контент: вопросы и игры ----
+# Модель отвечает JSON по схеме (response_format), ответ разбирается одним
+# декодером decode_content в ContentItem. Если модель не умеет структурированный
+# вывод, тот же декодер достаёт JSON из текста, прощая мелкие отклонения, а в
+# крайнем случае разбирает прежний текстовый формат.
+QUIZ_TOPICS = ["История", "Математика", "Английский"]
+
+class ContentItem:
+    """Готовый вопрос или раунд игры: текст для пользователя и правильный ответ."""
+
+    __slots__ = ("kind", "text", "answer", "fields", "source")
+
+    def __init__(self, kind, text, answer, fields=None, source="json"):
+        self.kind = kind
+        self.text = text
+        self.answer = answer
+        self.fields = fields  # поля по схеме; None для текстового формата
+        self.source = source  # json, extracted или text
+
+def object_schema(**properties):
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+def string_list(count):
+    return {"type": "array", "items": {"type": "string"}, "minItems": count, "maxItems": count}
+
+def conform(schema, value):
+    """Привести value к схеме: ключи без учёта регистра, "№2" -> 2, "B) 4" -> "B".
+    None, если значение не подходит."""
+    kind = schema["type"]
+    if kind == "object":
+        if not isinstance(value, dict):
+            return None
+        values = {str(k).strip().lower(): v for k, v in value.items()}
+        result = {}
+        for name, field in schema["properties"].items():
+            item = conform(field, values.get(name))
+            if item is None:
+                return None
+            result[name] = item
+        return result
+    if kind == "array":
+        if not isinstance(value, list) or not schema["minItems"] <= len(value) <= schema["maxItems"]:
+            return None
+        items = [conform(schema["items"], v) for v in value]
+        return None if None in items else items
+    if kind == "integer":
+        if isinstance(value, str):
+            digits = re.search(r"\d+", value)
+            value = int(digits.group()) if digits else None
+        if not isinstance(value, int) or isinstance(value, bool):
+            return None
+        return value if value in schema["enum"] else None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    value = str(value).strip()
+    if "enum" in schema:
+        return enum_choice(schema["enum"], value.upper())
+    return value or None
+
+ANSWER_MARKER_RE = re.compile(r"(?:ОТВЕТ|ANSWER)\w*\W+(\w+)")
+
+def enum_choice(choices, value):
+    """Вариант, названный в value отдельным словом: "B", "B) 4", "Ответ: C".
+
+    Сначала точное совпадение и слово после «Ответ»/«Answer», иначе —
+    единственный вариант среди слов. None, если варианта нет или названо
+    несколько ("A или C").
+    """
+    if value in choices:
+        return value
+    marked = ANSWER_MARKER_RE.search(value)
+    if marked and marked.group(1) in choices:
+        return marked.group(1)
+    named = {word for word in re.findall(r"\w+", value) if word in choices}
+    return named.pop() if len(named) == 1 else None
+
+def extract_json(reply):
+    """JSON-объект из ответа: весь ответ или первый {...} внутри текста/```json```."""
+    try:
+        return json_loads(reply), "json"
+    except ValueError:
+        pass
+    start, end = reply.find("{"), reply.rfind("}")
+    if start != -1 and end > start:
+        try:
+            return json_loads(reply[start:end + 1]), "extracted"
+        except ValueError:
+            pass
+    return None, None
+
+QUIZ = {
+    "name": "quiz",
+    "schema": object_schema(
+        question={"type": "string"},
+        options=string_list(4),
+        answer={"type": "string", "enum": ["A", "B", "C", "D"]},
+    ),
+    "render": lambda f: f["question"] + "\n\n" + "\n".join(f"{letter}) {option}" for letter, option in zip("ABCD", f["options"])),
+    "answer": lambda f: f["answer"],
+}
+
+def quiz_prompt(topic):
+    return f"""
+Задай один тестовый вопрос с 4 вариантами ответа по теме "{topic}".
+Ответь только JSON-объектом:
+{{"question": "...", "options": ["...", "...", "...", "..."], "answer": "A"}}
+где answer — буква правильного варианта (A-D).
+    """.strip()
+
+# Прежний текстовый формат — для моделей, которые игнорируют просьбу ответить JSON
+def parse_quiz(reply):
+    match = re.search(r"Правильный ответ:\s*([A-D])", reply, re.I)
+    if not match:
+        return None
+    question_without_answer = re.sub(r"Правильный ответ:\s*(.+)", "", reply, flags=re.I).strip()
+    return {"text": question_without_answer, "answer": match.group(1).upper()}
+
+def parse_guess_word(reply):
+    match = re.search(r"Загаданное слово:\s*(.+)", reply, re.I)
+    if not match:
+        return None
+    description = re.sub(r"Загаданное слово:\s*.+", "", reply, flags=re.I).replace("Описание:", "").strip()
+    return {"text": description, "answer": match.group(1).strip().upper()}
+
+def parse_find_lie(reply):
+    match = re.search(r"Ложь:\s*№?([1-3])", reply, re.I)
+    if not match:
+        return None
+    description = re.sub(r"Ложь:\s*№?[1-3]", "", reply, flags=re.I).strip()
+    return {"text": description, "answer": match.group(1)}
+
+def parse_story(reply):
+    # Правильного ответа нет, но без пронумерованных вариантов это не история, а ошибка
+    if not re.search(r"^\s*1[.)]", reply, re.M):
+        return None
+    return {"text": reply.strip(), "answer": None}
+
+def parse_charade(reply):
+    match = re.search(r"Ответ:\s*(.+)", reply, re.I)
+    if not match:
+        return None
+    description = re.sub(r"Ответ:\s*.+", "", reply, flags=re.I).strip()
+    return {"text": description, "answer": match.group(1).strip().upper()}
+
+QUIZ["parse"] = parse_quiz
+
+def numbered(items, mark="."):
+    return "\n".join(f"{i}{mark} {item}" for i, item in enumerate(items, 1))
+
+GAMES = {
+    "Угадай слово": {
+        "name": "guess_word",
+        "prompt": """
+Загадай одно существительное и опиши его так, чтобы пользователь попытался угадать, не называя само слово.
+Ответь только JSON-объектом:
+{"description": "...", "word": "..."}
+            """,
+        "schema": object_schema(description={"type": "string"}, word={"type": "string"}),
+        "render": lambda f: f["description"],
+        "answer": lambda f: f["word"].upper(),
+        "parse": parse_guess_word,
+        "reply": "🧠 {game}:\n\n{text}",
+        "failure": "⚠️ Не удалось сгенерировать слово. Попробуй ещё.",
+    },
+    "Найди ложь": {
+        "name": "find_lie",
+        "prompt": """
+Придумай три коротких утверждения на любые темы. Два из них правдивые, одно ложное.
+Ответь только JSON-объектом:
+{"statements": ["...", "...", "..."], "lie": 2}
+где lie — номер ложного утверждения (1, 2 или 3).
+            """,
+        "schema": object_schema(statements=string_list(3), lie={"type": "integer", "enum": [1, 2, 3]}),
+        "render": lambda f: numbered(f["statements"]),
+        "answer": lambda f: str(f["lie"]),
+        "parse": parse_find_lie,
+        "reply": "🕵️ {game}:\n\n{text}\n\nОтвет введи цифрой (1, 2 или 3).",
+        "failure": "⚠️ Не удалось сгенерировать утверждения. Попробуй ещё.",
+    },
+    "Продолжи историю": {
+        "name": "story",
+        "prompt": """
+Придумай короткое начало истории и три возможных продолжения.
+Ответь только JSON-объектом:
+{"beginning": "...", "options": ["...", "...", "..."]}
+            """,
+        "schema": object_schema(beginning={"type": "string"}, options=string_list(3)),
+        "render": lambda f: f["beginning"] + "\n\n" + numbered(f["options"]),
+        "answer": lambda f: None,
+        "parse": parse_story,
+        "reply": "📖 {game}:\n\n{text}\n\nВыбери номер продолжения (1, 2 или 3).",
+        "failure": "⚠️ Не удалось сгенерировать историю. Попробуй ещё.",
+    },
+    "Шарада": {
+        "name": "charade",
+        "prompt": """
+Придумай одну шараду (загадку), которая состоит из трех частей, каждая часть даёт подсказку, чтобы угадать слово.
+Ответь только JSON-объектом:
+{"parts": ["...", "...", "..."], "answer": "..."}
+            """,
+        "schema": object_schema(parts=string_list(3), answer={"type": "string"}),
+        "render": lambda f: numbered(f["parts"], ")"),
+        "answer": lambda f: f["answer"].upper(),
+        "parse": parse_charade,
+        "reply": "🧩 {game}:\n\n{text}\n\nНапиши свой ответ.",
+        "failure": "⚠️ Не удалось сгенерировать шараду. Попробуй ещё.",
+    },
+}
+
+def content_spec(kind):
+    return GAMES.get(kind) or QUIZ
+
+def response_format(spec):
+    if LLM_STRUCTURED_OUTPUT == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": spec["name"], "strict": True, "schema": spec["schema"]}}
+    if LLM_STRUCTURED_OUTPUT == "json_object":
+        return {"type": "json_object"}
+    return None
+
+CONTENT_DECODE = Counter("bot_content_decode_total", "Разбор сгенерированного контента по способу", ("kind", "source"))
+
+def decode_content(kind, reply):
+    """Единственный путь разбора ответа модели в ContentItem; None — ответ негоден."""
+    spec = content_spec(kind)
+    data, source = extract_json(reply)
+    fields = conform(spec["schema"], data) if data is not None else None
+    if fields is not None:
+        item = ContentItem(kind, spec["render"](fields), spec["answer"](fields), fields, source)
+    else:
+        parsed = spec["parse"](reply)
+        item = ContentItem(kind, parsed["text"], parsed["answer"], source="text") if parsed else None
+    CONTENT_DECODE.inc(kind, item.source if item else "failed")
+    return item
+
+async def generate_content(kind):
+    """Сгенерировать и разобрать вопрос по теме или раунд игры.
+
+    None — ответ не разобрался; LLMError — ответа от модели не было вовсе.
+    """
+    spec = content_spec(kind)
+    prompt = spec["prompt"] if kind in GAMES else quiz_prompt(kind)
+    reply = await ask_gpt(prompt, response_format=response_format(spec), raise_errors=True)
+    return decode_content(kind, reply)
+
+class ContentPool:
+    """Запас заранее сгенерированных и разобранных вопросов/раундов.
+
+    Фоновая задача держит для каждого вида контента depth готовых элементов.
+    Обработчик забирает элемент мгновенно, а при пустом пуле генерирует
+    его сам, как раньше.
+    """
+
+    def __init__(self, kinds, generate, depth, concurrency, retry_delay):
+        self.generate = generate
+        self.depth = depth
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+        self.pools = {kind: deque() for kind in kinds}
+        self.generating = {kind: 0 for kind in kinds}
+        self.retry_at = {kind: 0.0 for kind in kinds}
+        self.semaphore = None
+        self.wakeup = None
+        self.runner = None
+        self.tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.generations = 0
+        self.parse_failures = 0
+        self.llm_errors = 0
+        self.refills = 0
+        self.refill_total = 0.0
+        self.refill_max = 0.0
+
+    @property
+    def enabled(self):
+        return self.depth > 0 and bool(OPENROUTER_API_KEY)
+
+    def start(self):
+        if self.enabled and (self.runner is None or self.runner.done()):
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.wakeup = asyncio.Event()
+            self.runner = asyncio.create_task(self.run())
+
+    def wake(self):
+        if self.wakeup:
+            self.wakeup.set()
+
+    async def get(self, kind):
+        self.start()
+        pool = self.pools[kind]
+        if pool:
+            self.hits += 1
+            self.wake()
+            return pool.popleft()
+        self.misses += 1
+        self.wake()
+        return await self.generate_counted(kind)
+
+    async def generate_counted(self, kind):
+        try:
+            item = await self.generate(kind)
+        except LLMBusy:
+            raise
+        except LLMError:
+            # Сбой OpenRouter — не ошибка разбора; причина уже в bot_llm_errors_total
+            self.generations += 1
+            self.llm_errors += 1
+            return None
+        except Exception as e:
+            print("content generation error:", e)
+            item = None
+        self.generations += 1
+        if item is None:
+            self.parse_failures += 1
+        return item
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            sleep_for = None
+            for kind, pool in self.pools.items():
+                if now < self.retry_at[kind]:
+                    wait = self.retry_at[kind] - now
+                    sleep_for = wait if sleep_for is None else min(sleep_for, wait)
+                    continue
+                for _ in range(self.depth - len(pool) - self.generating[kind]):
+                    self.generating[kind] += 1
+                    task = asyncio.create_task(self.refill(kind))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refill(self, kind):
+        try:
+            async with self.semaphore:
+                started = time.monotonic()
+                try:
+                    item = await self.generate_counted(kind)
+                except LLMBusy:
+                    # Пользователям слоты нужнее — дозаполним позже
+                    self.retry_at[kind] = time.monotonic() + self.retry_delay
+                    return
+                elapsed = time.monotonic() - started
+            self.refills += 1
+            self.refill_total += elapsed
+            self.refill_max = max(self.refill_max, elapsed)
+            if item is None:
+                # Не сжигаем запросы, пока модель отвечает мусором или недоступна
+                self.retry_at[kind] = time.monotonic() + self.retry_delay
+            else:
+                self.pools[kind].append(item)
+        finally:
+            self.generating[kind] -= 1
+            self.wake()
+
+    async def stop(self):
+        if self.runner is None:
+            return
+        self.runner.cancel()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(self.runner, *self.tasks, return_exceptions=True)
+        self.runner = None
+
+    def snapshot(self):
+        served = self.hits + self.misses
+        replies = self.generations - self.llm_errors
+        produced = replies - self.parse_failures
+        return {
+            "depth": self.depth,
+            "available": {kind: len(pool) for kind, pool in self.pools.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / served, 4) if served else 0.0,
+            "generations": self.generations,
+            "llm_errors": self.llm_errors,
+            "parse_failures": self.parse_failures,
+            # Доля неразобранных среди ответов, которые модель всё же вернула
+            "parse_failure_rate": round(self.parse_failures / replies, 4) if replies else 0.0,
+            # Сколько генераций уходит впустую на каждый годный вопрос/раунд
+            "wasted_per_item": round(self.parse_failures / produced, 4) if produced else 0.0,
+            "refills": self.refills,
+            "refill_avg_ms": round(self.refill_total / self.refills * 1000, 1) if self.refills else 0.0,
+            "refill_max_ms": round(self.refill_max * 1000, 1),
+        }
+
+content_pool = ContentPool(
+    QUIZ_TOPICS + list(GAMES),
+    generate_content,
+    depth=CONTENT_POOL_DEPTH,
+    concurrency=CONTENT_POOL_CONCURRENCY,
+    retry_delay=CONTENT_POOL_RETRY_DELAY,
+)
+
+async def start_content_pool():
+    # Диспетчер sharded-режима апдейты не обрабатывает — запас готовят воркеры
+    if INGEST_MODE == "sharded" and SHARD_INDEX is None:
+        return
+    content_pool.start()
+
+startup_hooks.append(start_content_pool)
+shutdown_hooks.append(content_pool.stop)
+
+# ---- Одна генерация на чат ----
+GENERATION_SKIPPED = object()
+BUSY_TEXT = "⏳ Сейчас много запросов, подожди немного и попробуй снова."
+
+class GenerationGuard:
+    """Не больше одной генерации контента на чат.
+
+    Повторное нажатие той же кнопки, пока генерация идёт, присоединяется к
+    ней (ответ отправит первый обработчик). Другая кнопка отменяет текущую
+    генерацию: её результат всё равно был бы перезаписан в sessions.
+    """
+
+    def __init__(self):
+        self.in_flight = {}  # chat_id -> (action, task)
+        self.started = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def run(self, chat_id, action, factory):
+        current = self.in_flight.get(chat_id)
+        if current and not current[1].done():
+            if current[0] == action:
+                self.coalesced += 1
+                return GENERATION_SKIPPED
+            current[1].cancel()
+            self.cancelled += 1
+        task = asyncio.create_task(factory())
+        self.in_flight[chat_id] = (action, task)
+        self.started += 1
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self.in_flight.get(chat_id, (None, None))[1] is task:
+                del self.in_flight[chat_id]
+        if task.cancelled():
+            return GENERATION_SKIPPED
+        return task.result()
+
+    def supersede(self, chat_id, action):
+        """Другая кнопка уже ждёт в очереди чата — текущая генерация не нужна."""
+        current = self.in_flight.get(chat_id)
+        if current and current[0] != action and not current[1].done():
+            current[1].cancel()
+            self.cancelled += 1
+
+    def snapshot(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+generation_guard = GenerationGuard()
+GENERATION_ACTIONS = frozenset(QUIZ_TOPICS) | frozenset(GAMES)
+
+def generation_action(update, before=MISSING):
+    """Кнопка темы теста или игры, если route() отправит апдейт в start_quiz или start_game; иначе None.
+
+    before — действие апдейта чата, который обработают прямо перед этим:
+    MISSING — перед ним ничего нет, и маршрут считается по текущему
+    состоянию чата; None — каким будет состояние, заранее не известно.
+    """
+    text = update.text
+    if text not in GENERATION_ACTIONS:
+        return None
+    if before is MISSING:
+        handler = route(update.chat_id, text, sessions.get(update.chat_id, {}))
+        return text if handler in (start_quiz, start_game) else None
+    if before is None:
+        return None
+    # После теста или игры ни ИИ-диалога, ни отзыва нет; тема теста важнее
+    # ответа на вопрос, кнопка игры — ответа в игре, но не ответа на тест
+    return text if text in QUIZ_TOPICS or before in GAMES else None
+
+async def generate_for_chat(chat_id, action, factory):
+    """Генерация под GenerationGuard; GENERATION_SKIPPED — отвечать пользователю не нужно."""
+    try:
+        return await generation_guard.run(chat_id, action, factory)
+    except LLMBusy:
+        await send_message(chat_id, BUSY_TEXT)
+        return GENERATION_SKIPPED
+
+# ---- Клавиатуры ----
+MAIN_MENU_KEYBOARD = {
+    "keyboard": [[{"text": "🤖 ИИ-помощник"}],
+        [{"text": "История"}, {"text": "Математика"}],
+        [{"text": "Английский"}, {"text": "Игры 🎲"}],
+        [{"text": "/feedback"}, {"text": "📤 Поделиться контактом", "request_contact": True}]
+    ],
+    "resize_keyboard": True
+}
+AI_CHAT_KEYBOARD = {
+    "keyboard": [[{"text": "Закончить диалог"}]],
+    "resize_keyboard": True
+}
+AI_DONE_KEYBOARD = {
+    "keyboard": [
+        [{"text": "История"}, {"text": "Математика"}],
+        [{"text": "Английский"}, {"text": "Игры 🎲"}],
+        [{"text": "🤖 ИИ-помощник"}, {"text": "/feedback"}],
+        [{"text": "📤 Поделиться контактом", "request_contact": True}]
+    ],
+    "resize_keyboard": True
+}
+CONTACT_KEYBOARD = {
+    "keyboard": [[{"text": "📤 Поделиться контактом", "request_contact": True}], [{"text": "Назад"}]],
+    "resize_keyboard": True,
+    "one_time_keyboard": True
+}
+GAMES_KEYBOARD = {
+    "keyboard": [
+        [{"text": "Угадай слово"}, {"text": "Найди ложь"}],
+        [{"text": "Продолжи историю"}, {"text": "Шарада"}],
+        [{"text": "Назад"}, {"text": "/stats"}]
+    ],
+    "resize_keyboard": True
+}
+QUIZ_ANSWER_KEYBOARD = {
+    "keyboard": [
+        [{"text": "A"}, {"text": "B"}],
+        [{"text": "C"}, {"text": "D"}]
+    ],
+    "resize_keyboard": True
+}
+QUIZ_DONE_KEYBOARD = {
+    "keyboard": [[{"text": "🤖 ИИ-помощник"}],
+        [{"text": "История"}, {"text": "Математика"}],
+        [{"text": "Английский"}, {"text": "Игры 🎲"}]
+    ],
+    "resize_keyboard": True
+}
+GAME_DONE_KEYBOARD = {
+    "keyboard": [[{"text": "Игры 🎲"}], [{"text": "/stats"}], [{"text": "Назад"}]],
+    "resize_keyboard": True
+}
+
+# ---- Статистика игр ----
+def stats_games(value):
+    """Счётчики чата {игра: (сыграно, побед, время последней победы)} из значения stats.
+
+    Значение — {"name": имя, "games": {игра: [сыграно, побед, won_at]},
+    "counted": учтены ли в итогах}; записи прежнего формата {игра: {"played", "wins"}} читаются как есть и
+    переписываются в новый при следующей игре.
+    """
+    if not value:
+        return {}
+    if "games" in value:
+        return {game: tuple(counts) for game, counts in value["games"].items()}
+    return {game: (s["played"], s["wins"], 0) for game, s in value.items()}
+
+class Leaderboard:
+    """Первые size чатов одной игры по числу побед.
+
+    Ключ чата (-побед, время последней победы) меняется только на победе и
+    только в лучшую сторону, поэтому выбывший из топа чат не обгонит
+    оставшихся, пока сам не выиграет, — хранить всех остальных не нужно.
+    При равенстве побед выше тот, кто набрал их раньше.
+    """
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.entries = []  # отсортированные (-wins, won_at, chat_id)
+        self.members = {}  # chat_id -> (ключ, имя)
+        self.version = 0
+
+    def offer(self, chat_id, wins, won_at, name):
+        """Учесть число побед чата; True, если топ изменился."""
+        key = (-wins, won_at, chat_id)
+        old = self.members.get(chat_id)
+        if old is not None:
+            if old == (key, name):
+                return False
+            del self.entries[bisect_left(self.entries, old[0])]
+        elif len(self.entries) >= self.size and key >= self.entries[-1]:
+            return False
+        insort(self.entries, key)
+        self.members[chat_id] = (key, name)
+        if len(self.entries) > self.size:
+            del self.members[self.entries.pop()[2]]
+        self.version += 1
+        return True
+
+    def place(self, chat_id):
+        member = self.members.get(chat_id)
+        return bisect_left(self.entries, member[0]) + 1 if member else None
+
+    def top(self):
+        return [(chat_id, -wins, won_at, self.members[chat_id][1]) for wins, won_at, chat_id in self.entries]
+
+class GameStats:
+    """Итоги по играм, таблицы лидеров и готовые тексты /stats и /top.
+
+    Счётчики чата (пространство stats) и итоги по играм вместе с топами
+    (один ключ в пространстве stats_totals) живут в хранилище состояния и
+    меняются только через update — атомарно и общими для воркеров. Запись
+    прибавляет к итогам лишь свою разницу, поэтому полных проходов по чатам
+    нет; чат, чьи счётчики в итогах ещё не учтены (без отметки counted),
+    входит в них целиком при следующей игре. Топы и тексты — кэш процесса:
+    топы собираются заново, только когда итоги в хранилище изменились, а
+    тексты /stats хранятся вместе со значением чата и версиями топов. sqlite
+    хранит всё сам; хранилище в памяти раз в snapshot_interval и при
+    остановке сохраняется в path и читается при старте.
+    """
+
+    def __init__(self, view, totals_view, path, snapshot_interval, top_size, cache_entries):
+        self.view = view
+        self.totals_view = totals_view
+        self.store = view.store
+        self.path = "" if self.store.persistent else path
+        self.snapshot_interval = snapshot_interval
+        self.top_size = top_size
+        self.seen = None  # значение итогов, по которому собраны totals и boards
+        self.totals = {}  # игра -> [сыграно, побед, игроков]
+        self.boards = {}  # игра -> Leaderboard
+        self.version = 0  # меняется вместе с любым топом — для /top
+        self.rendered = BoundedState(max_entries=cache_entries)
+        self.top_rendered = (None, None)
+        self.loaded = False
+        self.task = None
+        self.saving = None
+        self.saved_records = 0
+        self.records = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.refreshes = 0
+        self.snapshots = 0
+        self.snapshot_ms = 0.0
+        self.load_ms = 0.0
+        self.errors = 0
+
+    def make_board(self, top):
+        board = Leaderboard(self.top_size)
+        for chat_id, wins, won_at, name in top:
+            board.offer(chat_id, wins, won_at, name)
+        return board
+
+    def merge(self, totals, delta, chat_id, name):
+        """Итоги после записи: delta — {игра: (сыграно, побед, игроков, побед чата, won_at)}."""
+        totals = dict(totals)
+        for game, (played, wins, players, chat_wins, won_at) in delta.items():
+            entry = totals.get(game) or {"played": 0, "wins": 0, "players": 0, "top": []}
+            top = entry["top"]
+            if chat_wins:
+                board = self.make_board(top)
+                if board.offer(chat_id, chat_wins, won_at, name):
+                    top = [list(row) for row in board.top()]
+            totals[game] = {
+                "played": entry["played"] + played,
+                "wins": entry["wins"] + wins,
+                "players": entry["players"] + players,
+                "top": top,
+            }
+        return totals
+
+    def record(self, chat_id, game, win, name=None):
+        self.start()
+        name = name or "Без имени"
+        now = time.time()
+        counted = False
+
+        def bump(value):
+            nonlocal counted
+            counted = bool(value.get("counted"))
+            games = dict(value["games"]) if "games" in value else {g: list(c) for g, c in stats_games(value).items()}
+            played, wins, won_at = games.get(game, (0, 0, 0))
+            games[game] = [played + 1, wins + 1, now] if win else [played + 1, wins, won_at]
+            return {"name": name, "games": games, "counted": True}
+
+        games = self.view.update(chat_id, bump, {})["games"]
+        if counted:
+            played, wins, won_at = games[game]
+            delta = {game: (1, 1 if win else 0, 1 if played == 1 else 0, wins if win else 0, won_at)}
+        else:
+            # Прежние счётчики чата в итогах ещё не учтены — добавляем их целиком
+            delta = {g: (played, wins, 1, wins, won_at) for g, (played, wins, won_at) in games.items()}
+        self.totals_view.update("games", lambda totals: self.merge(totals, delta, chat_id, name), {})
+        self.records += 1
+
+    def board_version(self, game):
+        board = self.boards.get(game)
+        return board.version if board is not None else 0
+
+    def refresh(self):
+        """Собрать итоги и топы заново, если значение в хранилище изменилось."""
+        value = self.totals_view.get("games") or {}
+        if value is self.seen or value == self.seen:
+            self.seen = value
+            return
+        changed = False
+        boards = {}
+        for game, entry in value.items():
+            board = boards[game] = self.make_board(entry["top"])
+            old = self.boards.get(game)
+            same = old is not None and board.top() == old.top()
+            board.version = (old.version if old else 0) + (not same)
+            changed = changed or not same
+        self.totals = {game: [e["played"], e["wins"], e["players"]] for game, e in value.items()}
+        self.boards = boards
+        self.seen = value
+        self.version += changed
+        self.refreshes += 1
+
+    def chat_text(self, chat_id):
+        self.start()
+        self.refresh()
+        value = self.view.get(chat_id)
+        cached = self.rendered.get(chat_id)
+        # Текст годен, пока не изменились ни значение в хранилище, ни топы его игр
+        if (cached is not None and (cached[0] is value or cached[0] == value)
+                and all(self.board_version(game) == version for game, version in cached[1])):
+            self.cache_hits += 1
+            return cached[2]
+        self.cache_misses += 1
+        games = stats_games(value)
+        versions = tuple((game, self.board_version(game)) for game in games)
+        if not games:
+            text = "Ты ещё не играл ни в одну игру."
+        else:
+            lines = []
+            for game, (played, wins, _) in games.items():
+                place = self.boards[game].place(chat_id) if game in self.boards else None
+                lines.append(f"• {game}: сыграно {played}, побед {wins}" + (f" — 🏆 {place}-е место" if place else ""))
+            text = "📊 Твоя статистика:\n\n" + "\n".join(lines) + "\n\nЛучшие игроки: /top"
+        self.rendered[chat_id] = (value, versions, text)
+        return text
+
+    def top_text(self):
+        self.start()
+        self.refresh()
+        version, text = self.top_rendered
+        if version == self.version:
+            self.cache_hits += 1
+            return text
+        self.cache_misses += 1
+        blocks = []
+        for game, board in self.boards.items():
+            if board.entries:
+                rows = [f"{place}. {name} — побед: {wins}" for place, (_, wins, _, name) in enumerate(board.top(), 1)]
+                blocks.append(f"{game}:\n" + "\n".join(rows))
+        text = "🏆 Лучшие игроки\n\n" + "\n\n".join(blocks) if blocks else "Пока никто не выигрывал."
+        self.top_rendered = (self.version, text)
+        return text
+
+    def load(self):
+        """Вернуть в хранилище в памяти снимок счётчиков и итогов — один раз, при старте."""
+        if self.loaded:
+            return
+        self.loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        started = time.perf_counter()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            chats, totals = data["chats"], data["totals"]
+        except Exception as e:
+            self.errors += 1
+            print("stats snapshot load error:", e)
+            return
+        for chat_id, value in chats:
+            self.view[chat_id] = value
+        self.totals_view["games"] = totals
+        self.saved_records = self.records
+        self.load_ms = (time.perf_counter() - started) * 1000
+
+    def start(self):
+        self.load()
+        if self.path and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    async def save(self):
+        if self.saving is not None:
+            await asyncio.gather(self.saving, return_exceptions=True)
+        if self.records == self.saved_records:
+            return
+        started = time.perf_counter()
+        # Значения в хранилище не меняются на месте (update возвращает новые),
+        # поэтому список пар можно сериализовать в потоке без копирования
+        chats, totals, records = self.store.scan(self.view.ns), self.totals_view.get("games") or {}, self.records
+        self.saving = asyncio.get_running_loop().run_in_executor(None, self.write, chats, totals)
+        try:
+            await asyncio.shield(self.saving)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print("stats snapshot error:", e)
+            return
+        finally:
+            self.saving = None
+        self.saved_records = records
+        self.snapshots += 1
+        self.snapshot_ms = (time.perf_counter() - started) * 1000
+
+    def write(self, chats, totals):
+        data = json.dumps({"version": 3, "chats": chats, "totals": totals}, ensure_ascii=False, separators=(",", ":"))
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.path:
+            await self.save()
+
+    def snapshot(self):
+        return {
+            "games": len(self.totals),
+            "records": self.records,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cached": len(self.rendered),
+            "refreshes": self.refreshes,
+            "snapshots": self.snapshots,
+            "snapshot_ms": round(self.snapshot_ms, 1),
+            "load_ms": round(self.load_ms, 1),
+            "errors": self.errors,
+        }
+
+    def summary(self):
+        self.refresh()
+        return {
+            game: {"played": played, "wins": wins, "players": players}
+            for game, (played, wins, players) in self.totals.items()
+        }
+
+game_stats = GameStats(stats, stats_totals, STATS_SNAPSHOT_PATH, STATS_SNAPSHOT_INTERVAL, STATS_TOP_SIZE, STATS_RENDER_CACHE)
+
+async def start_game_stats():
+    game_stats.start()
+
+startup_hooks.append(start_game_stats)
+shutdown_hooks.append(game_stats.stop)
+
+# ---- Игровая логика ----
+
+# Все обработчики: handler(chat_id, text, first_name, session)
+
+# ==== ИИ-помощник ====
+async def start_ai_chat(chat_id, text, first_name, session):
+    # Начинаем сессию с ИИ
+    ai_chat_sessions[chat_id] = []
+    await send_message(chat_id, 
+        "🤖 Привет! Я твой ИИ-помощник. Задай мне любой вопрос, и я постараюсь помочь!\n\n"
+        "Можешь спросить о чем угодно: учеба, программирование, советы по разным темам и т.д.\n\n"
+        "Чтобы закончить диалог, напиши /stop или нажми кнопку 'Закончить диалог'", 
+        AI_CHAT_KEYBOARD
+    )
+
+# ==== Обработка вопросов к ИИ ====
+async def ai_chat_reply(chat_id, text, first_name, session):
+    # ==== Завершение диалога с ИИ ====
+    if text in AI_STOP_TEXTS:
+        ai_chat_sessions.pop(chat_id)
+        await send_message(chat_id, "✅ Диалог с ИИ-помощником завершен. Чем еще могу помочь?", AI_DONE_KEYBOARD)
+        return
+
+    try:
+        if AI_STREAMING:
+            # Ответ уходит пользователю по мере генерации
+            ai_response = await stream_ai_reply(chat_id, text, ai_chat_sessions[chat_id], AI_CHAT_KEYBOARD)
+        else:
+            # Показываем, что бот печатает
+            await telegram_api("sendChatAction", {"chat_id": chat_id, "action": "typing"})
+            
+            # Получаем ответ от ИИ
+            ai_response = await ask_gpt(text, ai_chat_sessions[chat_id], cacheable=True)
+    except LLMBusy:
+        await send_message(chat_id, BUSY_TEXT, AI_CHAT_KEYBOARD)
+        return
+    
+    # Обновляем историю диалога. Пока ждали ответ, диалог могли завершить
+    # (/stop, «Назад») — тогда не воскрешаем его: None из update ничего не пишет
+    turn = [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": ai_response},
+    ]
+    history = ai_chat_sessions.update(chat_id, lambda current: trim_history(current + turn) if current is not None else None)
+
+    # Сверх AI_HISTORY_TOKEN_BUDGET старые реплики сворачиваются в фоне
+    if history is not None:
+        schedule_history_fold(chat_id, history)
+    
+    if not AI_STREAMING:
+        await send_message(chat_id, ai_response, AI_CHAT_KEYBOARD)
+
+# ==== Контакт ====
+async def ask_contact(chat_id, text, first_name, session):
+    feed[chat_id] = True
+    await send_message(chat_id, "📱 Пожалуйста, поделитесь своим номером телефона:", CONTACT_KEYBOARD)
+
+# ==== Feedback ====
+async def start_feedback(chat_id, text, first_name, session):
+    feedback_sessions[chat_id] = True
+    await send_message(chat_id, "📝 Пожалуйста, введите ваш комментарий одним сообщением:")
+
+async def capture_feedback(chat_id, text, first_name, session):
+    feedback_sessions.pop(chat_id)
+    fn = session.get("firstName")
+    username = session.get("username")
+    queue_message(OWNER_ID, f"💬 Отзыв от {fn or 'Без имени'} (@{username or 'нет'})\nID: {chat_id}\nТекст: {text}")
+    queue_message(OWNER_ID, f"/reply {chat_id}")
+    await send_message(chat_id, "✅ Ваш комментарий отправлен, скоро с вами свяжутся!")
+
+# ==== /start / Назад ====
+async def start(chat_id, text, first_name, session):
+    sessions[chat_id] = {"firstName": first_name}
+    await send_message(chat_id, f"👋 Привет, {first_name or 'друг'}! Выбери тему для теста или игру:", MAIN_MENU_KEYBOARD)
+
+async def back(chat_id, text, first_name, session):
+    sessions[chat_id] = {"firstName": first_name}
+    await send_message(chat_id, f"{first_name or 'друг'}!, Выбери тему для теста или игру:", MAIN_MENU_KEYBOARD)
+
+# ==== /stats ====
+async def show_stats(chat_id, text, first_name, session):
+    await send_message(chat_id, game_stats.chat_text(chat_id))
+
+# ==== /top ====
+async def show_top(chat_id, text, first_name, session):
+    # Имена игроков — не Markdown
+    await send_message(chat_id, game_stats.top_text(), parse_mode=None)
+
+# ==== Игры ====
+async def games_menu(chat_id, text, first_name, session):
+    await send_message(chat_id, "Выбери игру:", GAMES_KEYBOARD)
+
+# ==== Тесты по темам ====
+async def start_quiz(chat_id, text, first_name, session):
+    topic = text
+    item = await generate_for_chat(chat_id, topic, lambda: content_pool.get(topic))
+    if item is GENERATION_SKIPPED:
+        return
+    if not item:
+        await send_message(chat_id, "⚠️ Не удалось сгенерировать вопрос. Попробуй снова.")
+        return
+    sessions[chat_id] = {"correctAnswer": item.answer}
+    await send_message(chat_id, f"📚 Вопрос по теме *{topic}*:\n\n{item.text}", QUIZ_ANSWER_KEYBOARD)
+
+# ==== Проверка ответа на тест ====
+async def check_quiz_answer(chat_id, text, first_name, session):
+    user_answer = text.strip().upper()
+    session = dict(session)
+    correct = session.pop("correctAnswer").upper()
+    sessions[chat_id] = session
+    win = user_answer == correct
+    game_stats.record(chat_id, "Тест", win, first_name)
+    reply_text = "✅ Правильно! Хочешь ещё вопрос?" if win else f"❌ Неправильно. Правильный ответ: {correct}\nПопробуешь ещё?"
+    await send_message(chat_id, reply_text, QUIZ_DONE_KEYBOARD)
+
+# ==== Общий обработчик игр ====
+async def start_game(chat_id, text, first_name, session):
+    game = GAMES[text]
+    item = await generate_for_chat(chat_id, text, lambda: content_pool.get(text))
+    if item is GENERATION_SKIPPED:
+        return
+    if not item:
+        await send_message(chat_id, game["failure"])
+        return
+    sessions[chat_id] = {"game": text, "answer": item.answer}
+    await send_message(chat_id, game["reply"].format(game=text, text=item.text))
+
+# ==== Ответ на активную игру ====
+async def check_game_answer(chat_id, text, first_name, session):
+    game = session.get("game")
+    correct = session.get("answer")
+    user_input = text.strip().upper()
+    win = False
+    if game in ["Продолжи историю"]:
+        # Любой выбор 1-3 считается успешным
+        win = user_input in ["1", "2", "3"]
+    else:
+        win = correct and user_input == correct.upper()
+    game_stats.record(chat_id, game, win, first_name)
+    sessions.pop(chat_id, None)
+    reply_text = f"🎉 Верно!" if win else f"❌ Неправильно. Было: {correct}" if correct else "❌ Попробуй снова."
+    await send_message(chat_id, reply_text, GAME_DONE_KEYBOARD)
+
+# ==== Фоллбек ====
+async def fallback(chat_id, text, first_name, session):
+    await send_message(chat_id, "⚠️ Напиши /start, чтобы начать сначала или выбери команду из меню.")
+
+# ---- Маршрутизация ----
+# Приоритеты повторяют порядок исторической цепочки if: команда из таблицы
+# срабатывает, только если более приоритетное состояние чата не перехватило текст.
+PRIORITY_AI_START = 0
+PRIORITY_AI_SESSION = 1
+PRIORITY_SERVICE = 2       # /contact, /feedback
+PRIORITY_FEEDBACK = 3
+PRIORITY_MENU = 4          # /start, Назад, /stats, /top, Игры, темы тестов
+PRIORITY_QUIZ_ANSWER = 5
+PRIORITY_GAMES = 6
+PRIORITY_GAME_ANSWER = 7
+
+AI_STOP_TEXTS = frozenset(["/stop", "Закончить диалог"])
+
+# Точные команды: текст -> (приоритет, обработчик)
+COMMANDS = {
+    "/ai": (PRIORITY_AI_START, start_ai_chat),
+    "🤖 ИИ-помощник": (PRIORITY_AI_START, start_ai_chat),
+    "/contact": (PRIORITY_SERVICE, ask_contact),
+    "/feedback": (PRIORITY_SERVICE, start_feedback),
+    "/start": (PRIORITY_MENU, start),
+    "Назад": (PRIORITY_MENU, back),
+    "/stats": (PRIORITY_MENU, show_stats),
+    "/top": (PRIORITY_MENU, show_top),
+    "Игры 🎲": (PRIORITY_MENU, games_menu),
+}
+for topic in QUIZ_TOPICS:
+    COMMANDS[topic] = (PRIORITY_MENU, start_quiz)
+for game_name in GAMES:
+    COMMANDS[game_name] = (PRIORITY_GAMES, start_game)
+
+# Состояния чата в порядке приоритета: (приоритет, активно ли, обработчик).
+# "Назад" в диалоге с ИИ не перехватывается и уходит в меню, как и раньше.
+STATE_HANDLERS = [
+    (PRIORITY_AI_SESSION, lambda chat_id, text, session: text != "Назад" and chat_id in ai_chat_sessions, ai_chat_reply),
+    (PRIORITY_FEEDBACK, lambda chat_id, text, session: feedback_sessions.get(chat_id), capture_feedback),
+    (PRIORITY_QUIZ_ANSWER, lambda chat_id, text, session: session.get("correctAnswer"), check_quiz_answer),
+    (PRIORITY_GAME_ANSWER, lambda chat_id, text, session: session.get("game"), check_game_answer),
+]
+
+def route(chat_id, text, session):
+    command = COMMANDS.get(text)
+    for priority, active, handler in STATE_HANDLERS:
+        if command and command[0] < priority:
+            break
+        if active(chat_id, text, session):
+            return handler
+    return command[1] if command else fallback
+
+async def process_game_logic(chat_id, text, first_name):
+    session = sessions.get(chat_id, {})
+    handler = fallback
+    started = time.perf_counter()
+    try:
+        handler = route(chat_id, text, session)
+        await handler(chat_id, text, first_name, session)
+    except Exception as e:
+        HANDLER_ERRORS.inc(handler.__name__)
+        print("process_game_logic error:", e)
+        await send_message(chat_id, "⚠️ Произошла ошибка. Попробуй снова.")
+    finally:
+        elapsed = time.perf_counter() - started
+        HANDLER_SECONDS.observe(elapsed, handler.__name__)
+        trace_span("handler", started, elapsed, handler=handler.__name__)
+        # Все записи одного апдейта уходят в хранилище одной транзакцией
+        try:
+            state.flush()
+        except Exception as e:
+            print("state flush error:", e)
+
+# ---- Разбор апдейтов ----
+UPDATE_KINDS = ("message", "edited_message", "callback_query", "inline_query")
+
+def json_loads(raw):
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+def json_dumps(obj):
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+class ParsedUpdate:
+    """Апдейт Telegram, из которого нужные поля извлечены за один проход.
+
+    В апдейте присутствует ровно одно из полей UPDATE_KINDS, поэтому
+    достаточно найти его и прочитать поля только из него. Исходные байты
+    тела сохраняются: для пересылки владельцу JSON заново не собирается.
+    """
+
+    __slots__ = (
+        "raw", "data", "update_id", "kind", "from_id", "chat_id",
+        "text", "first_name", "callback_query_id", "contact", "dumped",
+    )
+
+    def __init__(self, data, raw=None):
+        if not isinstance(data, dict):
+            raise ValueError("update must be a JSON object")
+        self.raw = raw
+        self.data = data
+        self.dumped = None
+        self.update_id = data.get("update_id")
+        self.kind = None
+        obj = {}
+        for kind in UPDATE_KINDS:
+            value = data.get(kind)
+            if value:
+                self.kind, obj = kind, value
+                break
+        sender = obj.get("from") or {}
+        self.from_id = str(sender.get("id") or "")
+        self.first_name = sender.get("first_name") or ""
+        self.callback_query_id = None
+        self.contact = None
+        if self.kind == "callback_query":
+            self.text = obj.get("data") or ""
+            chat = (obj.get("message") or {}).get("chat") or {}
+            self.callback_query_id = obj.get("id")
+        elif self.kind == "inline_query":
+            self.text = obj.get("query") or ""
+            self.first_name = ""
+            chat = {}
+        else:
+            self.text = obj.get("text") or ""
+            chat = obj.get("chat") or {}
+            if self.kind == "message":
+                self.contact = obj.get("contact")
+        chat_id = chat.get("id")
+        self.chat_id = str(chat_id) if chat_id else None
+
+    @classmethod
+    def from_bytes(cls, raw):
+        return cls(json_loads(raw), raw)
+
+    @property
+    def order_key(self):
+        # Ключ сериализации: чат (или отправитель, если чата нет)
+        return self.chat_id or self.from_id
+
+    def json(self):
+        """Компактный JSON апдейта; по возможности — исходное тело как есть."""
+        if self.dumped is None:
+            # \uXXXX-экранирование нечитаемо в чате — такое тело пересобираем
+            if self.raw is not None and b"\\u" not in self.raw:
+                self.dumped = self.raw.decode("utf-8", "replace")
+            else:
+                self.dumped = json_dumps(self.data)
+        return self.dumped
+
+# ---- Очередь апдейтов ----
+class UpdateDeduplicator:
+    """Помнит update_id за последние window секунд (Telegram повторяет доставку)."""
+
+    def __init__(self, window, max_size=100_000):
+        self.window = window
+        self.max_size = max_size
+        self.seen = {}
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id):
+        if update_id is None:
+            return False
+        now = time.monotonic()
+        # dict хранит порядок вставки — самые старые записи в начале
+        while self.seen:
+            oldest_id, ts = next(iter(self.seen.items()))
+            if now - ts < self.window and len(self.seen) < self.max_size:
+                break
+            del self.seen[oldest_id]
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+        self.seen[update_id] = now
+        return False
+
+    def forget(self, update_id):
+        self.seen.pop(update_id, None)
+
+class UpdateQueue:
+    """Ограниченная очередь с пулом воркеров и строгим порядком внутри чата.
+
+    У каждого чата своя очередь ожидания; в общей очереди готовых чатов ключ
+    чата присутствует не больше одного раза, поэтому два апдейта одного чата
+    никогда не обрабатываются параллельно, а медленный чат не блокирует чужие.
+
+    Раз апдейты чата идут по одному, GenerationGuard повторных нажатий здесь
+    не увидит — их склеивает сама очередь. action_of(update, before) —
+    действие апдейта, если перед ним обработают апдейт с действием before
+    (MISSING — перед ним ничего нет), или None, когда апдейт ничего не
+    запускает или это заранее не известно. Действие ждущих апдейтов
+    запоминается при постановке, выполняемого — пересчитывается перед
+    обработкой. То же действие, что у предыдущего апдейта, поглощается;
+    другое заменяет ждущее и отменяет выполняемую генерацию. Апдейты без
+    действия (сообщения ИИ, ответы, отзывы) не склеиваются никогда.
+    """
+
+    def __init__(self, handler, workers, max_size, action_of=None):
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.action_of = action_of
+        self.pending = {}
+        self.active = {}  # ключ чата -> действие апдейта в обработке
+        self.ready = None
+        self.space = None
+        self.tasks = []
+        self.depth = 0
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def running(self):
+        return bool(self.tasks)
+
+    def start(self):
+        if self.running:
+            return
+        self.ready = asyncio.Queue()
+        self.space = asyncio.Event()
+        for key, items in self.pending.items():
+            if items:
+                self.ready.put_nowait(key)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def submit(self, update):
+        if self.depth >= self.max_size:
+            self.dropped += 1
+            return False
+        self.add(update)
+        return True
+
+    async def put(self, update):
+        """Как submit, но при полной очереди ждёт места, а не отбрасывает.
+
+        False — апдейт поглощён таким же нажатием, уже стоящим в очереди.
+        """
+        if not self.running:
+            self.start()
+        while self.depth >= self.max_size:
+            self.space.clear()
+            await self.space.wait()
+        return self.add(update)
+
+    def add(self, update):
+        if not self.running:
+            self.start()
+        key = update.order_key
+        items = self.pending.get(key)
+        self.submitted += 1
+        action = self.action(key, items, len(items) if items else 0, update)
+        if action is not None and self.coalesce(key, items, update, action):
+            return False
+        if items is None:
+            items = self.pending[key] = deque()
+            self.ready.put_nowait(key)
+        items.append((time.monotonic(), update, action))
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    def action(self, key, items, index, update):
+        """Действие update, если он встанет в очередь чата на место index."""
+        if not self.action_of:
+            return None
+        if index:
+            before = items[index - 1][2]
+        else:
+            before = self.active.get(key, MISSING)
+        return self.action_of(update, before)
+
+    def coalesce(self, key, items, update, action):
+        if items:
+            enqueued_at, last, last_action = items[-1]
+            if last_action == action:
+                self.coalesced += 1
+                return True
+            if last_action is not None:
+                # Ждущее нажатие устарело, не дождавшись обработки; место в очереди
+                # сохраняем, если и на нём апдейт наверняка запустит генерацию
+                replaced = self.action(key, items, len(items) - 1, update)
+                if replaced is not None:
+                    items[-1] = (enqueued_at, update, replaced)
+                    self.superseded += 1
+                    return True
+            return False
+        if self.active.get(key) == action:
+            self.coalesced += 1
+            return True
+        generation_guard.supersede(update.chat_id, action)
+        return False
+
+    async def worker(self):
+        while True:
+            key = await self.ready.get()
+            items = self.pending[key]
+            enqueued_at, update, _ = items.popleft()
+            # Всё, что было до него, уже обработано — действие считаем по состоянию чата
+            self.active[key] = self.action_of(update) if self.action_of else None
+            wait = time.monotonic() - enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("update worker error:", e)
+            finally:
+                self.depth -= 1
+                self.space.set()
+                del self.active[key]
+                if items:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.pending[key]
+                self.ready.task_done()
+
+    async def stop(self, timeout=10):
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.ready.join(), timeout)
+        except asyncio.TimeoutError:
+            print("update queue: dropping", self.depth, "updates on shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def snapshot(self):
+        done = self.processed + self.failed
+        return {
+            "workers": self.workers,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "capacity": self.max_size,
+            "active_chats": len(self.pending),
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "superseded": self.superseded,
+            "wait_avg_ms": round(self.wait_total / done * 1000, 3) if done else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+recent_updates = UpdateDeduplicator(UPDATE_DEDUP_WINDOW)
+
+# ---- Пересылка владельцу и журнал апдейтов ----
+class UpdateArchive:
+    """Append-only журнал апдейтов в JSON Lines с ротацией по размеру.
+
+    Строки копятся в памяти и дописываются в файл раз в секунду в отдельном
+    потоке. Заполненный файл уходит в path.1 (path.1.gz при сжатии), старые
+    сдвигаются, сверх backups — удаляются.
+    """
+
+    def __init__(self, path, max_bytes, backups, compress):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.buffer = []
+        self.task = None
+        self.writing = None  # запись в потоке; отмена run() её не останавливает
+        self.written = 0
+        self.bytes = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def write(self, update):
+        if not self.path:
+            return
+        self.buffer.append(f'{{"received":{time.time():.3f},"update":{update.json()}}}\n')
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(1)
+            await self.flush()
+
+    async def flush(self):
+        await self.wait_writing()
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        self.writing = asyncio.get_running_loop().run_in_executor(None, self.append, lines)
+        await self.wait_writing()
+
+    async def wait_writing(self):
+        # shield: при отмене ждущего запись в потоке продолжается, и stop() её дождётся
+        if self.writing is None:
+            return
+        try:
+            await asyncio.shield(self.writing)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print("update archive error:", e)
+        self.writing = None
+
+    def append(self, lines):
+        data = "".join(lines).encode()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.write(data)
+            size = f.tell()
+        self.written += len(lines)
+        self.bytes += len(data)
+        if self.max_bytes and size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        suffix = ".gz" if self.compress else ""
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}{suffix}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}{suffix}")
+        if self.compress:
+            with open(self.path, "rb") as src, gzip.open(f"{self.path}.1.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, f"{self.path}.1")
+        self.rotations += 1
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    def snapshot(self):
+        return {
+            "enabled": bool(self.path),
+            "pending": len(self.buffer),
+            "written": self.written,
+            "bytes": self.bytes,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+update_archive = UpdateArchive(UPDATE_ARCHIVE_PATH, UPDATE_ARCHIVE_MAX_BYTES, UPDATE_ARCHIVE_BACKUPS, UPDATE_ARCHIVE_COMPRESS)
+shutdown_hooks.append(update_archive.stop)
+
+def update_label(update):
+    """Короткая метка апдейта для владельца: команда, кнопка, контакт или просто текст."""
+    text = update.text
+    if update.contact:
+        return "контакт"
+    if text in COMMANDS:
+        return text
+    if update.kind == "callback_query":
+        return "кнопка"
+    if text.startswith("/"):
+        return text.split()[0][:32]
+    return "текст" if text else update.kind or "другое"
+
+def compact_line(update):
+    name = update.first_name or "—"
+    text = " ".join(update.text.split())
+    if len(text) > 100:
+        text = text[:100] + "…"
+    line = f"👤 {name} ({update.from_id or update.chat_id or '—'}) · {update_label(update)}"
+    return f"{line}: {text}" if text and text != update_label(update) else line
+
+class OwnerDigest:
+    """Сводка апдейтов за интервал: сколько всего, от кого и какие команды."""
+
+    def __init__(self, interval, top=10, max_keys=1000):
+        self.interval = interval
+        self.top = top
+        self.max_keys = max_keys
+        self.task = None
+        self.sent = 0
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.users = {}  # id -> [имя, число апдейтов]
+        self.labels = {}
+        self.started_at = time.time()
+
+    def add(self, update):
+        user = update.from_id or update.chat_id or "—"
+        entry = self.users.get(user)
+        if entry is None:
+            if len(self.users) >= self.max_keys:
+                user = "…"
+            entry = self.users.setdefault(user, [update.first_name if user != "…" else "остальные", 0])
+        entry[1] += 1
+        label = update_label(update)
+        if label in self.labels or len(self.labels) < self.max_keys:
+            self.labels[label] = self.labels.get(label, 0) + 1
+        self.total += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def render(self):
+        minutes = max(1, round((time.time() - self.started_at) / 60))
+        users = sorted(self.users.items(), key=lambda item: -item[1][1])
+        labels = sorted(self.labels.items(), key=lambda item: -item[1])
+        lines = [f"📊 За {minutes} мин: {self.total} апдейтов от {len(self.users)} пользователей"]
+        lines.append("Команды: " + ", ".join(f"{label} ×{count}" for label, count in labels[:self.top]))
+        lines.append("Пользователи: " + ", ".join(
+            f"{name or '—'} ({user}) ×{count}" for user, (name, count) in users[:self.top]
+        ))
+        return "\n".join(lines)
+
+    def flush(self):
+        if not self.total:
+            return
+        text = self.render()
+        self.reset()
+        self.sent += 1
+        queue_message(OWNER_ID, text, parse_mode=None)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+            self.flush()
+
+owner_digest = OwnerDigest(OWNER_DIGEST_INTERVAL)
+shutdown_hooks.append(owner_digest.stop)
+owner_forward_stats = {"forwarded": 0}
+
+def forward_to_owner(update):
+    if OWNER_FORWARD_MODE == "full":
+        update_id = update.update_id if update.update_id is not None else "—"
+        header = f"📡 Новое событие (update_id: {update_id})\nСодержимое апдейта (JSON):\n"
+        # Планировщик склеит пересылки подряд и сам порежет по TELEGRAM_SEND_MAX
+        queue_message(OWNER_ID, header + update.json(), wrap="```json\n{}\n```")
+    elif OWNER_FORWARD_MODE == "compact":
+        # Одинаковая обёртка — строки подряд склеиваются в одно сообщение
+        queue_message(OWNER_ID, compact_line(update), parse_mode=None, wrap="{}")
+    elif OWNER_FORWARD_MODE == "digest":
+        owner_digest.add(update)
+        return
+    else:
+        return
+    owner_forward_stats["forwarded"] += 1
+
+# ---- Обработка апдейта ----
+async def handle_update(update):
+    started = time.perf_counter()
+    trace, token = start_trace(update_id=update.update_id, kind=update.kind, chat_id=update.chat_id)
+    try:
+        await dispatch_update(update)
+    finally:
+        UPDATE_SECONDS.observe(time.perf_counter() - started, update.kind or "unknown")
+        finish_trace(trace, token)
+
+async def dispatch_update(update):
+    is_owner = update.from_id and OWNER_ID and update.from_id == OWNER_ID
+    msg_text = update.text
+
+    # ---- /reply для владельца ----
+    if is_owner and isinstance(msg_text, str) and msg_text.startswith("/reply "):
+        parts = msg_text.split(" ")
+        target_id = parts[1] if len(parts) > 1 else None
+        reply_text = " ".join(parts[2:]) if len(parts) > 2 else ""
+        if not target_id or not reply_text:
+            await send_message(OWNER_ID, "⚠ Формат: /reply <chat_id> <текст>")
+        else:
+            await send_message(target_id, reply_text)
+            await send_message(OWNER_ID, f"✅ Сообщение отправлено пользователю {target_id}")
+        return
+
+    # ---- Журнал и пересылка владельцу ----
+    if not is_owner:
+        update_archive.write(update)
+        if OWNER_ID:
+            forward_to_owner(update)
+
+    # ---- CallbackQuery ----
+    if update.callback_query_id:
+        await answer_callback_query(update.callback_query_id)
+
+    if update.chat_id:
+        chat_id_str = update.chat_id
+
+        # Контакт
+        contact = update.contact
         if contact:
             await send_message(chat_id_str, f"✅ Спасибо! Я получил твой номер: +{contact.get('phone_number')}")
-            await send_message(
+            queue_message(
                 OWNER_ID,
                 f"📞 Новый контакт:\nИмя: {contact.get('first_name')}\nТелефон: +{contact.get('phone_number')}\nID: {contact.get('user_id')}"
             )
-            return PlainTextResponse("ok")
+            return
+
+        await process_game_logic(chat_id_str, str(msg_text or ""), update.first_name)
+
+update_queue = UpdateQueue(handle_update, UPDATE_WORKERS, UPDATE_QUEUE_MAX, action_of=generation_action)
+
+async def start_update_queue():
+    if INGEST_MODE == "queue":
+        update_queue.start()
+
+startup_hooks.append(start_update_queue)
+shutdown_hooks.append(update_queue.stop)
+
+# ---- Шардирование по процессам ----
+# Диспетчер (процесс с webhook или long polling) только разбирает апдейт,
+# отсеивает дубликаты и отправляет сырое тело в очередь процесса-воркера,
+# выбранного по хэшу чата. Состояние чата живёт только в его воркере, поэтому
+# хранилище в памяти остаётся согласованным, а порядок внутри чата сохраняется.
+SHARD_INDEX = None  # номер шарда в процессе-воркере; None — диспетчер или обычный режим
+
+def shard_of(key, count):
+    return zlib.crc32(str(key).encode()) % count
+
+def configure_shard(index, count):
+    """Общие для бота лимиты делятся между процессами поровну."""
+    global SHARD_INDEX
+    SHARD_INDEX = index
+    bucket = outbound.global_bucket
+    outbound.global_bucket = TokenBucket(bucket.rate / count, max(1, bucket.capacity / count))
+    if OWNER_ID:
+        # В чат владельца пишут все воркеры
+        outbound.limit_chat(OWNER_ID, outbound.chat_rate / count, max(1, outbound.chat_burst / count))
+    llm_limiter.max_concurrent = max(1, llm_limiter.max_concurrent // count)
+    llm_limiter.max_waiting = max(1, llm_limiter.max_waiting // count)
+    content_pool.concurrency = max(1, content_pool.concurrency // count)
+    if update_archive.path:
+        # Свой файл на процесс: ротация не должна делить файл с другими
+        update_archive.path += f".shard{index}"
+
+def run_shard_worker(index, count, inbox, processed):
+    """Точка входа процесса-воркера."""
+    configure_shard(index, count)
+    try:
+        asyncio.run(shard_worker(inbox, processed))
+    except KeyboardInterrupt:
+        pass
+
+async def shard_worker(inbox, processed):
+    async def handle_counted(update):
+        try:
+            await handle_update(update)
+        finally:
+            processed[SHARD_INDEX] += 1
+
+    update_queue.handler = handle_counted
+    await run_startup_hooks()
+    update_queue.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # Блокирующее чтение — в потоке; всё, что уже пришло, забираем пачкой
+            batch = [await loop.run_in_executor(None, inbox.get)]
+            try:
+                while len(batch) < 100:
+                    batch.append(inbox.get_nowait())
+            except Empty:
+                pass
+            for raw in batch:
+                if raw is None:
+                    return
+                try:
+                    update = ParsedUpdate.from_bytes(raw)
+                except Exception as e:
+                    print("shard worker: bad update:", e)
+                    continue
+                if not await update_queue.put(update):
+                    # Поглощён таким же нажатием — для диспетчера он тоже обработан
+                    processed[SHARD_INDEX] += 1
+    finally:
+        await run_shutdown_hooks()
+
+class ShardPool:
+    """SHARD_WORKERS процессов со своими очередями; чат закреплён за одним из них.
+
+    Умерший воркер перезапускается при следующем апдейте для его шарда, не
+    чаще раза в restart_delay секунд. Очередь у нового воркера новая: старый
+    процесс умирает, держа её блокировку чтения, и то, что в ней лежало,
+    теряется.
+    """
+
+    def __init__(self, workers, max_size, restart_delay=1):
+        self.workers = workers
+        self.max_size = max_size
+        self.restart_delay = restart_delay
+        self.ctx = None
+        self.inboxes = []
+        self.processes = []
+        self.processed = None
+        self.submitted = [0] * workers
+        self.started_at = [0.0] * workers
+        self.dropped = 0
+        self.restarts = 0
+
+    @property
+    def running(self):
+        return bool(self.processes)
+
+    def start(self):
+        if self.running:
+            return
+        # spawn, а не fork: диспетчер к этому моменту может держать потоки и event loop
+        self.ctx = multiprocessing.get_context("spawn")
+        self.processed = self.ctx.Array("q", self.workers, lock=False)
+        self.inboxes = [None] * self.workers
+        self.processes = [None] * self.workers
+        for index in range(self.workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        inbox = self.ctx.Queue(self.max_size)
+        process = self.ctx.Process(
+            target=run_shard_worker,
+            args=(index, self.workers, inbox, self.processed),
+            name=f"shard-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.inboxes[index] = inbox
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+
+    def alive(self, index):
+        process = self.processes[index]
+        if process.is_alive():
+            return True
+        if time.monotonic() - self.started_at[index] < self.restart_delay:
+            # Воркер падает сразу после старта — не плодим процесс на каждый апдейт
+            return False
+        print(f"shard pool: {process.name} exited with {process.exitcode}, restarting")
+        process.join(0)
+        self.inboxes[index].close()
+        self.spawn(index)
+        self.restarts += 1
+        return True
+
+    def offer(self, update):
+        if not self.running:
+            self.start()
+        index = shard_of(update.order_key, self.workers)
+        if not self.alive(index):
+            return False
+        raw = update.raw if update.raw is not None else json_dumps(update.data).encode()
+        try:
+            self.inboxes[index].put_nowait(raw)
+        except Full:
+            return False
+        self.submitted[index] += 1
+        return True
+
+    def submit(self, update):
+        if self.offer(update):
+            return True
+        self.dropped += 1
+        return False
+
+    async def put(self, update):
+        """Как submit, но при полной очереди шарда ждёт места, а не отбрасывает."""
+        while not self.offer(update):
+            await asyncio.sleep(0.01)
+
+    async def stop(self, timeout=10):
+        if not self.running:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        for inbox in self.inboxes:
+            try:
+                await loop.run_in_executor(None, inbox.put, None, True, max(0.1, deadline - time.monotonic()))
+            except Full:
+                pass
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, max(0.1, deadline - time.monotonic()))
+            if process.is_alive():
+                print("shard pool: terminating", process.name)
+                process.terminate()
+        self.processes = []
+        self.inboxes = []
+
+    def snapshot(self):
+        processed = list(self.processed) if self.processed is not None else [0] * self.workers
+        return {
+            "workers": self.workers,
+            "alive": sum(p.is_alive() for p in self.processes),
+            "submitted": sum(self.submitted),
+            "processed": sum(processed),
+            "dropped": self.dropped,
+            "restarts": self.restarts,
+            "per_shard": {str(i): n for i, n in enumerate(processed)},
+        }
+
+shard_pool = ShardPool(SHARD_WORKERS, SHARD_QUEUE_MAX)
+
+async def start_shard_pool():
+    if INGEST_MODE == "sharded" and SHARD_INDEX is None:
+        shard_pool.start()
+
+startup_hooks.append(start_shard_pool)
+shutdown_hooks.append(shard_pool.stop)
+
+# ---- Long polling ----
+polling_stats = {"batches": 0, "updates": 0, "errors": 0, "offset": None}
 
-        text = msg_text
-        await process_game_logic(chat_id_str, str(text or ""), first_name)
+async def poll_updates():
+    """Получать апдейты через getUpdates — без публичного адреса и webhook.
 
-    return PlainTextResponse("ok")
+    Пачки раздаются в ту же очередь, что и в режиме INGEST_MODE=queue:
+    параллельно между чатами, по порядку внутри чата, тем же handle_update.
+    В режиме INGEST_MODE=sharded — процессам-воркерам.
+    """
+    ingest = shard_pool if INGEST_MODE == "sharded" else update_queue
+    ingest.start()
+    # getUpdates не работает, пока у бота установлен webhook
+    try:
+        await telegram_api("deleteWebhook", {"drop_pending_updates": False})
+    except Exception as e:
+        print("deleteWebhook error:", e)
+    offset = None
+    failures = 0
+    while True:
+        payload = {"timeout": POLLING_TIMEOUT, "limit": POLLING_LIMIT}
+        if offset is not None:
+            payload["offset"] = offset
+        try:
+            res = await telegram_api("getUpdates", payload, timeout=POLLING_TIMEOUT + 10)
+            data = json_loads(res.content)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            data = {"ok": False, "description": str(e)}
+        if not data.get("ok"):
+            failures += 1
+            polling_stats["errors"] += 1
+            print("getUpdates error:", data.get("description"))
+            retry_after = (data.get("parameters") or {}).get("retry_after")
+            await asyncio.sleep(retry_after or min(30, 2 ** failures))
+            continue
+        failures = 0
+        polling_stats["batches"] += 1
+        for item in data.get("result") or []:
+            # Следующий getUpdates с этим offset подтвердит пачку в Telegram
+            offset = item["update_id"] + 1
+            try:
+                update = ParsedUpdate(item)
+            except ValueError:
+                continue
+            if recent_updates.is_duplicate(update.update_id):
+                continue
+            polling_stats["updates"] += 1
+            await ingest.put(update)
+        polling_stats["offset"] = offset
+
+async def run_polling():
+    await run_startup_hooks()
+    try:
+        await poll_updates()
+    finally:
+        await run_shutdown_hooks()
+
+# ---- Webhook обработчик ----
+@app.post("/api/telegram")
+async def telegram_webhook(request: Request):
+    started = time.perf_counter()
+    result, response = await receive_update(request)
+    WEBHOOK_SECONDS.observe(time.perf_counter() - started, result)
+    return response
+
+async def receive_update(request):
+    raw = await read_raw_body(request)
+    try:
+        update = ParsedUpdate.from_bytes(raw)
+    except Exception as e:
+        print("Bad JSON:", e)
+        return "bad_json", PlainTextResponse("Bad JSON", status_code=400)
+
+    update_id = update.update_id
+    if recent_updates.is_duplicate(update_id):
+        return "duplicate", PlainTextResponse("ok")
+
+    if INGEST_MODE in ("queue", "sharded"):
+        target = shard_pool if INGEST_MODE == "sharded" else update_queue
+        if not target.submit(update):
+            # Не подтверждаем: Telegram доставит апдейт повторно позже
+            recent_updates.forget(update_id)
+            return "busy", PlainTextResponse("Busy", status_code=503)
+        return "queued", PlainTextResponse("ok")
+
+    await handle_update(update)
+    return "handled", PlainTextResponse("ok")
+
+@app.get("/api/telegram/state")
+async def state_stats():
+    return {"backend": STATE_BACKEND, "namespaces": state.footprint()}
+
+@app.get("/api/telegram/queue")
+async def queue_stats():
+    return {
+        "mode": INGEST_MODE,
+        **update_queue.snapshot(),
+        "duplicates": recent_updates.duplicates,
+        "outbound": outbound.snapshot(),
+        "content_pool": content_pool.snapshot(),
+        "ai_stream": ai_stream_stats,
+        "llm_cache": llm_cache.snapshot(),
+        "polling": polling_stats,
+        "llm_limiter": llm_limiter.snapshot(),
+        "llm_client": llm_client.snapshot(),
+        "shards": shard_pool.snapshot(),
+        "owner_forward": {"mode": OWNER_FORWARD_MODE, **owner_forward_stats, "digests": owner_digest.sent},
+        "update_archive": update_archive.snapshot(),
+        "game_stats": {**game_stats.snapshot(), "totals": game_stats.summary()},
+        "generation": generation_guard.snapshot(),
+        "prompt_tokens": prompt_token_snapshot(),
+    }
+
+metric_sources.extend([
+    ("update_queue", update_queue.snapshot),
+    ("outbound", outbound.snapshot),
+    ("content_pool", content_pool.snapshot),
+    ("ai_stream", lambda: ai_stream_stats),
+    ("llm_cache", llm_cache.snapshot),
+    ("llm_limiter", llm_limiter.snapshot),
+    ("llm_client", llm_client.snapshot),
+    ("shards", shard_pool.snapshot),
+    ("owner_forward", lambda: {**owner_forward_stats, "digests": owner_digest.sent}),
+    ("update_archive", update_archive.snapshot),
+    ("game_stats", game_stats.snapshot),
+    ("generation", generation_guard.snapshot),
+    ("prompt_tokens", prompt_token_snapshot),
+    ("polling", lambda: polling_stats),
+    ("dedup", lambda: {"duplicates": recent_updates.duplicates}),
+])
+
+# /metrics — для Prometheus; второй путь — для деплоя, где наружу проброшен только /api/telegram*
+@app.get("/metrics")
+@app.get("/api/telegram/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_polling())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,209 @@
+"""Локальные заглушки внешних API для бенчмарков.
+
+Поднимает uvicorn в отдельном потоке, чтобы клиентская нагрузка и сервер
+не делили один event loop. У обеих заглушек настраиваются задержка,
+доля ошибок 5xx и доля ответов 429 (см. StubConfig).
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class StubConfig:
+    """Поведение заглушки: задержка ответа и доли ошибок (0..1).
+
+    Доля tail_rate ответов задерживается на tail_latency — медленный хвост.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1,
+                 tail_rate=0.0, tail_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+
+    def delay(self):
+        if self.tail_rate and random.random() < self.tail_rate:
+            return self.tail_latency
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def failure(self):
+        """None, 429 или 500 — что ответить на этот запрос."""
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+
+# ---- Telegram Bot API ----
+fake_telegram = FastAPI()
+telegram_config = StubConfig()
+telegram_calls = []
+# Ответы заглушки по (метод, код) — включая 429 и 500
+telegram_responses = Counter()
+# Апдейты, которые отдаёт getUpdates (по возрастанию update_id)
+pending_updates = []
+
+
+def get_updates(payload):
+    offset = payload.get("offset") or 0
+    while pending_updates and pending_updates[0]["update_id"] < offset:
+        pending_updates.pop(0)
+    return pending_updates[:payload.get("limit") or 100]
+
+
+@fake_telegram.post("/bot{token}/{method}")
+async def telegram_method(token: str, method: str, request: Request):
+    payload = await request.json()
+    if method == "getUpdates":
+        result = get_updates(payload)
+        if not result:
+            # Короткое ожидание вместо полного long polling, чтобы не тормозить бенчмарк
+            await asyncio.sleep(0.05)
+        return JSONResponse({"ok": True, "result": result})
+    delay = telegram_config.delay()
+    if delay:
+        await asyncio.sleep(delay)
+    failure = telegram_config.failure()
+    telegram_responses[method, failure or 200] += 1
+    if failure == 429:
+        return JSONResponse(
+            {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after "
+             f"{telegram_config.retry_after}", "parameters": {"retry_after": telegram_config.retry_after}},
+            status_code=429,
+        )
+    if failure:
+        return JSONResponse({"ok": False, "error_code": failure, "description": "Internal Server Error"},
+                            status_code=failure)
+    telegram_calls.append((method, payload))
+    return JSONResponse({"ok": True, "result": {"message_id": len(telegram_calls)}})
+
+
+# ---- OpenRouter chat/completions ----
+fake_openrouter = FastAPI()
+openrouter_config = StubConfig()
+# Потоковый ответ: число кусков и пауза между ними (задержка latency — до первого куска)
+openrouter_stream = {"chunks": 8, "chunk_delay": 0.02}
+openrouter_calls = Counter()  # (stream, код) -> число запросов
+openrouter_models = Counter()  # модель -> число запросов
+# Модели, которые всегда отвечают заданным кодом (проверка запасных моделей)
+openrouter_model_status = {}
+
+# Ответы на промпты тестов и игр: JSON по схеме и прежний текстовый формат
+CANNED_CONTENT = [
+    ('"question"', {"question": "Сколько будет 2 + 2?", "options": ["3", "4", "5", "22"], "answer": "B"},
+     "Вопрос: Сколько будет 2 + 2?\nA) 3\nB) 4\nC) 5\nD) 22\n\nПравильный ответ: B"),
+    ('"word"', {"description": "Мурлычет и ловит мышей.", "word": "кот"},
+     "Описание: Мурлычет и ловит мышей.\nЗагаданное слово: кот"),
+    ('"lie"', {"statements": ["Вода кипит при 100 °C.", "Луна сделана из сыра.", "У паука восемь ног."], "lie": 2},
+     "1. Вода кипит при 100 °C.\n2. Луна сделана из сыра.\n3. У паука восемь ног.\nЛожь: №2"),
+    ('"beginning"', {"beginning": "Дверь скрипнула.", "options": ["Вошёл кот.", "Подул ветер.", "Никого не было."]},
+     "Начало: Дверь скрипнула.\n1. Вошёл кот.\n2. Подул ветер.\n3. Никого не было."),
+    ('"parts"', {"parts": ["Первый слог — нота.", "Второй — тоже нота.", "Вместе — имя."], "answer": "Соля"},
+     "1) Первый слог — нота.\n2) Второй — тоже нота.\n3) Вместе — имя.\nОтвет: Соля"),
+]
+SUMMARY_REPLY = "Пользователь болтал с ботом о жизни."
+CHAT_REPLY = "Ну и вопрос! Ладно, отвечу: всё сложно, но интересно. Спроси что-нибудь ещё."
+# Доли ответов на промпты контента, где модель отходит от чистого JSON:
+# prose — JSON внутри текста и ```json```, text — прежний текстовый формат, garbage — мусор
+openrouter_drift = {"prose": 0.0, "text": 0.0, "garbage": 0.0}
+
+
+def content_reply(data, text):
+    roll = random.random()
+    for kind in ("prose", "text", "garbage"):
+        if roll < openrouter_drift[kind]:
+            break
+        roll -= openrouter_drift[kind]
+    else:
+        return json.dumps(data, ensure_ascii=False)
+    if kind == "prose":
+        return "Конечно! Вот ответ:\n```json\n" + json.dumps(data, ensure_ascii=False, indent=2) + "\n```"
+    if kind == "text":
+        return text
+    return "Извини, сегодня без загадок."
+
+
+def canned_reply(messages):
+    prompt = messages[-1]["content"] if messages else ""
+    for marker, data, text in CANNED_CONTENT:
+        if marker in prompt:
+            return content_reply(data, text)
+    if prompt.startswith("Сожми"):
+        return SUMMARY_REPLY
+    return CHAT_REPLY
+
+
+def chunks(text, count):
+    size = max(1, -(-len(text) // count))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@fake_openrouter.post("/api/v1/chat/completions")
+async def openrouter_completions(request: Request):
+    body = await request.json()
+    stream = bool(body.get("stream"))
+    openrouter_models[body.get("model")] += 1
+    delay = openrouter_config.delay()
+    if delay:
+        await asyncio.sleep(delay)
+    failure = openrouter_model_status.get(body.get("model")) or openrouter_config.failure()
+    openrouter_calls[stream, failure or 200] += 1
+    if failure:
+        message = "Rate limit exceeded" if failure == 429 else "Upstream error"
+        headers = {"Retry-After": str(openrouter_config.retry_after)} if failure == 429 else None
+        return JSONResponse({"error": {"code": failure, "message": message}}, status_code=failure, headers=headers)
+    reply = canned_reply(body.get("messages") or [])
+    if not stream:
+        return JSONResponse({
+            "choices": [{"message": {"role": "assistant", "content": reply}}],
+            "usage": {"prompt_tokens": len(json.dumps(body["messages"], ensure_ascii=False)) // 4},
+        })
+
+    async def events():
+        yield b": OPENROUTER PROCESSING\n\n"
+        for i, part in enumerate(chunks(reply, openrouter_stream["chunks"])):
+            if i and openrouter_stream["chunk_delay"]:
+                await asyncio.sleep(openrouter_stream["chunk_delay"])
+            chunk = {"choices": [{"delta": {"content": part}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def reset():
+    telegram_calls.clear()
+    telegram_responses.clear()
+    openrouter_calls.clear()
+    openrouter_models.clear()
+
+
+class ServerThread:
+    def __init__(self, app, port):
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = f"http://127.0.0.1:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
@@ -0,0 +1,155 @@
+"""Статистика игр: прежние update_stats и /stats против GameStats.
+
+    python -m bench.game_stats [--chats 100000] [--records 500000] [--top 10]
+
+Обе схемы пишут счётчики в хранилище состояния в памяти. Прежний /stats
+собирает текст заново на каждый запрос, а таблицу лидеров пришлось бы
+строить полным проходом по чатам; GameStats отдаёт закэшированный текст и
+держит итоги и топ в хранилище без проходов. Дальше — цена записи на
+sqlite и снимок хранилища в памяти: его время и самая долгая пауза event
+loop за это время.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from api import telegram as tg
+
+GAMES = ["Тест"] + list(tg.GAMES)
+
+
+def make_records(args):
+    rng = random.Random(args.seed)
+    return [(str(rng.randrange(args.chats)), rng.choice(GAMES), rng.random() < 0.4) for _ in range(args.records)]
+
+
+def per_op(seconds, count):
+    return f"{seconds / count * 1e6:8.2f} us"
+
+
+def old_record(view, chat_id, game, win):
+    def bump(user_stats):
+        s = user_stats.get(game, {"played": 0, "wins": 0})
+        return {**user_stats, game: {"played": s["played"] + 1, "wins": s["wins"] + (1 if win else 0)}}
+    view.update(chat_id, bump, {})
+
+
+def old_render(view, chat_id):
+    user_stats = view.get(chat_id)
+    msg = "📊 Твоя статистика:\n\n"
+    for game, s in user_stats.items():
+        msg += f"• {game}: сыграно {s['played']}, побед {s['wins']}\n"
+    return msg
+
+
+def old_top(store, game, size):
+    rows = [(s[game]["wins"], chat_id) for chat_id, (s, _, _) in store.data["stats"].items.items() if game in s]
+    return sorted(rows, reverse=True)[:size]
+
+
+def memory_view():
+    store = tg.MemoryStateStore({})
+    return store, store.view("stats")
+
+
+async def compare(args, records):
+    chats = sorted({chat_id for chat_id, _, _ in records})
+    lookups = [random.choice(chats) for _ in range(args.lookups)]
+
+    store, view = memory_view()
+    started = time.perf_counter()
+    for chat_id, game, win in records:
+        old_record(view, chat_id, game, win)
+    old_write = time.perf_counter() - started
+    started = time.perf_counter()
+    for chat_id in lookups:
+        old_render(view, chat_id)
+    old_stats = time.perf_counter() - started
+    started = time.perf_counter()
+    for game in GAMES:
+        old_top(store, game, args.top)
+    old_board = (time.perf_counter() - started) / len(GAMES)
+
+    store, view = memory_view()
+    stats = tg.GameStats(view, store.view("stats_totals"), "", 3600, args.top, args.chats)
+    started = time.perf_counter()
+    for chat_id, game, win in records:
+        stats.record(chat_id, game, win, chat_id)
+    new_write = time.perf_counter() - started
+    started = time.perf_counter()
+    for chat_id in lookups:
+        stats.chat_text(chat_id)
+    new_first = time.perf_counter() - started
+    started = time.perf_counter()
+    for chat_id in lookups:
+        stats.chat_text(chat_id)
+    new_cached = time.perf_counter() - started
+    stats.top_rendered = (None, None)
+    started = time.perf_counter()
+    stats.top_text()
+    new_board = time.perf_counter() - started
+
+    print(f"{'':<28}{'old':>12}{'GameStats':>14}")
+    print(f"{'record':<28}{per_op(old_write, len(records)):>12}{per_op(new_write, len(records)):>14}")
+    print(f"{'/stats first render':<28}{per_op(old_stats, len(lookups)):>12}{per_op(new_first, len(lookups)):>14}")
+    print(f"{'/stats cached':<28}{'':>12}{per_op(new_cached, len(lookups)):>14}")
+    print(f"{'leaderboard, one game':<28}{old_board * 1000:9.2f} ms{new_board * 1000:11.2f} ms  (all games, rendered)")
+
+
+async def persistence(args, records, tmp):
+    store = tg.SQLiteStateStore(os.path.join(tmp, "state.sqlite3"))
+    stats = tg.GameStats(store.view("stats"), store.view("stats_totals"), "", 3600, args.top, args.chats)
+    started = time.perf_counter()
+    for chat_id, game, win in records[:args.sqlite_records]:
+        stats.record(chat_id, game, win, chat_id)
+    sqlite_write = time.perf_counter() - started
+    store.close()
+
+    store, view = memory_view()
+    stats = tg.GameStats(view, store.view("stats_totals"), os.path.join(tmp, "stats.json"), 3600, args.top, args.chats)
+    for chat_id, game, win in records:
+        stats.record(chat_id, game, win, chat_id)
+
+    stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await stats.save()
+    done = True
+    await task
+    store, view = memory_view()
+    fresh = tg.GameStats(view, store.view("stats_totals"), stats.path, 3600, args.top, args.chats)
+    fresh.load()
+    print(f"sqlite: record {per_op(sqlite_write, args.sqlite_records).strip()}")
+    print(f"memory: snapshot of {len(store.scan('stats'))} chats {stats.snapshot_ms:.0f} ms in a thread, "
+          f"longest event loop pause {stall * 1000:.1f} ms; load at start {fresh.load_ms:.0f} ms")
+
+
+def main(args):
+    records = make_records(args)
+    asyncio.run(compare(args, records))
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(persistence(args, records, tmp))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--records", type=int, default=500000)
+    parser.add_argument("--sqlite-records", type=int, default=200000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,55 @@
+"""Запросов в секунду к заглушке Telegram: новый клиент на вызов против общего пула.
+
+    python -m bench.http_client [--requests 2000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from api import telegram as tg
+from bench.fake_servers import ServerThread, fake_telegram
+
+
+async def send_fresh_client(chat_id, text):
+    # Поведение до общего пула: новый AsyncClient на каждый вызов.
+    async with httpx.AsyncClient() as client:
+        await client.post(
+            f"{tg.TELEGRAM_API_BASE}/bot{tg.TELEGRAM_BOT_TOKEN}/sendMessage",
+            json={"chat_id": str(chat_id), "text": text},
+        )
+
+
+async def measure(send, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with sem:
+            await send(i, "ping")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def main(total, concurrency):
+    before = await measure(send_fresh_client, total, concurrency)
+    await tg.open_http_clients()
+    try:
+        after = await measure(tg.send_message, total, concurrency)
+    finally:
+        await tg.close_http_clients()
+    print(f"fresh client per call: {before:8.1f} req/s")
+    print(f"shared pooled client:  {after:8.1f} req/s  (x{after / before:.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=18081)
+    args = parser.parse_args()
+    with ServerThread(fake_telegram, args.port) as server:
+        tg.TELEGRAM_API_BASE = server.url
+        asyncio.run(main(args.requests, args.concurrency))
@@ -0,0 +1,98 @@
+"""Хвост задержки ask_gpt при сбоях OpenRouter: без защиты, с повторами, с дублированием, с запасной моделью.
+
+    python -m bench.llm_client [--requests 400] [--errors 0.05] [--tail 0.05] [--tail-latency 2]
+
+Заглушка OpenRouter отвечает за --latency секунд, доля --tail ответов
+задерживается на --tail-latency, доля --errors отвечает 503. В сценарии
+fallback основная модель всегда отвечает 503.
+"""
+import argparse
+import asyncio
+import time
+
+from api import telegram as tg
+from bench import fake_servers
+from bench.fake_servers import ServerThread, fake_openrouter
+
+PRIMARY = "bench/primary"
+FALLBACK = "bench/fallback"
+
+SCENARIOS = {
+    "baseline": {"retries": 0, "hedge": False, "models": [PRIMARY]},
+    "retries": {"retries": 2, "hedge": False, "models": [PRIMARY]},
+    "retries+hedge": {"retries": 2, "hedge": True, "models": [PRIMARY]},
+    "fallback": {"retries": 2, "hedge": False, "models": [PRIMARY, FALLBACK], "down": PRIMARY},
+}
+
+
+def make_client(scenario, args):
+    return tg.LLMClient(
+        models=scenario["models"],
+        deadline=args.deadline,
+        retries=scenario["retries"],
+        backoff_base=0.05,
+        backoff_max=0.5,
+        hedge=scenario["hedge"],
+        hedge_percentile=95,
+        hedge_min_samples=20,
+        breaker_failures=5,
+        breaker_cooldown=30,
+    )
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+async def run(args):
+    sem = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        async with sem:
+            started = time.perf_counter()
+            reply = await tg.ask_gpt(f"Вопрос {i}")
+            latencies.append(time.perf_counter() - started)
+            failures += reply.startswith("Ошибка")
+
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    await tg.close_http_clients()
+    return latencies, failures
+
+
+def main(args):
+    tg.OPENROUTER_API_KEY = tg.OPENROUTER_API_KEY or "bench"
+    with ServerThread(fake_openrouter, args.port) as openrouter:
+        tg.OPENROUTER_API_BASE = openrouter.url + "/api/v1"
+        print(f"{'scenario':<15}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}{'calls/req':>11}")
+        for name, scenario in SCENARIOS.items():
+            fake_servers.openrouter_config.__init__(
+                latency=args.latency, jitter=args.latency / 2, error_rate=args.errors,
+                tail_rate=args.tail, tail_latency=args.tail_latency,
+            )
+            fake_servers.openrouter_model_status.clear()
+            if scenario.get("down"):
+                fake_servers.openrouter_model_status[scenario["down"]] = 503
+            fake_servers.reset()
+            tg.llm_client = make_client(scenario, args)
+            tg.llm_limiter = tg.LLMLimiter(args.concurrency, args.requests)
+            latencies, failures = asyncio.run(run(args))
+            calls = sum(fake_servers.openrouter_calls.values()) / args.requests
+            print(f"{name:<15}{percentile(latencies, 50) * 1000:9.0f}{percentile(latencies, 95) * 1000:9.0f}"
+                  f"{percentile(latencies, 99) * 1000:9.0f}{failures / args.requests:8.1%}{calls:11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--errors", type=float, default=0.05)
+    parser.add_argument("--tail", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=2)
+    parser.add_argument("--deadline", type=float, default=10)
+    parser.add_argument("--port", type=int, default=18291)
+    main(parser.parse_args())
@@ -0,0 +1,281 @@
+"""Нагрузочный прогон бота целиком: webhook под uvicorn, заглушки Telegram и OpenRouter.
+
+    python -m bench.load [--updates 2000] [--concurrency 32] [--mix ai=3,quiz=2,game=2,contact=1,callback=1,menu=1]
+                         [--tg-latency 0.02] [--tg-errors 0.01] [--tg-429 0.01]
+                         [--llm-latency 0.3] [--llm-errors 0.02] [--llm-429 0.01]
+                         [--llm-drift prose=0.1,text=0.05,garbage=0.02] [--json out.json]
+
+Каждый синтетический чат проходит сценарий (диалог с ИИ, тест, игра, контакт,
+нажатие inline-кнопки, меню) и шлёт свои апдейты по очереди, как Telegram;
+разные чаты идут параллельно, не больше --concurrency запросов сразу.
+Отчёт: p50/p95/p99 задержки webhook, апдейтов в секунду, исходящих вызовов
+на апдейт по методам и RSS процесса (заглушки работают в том же процессе).
+
+Лимиты планировщика по умолчанию сняты, чтобы мерить сам бот, а не 1 сообщение/с
+на чат (--real-limits — оставить). Остальное настраивается переменными окружения
+бота как обычно: INGEST_MODE, AI_STREAMING, CONTENT_POOL_DEPTH, LLM_CACHE_POLICY...
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import time
+
+import httpx
+
+from api import telegram as tg
+from bench import fake_servers
+from bench.fake_servers import ServerThread, fake_openrouter, fake_telegram
+
+SCENARIOS = {
+    "ai": ["🤖 ИИ-помощник", "Привет! Как дела?", "Расскажи что-нибудь интересное", "Назад"],
+    "quiz": ["/start", "История", "B"],
+    "game": ["Игры 🎲", "{game}", "{answer}"],
+    "contact": ["/contact", "<contact>"],
+    "callback": ["<callback:/stats>", "<callback:Игры 🎲>"],
+    "menu": ["/start", "/stats", "Назад"],
+}
+GAME_ANSWERS = {"Угадай слово": "кот", "Найди ложь": "2", "Продолжи историю": "1", "Шарада": "Соля"}
+DEFAULT_MIX = "ai=3,quiz=2,game=2,contact=1,callback=1,menu=1"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"неизвестный сценарий {name!r}: {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def make(self, chat_id, step):
+        self.update_id += 1
+        self.message_id += 1
+        user = {"id": chat_id, "is_bot": False, "first_name": "Нагрузка"}
+        chat = {"id": chat_id, "type": "private", "first_name": "Нагрузка"}
+        message = {"message_id": self.message_id, "from": user, "chat": chat, "date": 1760700000}
+        if step.startswith("<callback:"):
+            data = step[len("<callback:"):-1]
+            return {"update_id": self.update_id, "callback_query": {
+                "id": str(self.update_id), "from": user, "message": message, "chat_instance": "1", "data": data,
+            }}
+        if step == "<contact>":
+            message["contact"] = {"phone_number": "79990000000", "first_name": "Нагрузка", "user_id": chat_id}
+        else:
+            message["text"] = step
+        return {"update_id": self.update_id, "message": message}
+
+
+def make_chats(total, mix, seed):
+    """Сценарии чатов, пока суммарно не наберётся total апдейтов."""
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    factory = UpdateFactory()
+    chats = []
+    count = 0
+    while count < total:
+        chat_id = 100000 + len(chats)
+        scenario = rng.choices(names, weights)[0]
+        game = rng.choice(list(GAME_ANSWERS))
+        steps = [s.format(game=game, answer=GAME_ANSWERS[game]) for s in SCENARIOS[scenario]]
+        steps = steps[:total - count]
+        chats.append((scenario, [factory.make(chat_id, step) for step in steps]))
+        count += len(steps)
+    return chats
+
+
+def configure_bot(args, telegram_url, openrouter_url):
+    tg.TELEGRAM_API_BASE = telegram_url
+    tg.OPENROUTER_API_BASE = openrouter_url + "/api/v1"
+    tg.OPENROUTER_API_KEY = tg.OPENROUTER_API_KEY or "bench"
+    tg.TELEGRAM_BOT_TOKEN = tg.TELEGRAM_BOT_TOKEN or "bench"
+    tg.OWNER_ID = "" if args.no_owner else "1"
+    if not args.real_limits:
+        tg.outbound.chat_rate = tg.outbound.chat_burst = 1e9
+        tg.outbound.global_bucket = tg.TokenBucket(1e9, 1e9)
+
+
+def parse_shares(text):
+    shares = {}
+    for part in filter(None, text.split(",")):
+        name, _, share = part.partition("=")
+        if name not in fake_servers.openrouter_drift:
+            raise SystemExit(f"неизвестный вид отклонения {name!r}: {', '.join(fake_servers.openrouter_drift)}")
+        shares[name] = float(share)
+    return shares
+
+
+def configure_stubs(args):
+    fake_servers.telegram_config.__init__(
+        latency=args.tg_latency, jitter=args.tg_latency / 2,
+        error_rate=args.tg_errors, rate_limit_rate=args.tg_429, retry_after=args.retry_after,
+    )
+    fake_servers.openrouter_config.__init__(
+        latency=args.llm_latency, jitter=args.llm_latency / 2,
+        error_rate=args.llm_errors, rate_limit_rate=args.llm_429, retry_after=args.retry_after,
+    )
+    for kind, share in parse_shares(args.llm_drift).items():
+        fake_servers.openrouter_drift[kind] = share
+    fake_servers.reset()
+
+
+async def replay(url, chats, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        async def run_chat(updates):
+            # Telegram не шлёт следующий апдейт чата, пока не подтверждён предыдущий
+            for update in updates:
+                body = json.dumps(update, ensure_ascii=False).encode()
+                async with sem:
+                    started = time.perf_counter()
+                    res = await client.post("/api/telegram", content=body,
+                                            headers={"content-type": "application/json"})
+                    latencies.append(time.perf_counter() - started)
+                statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_chat(updates) for _, updates in chats))
+        return latencies, statuses, time.perf_counter() - started
+
+
+def bot_idle():
+    return (not tg.outbound.queues and not tg.outbound.in_flight
+            and not tg.update_queue.depth and not tg.generation_guard.in_flight)
+
+
+def wait_idle(timeout):
+    # Бот в своём потоке: ждём, пока разойдутся очереди исходящих и апдейтов
+    deadline = time.monotonic() + timeout
+    while not bot_idle() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def rss_mb():
+    current = 0.0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux: КБ
+    return round(current, 1), round(max(current, peak), 1)
+
+
+def report(args, chats, latencies, statuses, elapsed, drained, rss_before):
+    updates = sum(len(u) for _, u in chats)
+    telegram = {}
+    for (method, code), count in sorted(fake_servers.telegram_responses.items()):
+        telegram.setdefault(method, {})[str(code)] = count
+    telegram_total = sum(fake_servers.telegram_responses.values())
+    llm_total = sum(fake_servers.openrouter_calls.values())
+    scenarios = {}
+    for name, _ in chats:
+        scenarios[name] = scenarios.get(name, 0) + 1
+    rss_now, rss_peak = rss_mb()
+    content = tg.content_pool.snapshot()
+    return {
+        "updates": updates,
+        "chats": len(chats),
+        "scenarios": scenarios,
+        "concurrency": args.concurrency,
+        "ingest_mode": tg.INGEST_MODE,
+        "webhook_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies, default=0) * 1000, 2),
+        },
+        "webhook_status": statuses,
+        "updates_per_sec": round(updates / elapsed, 1),
+        "drain_sec": round(drained, 2),
+        "outbound_per_update": {
+            "telegram": round(telegram_total / updates, 3),
+            "openrouter": round(llm_total / updates, 3),
+        },
+        "telegram_calls": telegram,
+        "openrouter_calls": {f"{'stream' if s else 'complete'}:{c}": n
+                             for (s, c), n in sorted(fake_servers.openrouter_calls.items())},
+        "content": {key: content[key] for key in ("generations", "parse_failure_rate", "wasted_per_item")},
+        "rss_mb": {"before": rss_before, "after": rss_now, "peak": rss_peak},
+    }
+
+
+def print_report(result):
+    print(f"updates: {result['updates']}  chats: {result['chats']}  mode: {result['ingest_mode']}  "
+          f"concurrency: {result['concurrency']}")
+    print("scenarios:", ", ".join(f"{k}={v}" for k, v in result["scenarios"].items()))
+    ms = result["webhook_ms"]
+    print(f"webhook latency ms: p50 {ms['p50']}  p95 {ms['p95']}  p99 {ms['p99']}  max {ms['max']}")
+    print(f"webhook status: {result['webhook_status']}")
+    print(f"throughput: {result['updates_per_sec']} updates/s  (outbound drained in {result['drain_sec']} s)")
+    per = result["outbound_per_update"]
+    print(f"outbound calls per update: telegram {per['telegram']}  openrouter {per['openrouter']}")
+    for method, codes in result["telegram_calls"].items():
+        print(f"  {method}: {codes}")
+    print(f"  openrouter: {result['openrouter_calls']}")
+    content = result["content"]
+    print(f"content: {content['generations']} generations, parse failures {content['parse_failure_rate']:.1%}, "
+          f"wasted per item {content['wasted_per_item']}")
+    rss = result["rss_mb"]
+    print(f"RSS MB (process incl. stubs): before {rss['before']}  after {rss['after']}  peak {rss['peak']}")
+
+
+def main(args):
+    configure_stubs(args)
+    chats = make_chats(args.updates, parse_mix(args.mix), args.seed)
+    with ServerThread(fake_telegram, args.port) as telegram, \
+            ServerThread(fake_openrouter, args.port + 1) as openrouter:
+        configure_bot(args, telegram.url, openrouter.url)
+        with ServerThread(tg.app, args.port + 2) as bot:
+            rss_before = rss_mb()[0]
+            latencies, statuses, elapsed = asyncio.run(replay(bot.url, chats, args.concurrency))
+            started = time.perf_counter()
+            wait_idle(args.drain_timeout)
+            drained = time.perf_counter() - started
+    result = report(args, chats, latencies, statuses, elapsed, drained, rss_before)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--tg-errors", type=float, default=0.0)
+    parser.add_argument("--tg-429", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-errors", type=float, default=0.0)
+    parser.add_argument("--llm-429", type=float, default=0.0)
+    parser.add_argument("--llm-drift", default="")
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--real-limits", action="store_true")
+    parser.add_argument("--no-owner", action="store_true")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--port", type=int, default=18191)
+    parser.add_argument("--json")
+    main(parser.parse_args())
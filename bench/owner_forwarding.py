@@ -0,0 +1,96 @@
+"""Исходящие вызовы в чат владельца при разных OWNER_FORWARD_MODE.
+
+    python -m bench.owner_forwarding [--updates 2000] [--mix ai=3,quiz=2,game=2,contact=1,callback=1,menu=1]
+
+Прогоняет тот же синтетический поток, что и bench.load, через handle_update
+в одном процессе (Telegram и OpenRouter — httpx.MockTransport) и считает
+sendMessage в чат владельца и их объём. Лимиты планировщика сняты, поэтому
+в full склеиваются только пересылки, оказавшиеся в очереди одновременно;
+под настоящим лимитом 1 сообщение/с склеек больше, но и задержка копится.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+
+import httpx
+
+from api import telegram as tg
+from bench import fake_servers
+from bench.load import DEFAULT_MIX, make_chats, parse_mix
+
+OWNER = "1"
+MODES = ["full", "compact", "digest", "off"]
+
+
+def telegram_transport(calls):
+    def handler(request):
+        method = request.url.path.rsplit("/", 1)[-1]
+        body = json.loads(request.content)
+        calls.append((method, str(body.get("chat_id")), len(request.content)))
+        return httpx.Response(200, json={"ok": True, "result": {"message_id": len(calls)}})
+    return httpx.MockTransport(handler)
+
+
+def openrouter_transport():
+    def handler(request):
+        body = json.loads(request.content)
+        reply = fake_servers.canned_reply(body.get("messages") or [])
+        return httpx.Response(200, json={"choices": [{"message": {"content": reply}}]})
+    return httpx.MockTransport(handler)
+
+
+async def run(mode, chats, archive_path):
+    tg.OWNER_FORWARD_MODE = mode
+    tg.update_archive.path = archive_path
+    calls = []
+    tg.http_clients["telegram"] = httpx.AsyncClient(transport=telegram_transport(calls))
+    tg.http_clients["openrouter"] = httpx.AsyncClient(transport=openrouter_transport())
+
+    async def run_chat(updates):
+        for update in updates:
+            await tg.handle_update(tg.ParsedUpdate(update))
+
+    await asyncio.gather(*(run_chat(updates) for _, updates in chats))
+    await tg.owner_digest.stop()
+    await tg.update_archive.stop()
+    await tg.outbound.stop()
+    await tg.close_http_clients()
+    return calls
+
+
+async def run_all(chats, tmp):
+    # Один event loop на все режимы: семафоры бота привязываются к нему
+    return {mode: await run(mode, chats, os.path.join(tmp, f"{mode}.jsonl")) for mode in MODES}
+
+
+def main(args):
+    tg.OWNER_ID = OWNER
+    tg.OPENROUTER_API_KEY = "bench"
+    tg.AI_STREAMING = False
+    tg.content_pool.depth = 0
+    tg.outbound.chat_rate = tg.outbound.chat_burst = 1e9
+    tg.outbound.global_bucket = tg.TokenBucket(1e9, 1e9)
+    chats = make_chats(args.updates, parse_mix(args.mix), args.seed)
+    updates = sum(len(u) for _, u in chats)
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'mode':<10}{'owner msgs':>11}{'owner KB':>10}{'per update':>12}{'all calls/upd':>15}{'reduction':>11}")
+        for mode, calls in asyncio.run(run_all(chats, tmp)).items():
+            owner = [c for c in calls if c[0] == "sendMessage" and c[1] == OWNER]
+            if baseline is None:
+                baseline = len(owner)
+            reduction = 1 - len(owner) / baseline if baseline else 0.0
+            print(f"{mode:<10}{len(owner):>11}{sum(c[2] for c in owner) / 1024:>10.1f}"
+                  f"{len(owner) / updates:>12.3f}{len(calls) / updates:>15.3f}{reduction:>11.1%}")
+        archived = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+        print(f"archive: {archived / 1024:.1f} KB for {updates * len(MODES)} updates")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
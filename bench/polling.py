@@ -0,0 +1,90 @@
+"""Апдейтов в секунду: webhook через uvicorn против long polling getUpdates.
+
+    python -m bench.polling [--updates 2000] [--chats 200]
+
+Оба режима обрабатывают одинаковый набор апдейтов без обращений к LLM;
+исходящие sendMessage уходят в заглушку Telegram, лимиты планировщика сняты.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from api import telegram as tg
+from bench import fake_servers
+from bench.fake_servers import ServerThread, fake_telegram
+
+TEXTS = ["/start", "/stats", "Игры 🎲", "Назад", "привет"]
+
+
+def make_updates(count, chats, first_id):
+    return [
+        {
+            "update_id": first_id + i,
+            "message": {
+                "message_id": i,
+                "from": {"id": 1000 + i % chats, "first_name": "Бот-тест"},
+                "chat": {"id": 1000 + i % chats, "type": "private"},
+                "date": 1760700000,
+                "text": TEXTS[i % len(TEXTS)],
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def unthrottle():
+    tg.OWNER_ID = ""
+    tg.outbound.chat_rate = tg.outbound.chat_burst = 1e9
+    tg.outbound.global_bucket = tg.TokenBucket(1e9, 1e9)
+
+
+async def bench_webhook(url, updates, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(update):
+            async with sem:
+                res = await client.post("/api/telegram", content=json.dumps(update))
+                res.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        return len(updates) / (time.perf_counter() - started)
+
+
+async def bench_polling(updates):
+    tg.update_queue = tg.UpdateQueue(tg.handle_update, tg.UPDATE_WORKERS, tg.UPDATE_QUEUE_MAX)
+    fake_servers.pending_updates[:] = updates
+    started = time.perf_counter()
+    poller = asyncio.create_task(tg.poll_updates())
+    while tg.update_queue.processed + tg.update_queue.failed < len(updates):
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    poller.cancel()
+    await tg.update_queue.stop()
+    await asyncio.gather(poller, return_exceptions=True)
+    await tg.outbound.stop()
+    return len(updates) / elapsed
+
+
+def main(args):
+    unthrottle()
+    with ServerThread(fake_telegram, args.port) as telegram:
+        tg.TELEGRAM_API_BASE = telegram.url
+        with ServerThread(tg.app, args.port + 1) as bot:
+            webhook = asyncio.run(bench_webhook(bot.url, make_updates(args.updates, args.chats, 1), args.concurrency))
+        tg.http_clients.clear()
+        polling = asyncio.run(bench_polling(make_updates(args.updates, args.chats, 10_000_000)))
+    print(f"webhook (uvicorn, concurrency {args.concurrency}): {webhook:8.1f} updates/s")
+    print(f"long polling (limit {tg.POLLING_LIMIT}):          {polling:8.1f} updates/s  (x{polling / webhook:.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--port", type=int, default=18091)
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+"""Стоимость выбора обработчика на апдейт: таблица команд против прежней цепочки if.
+
+    python -m bench.router [--updates 200000]
+"""
+import argparse
+import random
+import time
+
+from api import telegram as tg
+
+TEXTS = [
+    "/start", "Назад", "/stats", "Игры 🎲", "История", "Шарада", "A", "B", "1",
+    "КОТ", "Привет", "Как дела?", "/feedback", "/ai", "Закончить диалог",
+]
+SESSIONS = [{}, {"correctAnswer": "B"}, {"game": "Шарада", "answer": "КОТ"}, {"firstName": "Ира"}]
+
+
+def legacy_route(chat_id, text, session):
+    # Прежний порядок проверок, включая пересборку словаря промптов игр на каждый апдейт
+    if text == "/ai" or text == "🤖 ИИ-помощник":
+        return "ai"
+    if chat_id in tg.ai_chat_sessions and text not in ["/stop", "Закончить диалог", "Назад"]:
+        return "ai_reply"
+    if text in ["/stop", "Закончить диалог"] and chat_id in tg.ai_chat_sessions:
+        return "ai_stop"
+    if text == "/contact":
+        return "contact"
+    if text == "/feedback":
+        return "feedback"
+    if tg.feedback_sessions.get(chat_id):
+        return "feedback_capture"
+    if text in ["/start"]:
+        return "start"
+    if text in ["Назад"]:
+        return "back"
+    if text == "/stats":
+        return "stats"
+    if text == "Игры 🎲":
+        return "games"
+    if text in ["История", "Математика", "Английский"]:
+        return "quiz"
+    if session.get("correctAnswer"):
+        return "quiz_answer"
+    games_prompts = {name: spec["prompt"] for name, spec in tg.GAMES.items()}
+    if text in games_prompts:
+        return "game"
+    if session.get("game"):
+        return "game_answer"
+    return "fallback"
+
+
+def measure(name, route, updates):
+    started = time.perf_counter()
+    for chat_id, text, session in updates:
+        route(chat_id, text, session)
+    per_update = (time.perf_counter() - started) / len(updates) * 1e6
+    print(f"{name:<12} {per_update:6.3f} µs/update")
+    return per_update
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=200000)
+    parser.add_argument("--chats", type=int, default=500)
+    args = parser.parse_args()
+    rnd = random.Random(42)
+    for i in range(0, args.chats, 10):
+        tg.ai_chat_sessions[str(i)] = []
+    for i in range(5, args.chats, 20):
+        tg.feedback_sessions[str(i)] = True
+    updates = [
+        (str(rnd.randrange(args.chats)), rnd.choice(TEXTS), rnd.choice(SESSIONS))
+        for _ in range(args.updates)
+    ]
+    legacy = measure("if-chain", legacy_route, updates)
+    table = measure("router", tg.route, updates)
+    print(f"speedup      x{legacy / table:.2f}")
@@ -0,0 +1,135 @@
+"""Апдейтов в секунду: один процесс (INGEST_MODE=queue) против N процессов (INGEST_MODE=sharded).
+
+    python -m bench.sharding [--updates 4000] [--chats 400] [--shards 1,2,4]
+
+Бот и заглушка Telegram запускаются отдельными процессами uvicorn, чтобы
+нагрузка и заглушка не делили ядро с ботом. Время — от первого POST до
+момента, когда все апдейты обработаны (по счётчикам /api/telegram/queue).
+Исходящие лимиты сняты, LLM не вызывается; владелец включён, так что
+пересылка JSON владельцу тоже входит в работу на апдейт. Масштабирование
+упирается в число ядер: на одном ядре шарды ничего не дают.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+TEXTS = ["/start", "/stats", "Игры 🎲", "Назад", "привет"]
+
+
+def make_updates(count, chats):
+    return [
+        json.dumps({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i,
+                "from": {"id": 1000 + i % chats, "first_name": "Бот-тест"},
+                "chat": {"id": 1000 + i % chats, "type": "private"},
+                "date": 1760700000,
+                "text": TEXTS[i % len(TEXTS)],
+            },
+        }, ensure_ascii=False).encode()
+        for i in range(count)
+    ]
+
+
+def uvicorn(app, port, env=None, workers=1):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env={**os.environ, **(env or {})},
+    )
+
+
+def processed(stats):
+    if stats["mode"] == "sharded":
+        return stats["shards"]["processed"], stats["shards"]["alive"]
+    return stats["processed"] + stats["failed"], 1
+
+
+async def wait_ready(client, workers):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            res = await client.get("/api/telegram/queue")
+            if res.status_code == 200 and processed(res.json())[1] >= workers:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("бот не поднялся")
+
+
+async def run(url, updates, concurrency, workers):
+    async with httpx.AsyncClient(base_url=url, timeout=60,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        await wait_ready(client, workers)
+        sem = asyncio.Semaphore(concurrency)
+
+        async def post(body):
+            async with sem:
+                while True:
+                    res = await client.post("/api/telegram", content=body,
+                                            headers={"content-type": "application/json"})
+                    if res.status_code != 503:
+                        return
+                    await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in updates))
+        while processed((await client.get("/api/telegram/queue")).json())[0] < len(updates):
+            await asyncio.sleep(0.02)
+        return len(updates) / (time.perf_counter() - started)
+
+
+def measure(args, mode, workers, stub_url):
+    env = {
+        "INGEST_MODE": mode,
+        "SHARD_WORKERS": str(workers),
+        "TELEGRAM_API_BASE": stub_url,
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "MY_TELEGRAM_ID": "1",
+        "OPENROUTER_API_KEY": "",
+        "CONTENT_POOL_DEPTH": "0",
+        "OUTBOUND_CHAT_RATE": "1000000",
+        "OUTBOUND_CHAT_BURST": "1000000",
+        "OUTBOUND_GLOBAL_RATE": "1000000",
+        "OUTBOUND_GLOBAL_BURST": "1000000",
+    }
+    bot = uvicorn("api.telegram:app", args.port + 1, env)
+    try:
+        return asyncio.run(run(f"http://127.0.0.1:{args.port + 1}", make_updates(args.updates, args.chats),
+                               args.concurrency, workers))
+    finally:
+        bot.terminate()
+        bot.wait()
+
+
+def main(args):
+    print(f"cpu cores: {os.cpu_count()}")
+    stub = uvicorn("bench.fake_servers:fake_telegram", args.port, workers=args.stub_workers)
+    stub_url = f"http://127.0.0.1:{args.port}"
+    try:
+        baseline = measure(args, "queue", 1, stub_url)
+        print(f"single process (queue):   {baseline:8.1f} updates/s")
+        for workers in map(int, args.shards.split(",")):
+            rate = measure(args, "sharded", workers, stub_url)
+            print(f"sharded, {workers} worker(s):     {rate:8.1f} updates/s  (x{rate / baseline:.2f})")
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--chats", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--shards", default="1,2,4")
+    parser.add_argument("--stub-workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=18391)
+    main(parser.parse_args())
@@ -0,0 +1,55 @@
+"""Операций в секунду для бэкендов хранилища состояния.
+
+    python -m bench.state_store [--ops 20000] [--chats 1000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from api import telegram as tg
+
+
+def bump(user_stats):
+    s = user_stats.get("Тест", {"played": 0, "wins": 0})
+    return {**user_stats, "Тест": {"played": s["played"] + 1, "wins": s["wins"]}}
+
+
+def measure(name, fn, ops):
+    started = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(f"  {name:<22} {ops / elapsed:>12,.0f} ops/s")
+
+
+def run(store, ops, chats):
+    sessions = store.view("sessions")
+    stats = store.view("stats")
+
+    def write(i):
+        sessions[str(i % chats)] = {"game": "Шарада", "answer": str(i)}
+
+    def write_flush(i):
+        write(i)
+        store.flush()
+
+    measure("set (batched)", write, ops)
+    store.flush()
+    measure("set + flush", write_flush, ops // 10)
+    measure("get (hot cache)", lambda i: sessions.get(str(i % chats)), ops)
+    measure("get (miss)", lambda i: sessions.get(f"none-{i}"), ops)
+    measure("update (atomic)", lambda i: stats.update(str(i % chats), bump, {}), ops // 10)
+    store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=1000)
+    args = parser.parse_args()
+    print("memory")
+    run(tg.MemoryStateStore(), args.ops, args.chats)
+    with tempfile.TemporaryDirectory() as tmp:
+        print("sqlite (WAL)")
+        run(tg.SQLiteStateStore(os.path.join(tmp, "state.sqlite3"), tg.STATE_BATCH_SIZE), args.ops, args.chats)
@@ -0,0 +1,85 @@
+"""Разбор апдейта и подготовка пересылки владельцу: прежний путь против ParsedUpdate.
+
+    python -m bench.update_parsing [--rounds 2000]
+
+Корпус — bench/updates.jsonl, по апдейту на строку.
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from api import telegram as tg
+
+CORPUS = os.path.join(os.path.dirname(__file__), "updates.jsonl")
+
+
+def legacy(raw):
+    # Прежний telegram_webhook: json.loads, цепочки .get() и json.dumps(indent=2)
+    update = json.loads(raw)
+    from_id = str(
+        update.get("message", {}).get("from", {}).get("id") or
+        update.get("edited_message", {}).get("from", {}).get("id") or
+        update.get("callback_query", {}).get("from", {}).get("id") or
+        update.get("inline_query", {}).get("from", {}).get("id") or ""
+    )
+    msg_text = (
+        update.get("message", {}).get("text") or
+        update.get("edited_message", {}).get("text") or
+        update.get("callback_query", {}).get("data") or
+        update.get("inline_query", {}).get("query") or ""
+    )
+    forwarded = json.dumps(update, ensure_ascii=False, indent=2)
+    chat_id = (
+        update.get("message", {}).get("chat", {}).get("id") or
+        update.get("edited_message", {}).get("chat", {}).get("id") or
+        update.get("callback_query", {}).get("message", {}).get("chat", {}).get("id")
+    )
+    first_name = (
+        update.get("message", {}).get("from", {}).get("first_name") or
+        update.get("edited_message", {}).get("from", {}).get("first_name") or
+        update.get("callback_query", {}).get("from", {}).get("first_name") or
+        ""
+    )
+    contact = update.get("message", {}).get("contact")
+    return from_id, msg_text, chat_id, first_name, contact, forwarded
+
+
+def fast(raw):
+    update = tg.ParsedUpdate.from_bytes(raw)
+    return update.from_id, update.text, update.chat_id, update.first_name, update.contact, update.json()
+
+
+def measure(name, fn, corpus, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for raw in corpus:
+            fn(raw)
+    per_update = (time.perf_counter() - started) / (rounds * len(corpus)) * 1e6
+
+    tracemalloc.start()
+    peaks = []
+    for raw in corpus:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn(raw)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    print(f"{name:<28} {per_update:7.2f} µs/update   peak alloc {sum(peaks) / len(peaks):8.0f} B/update")
+    return per_update
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+    with open(CORPUS, "rb") as f:
+        corpus = [line.strip() for line in f if line.strip()]
+    for raw in corpus:
+        old, new = legacy(raw), fast(raw)
+        assert (old[0], old[1], str(old[2]) if old[2] else None, old[3], old[4]) == new[:5], raw
+    print(f"{len(corpus)} updates, orjson: {'yes' if tg.orjson else 'no'}")
+    before = measure("json.loads + .get chains", legacy, corpus, args.rounds)
+    after = measure("ParsedUpdate", fast, corpus, args.rounds)
+    print(f"speedup x{before / after:.2f}")
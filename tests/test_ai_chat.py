@@ -0,0 +1,41 @@
+import asyncio
+
+from api import telegram as tg
+
+
+def reply(monkeypatch, during):
+    sent = []
+
+    async def ask_gpt(prompt, chat_history=None, **kwargs):
+        await asyncio.sleep(0)
+        during()
+        return "ответ"
+
+    async def telegram_api(method, payload, timeout=None):
+        return {"ok": True}
+
+    async def send_message(chat_id, text, reply_markup=None, parse_mode="Markdown"):
+        sent.append(text)
+
+    monkeypatch.setattr(tg, "AI_STREAMING", False)
+    monkeypatch.setattr(tg, "ask_gpt", ask_gpt)
+    monkeypatch.setattr(tg, "telegram_api", telegram_api)
+    monkeypatch.setattr(tg, "send_message", send_message)
+    asyncio.run(tg.ai_chat_reply("chat-ai", "вопрос", "Имя", {}))
+    return sent
+
+
+def test_reply_appends_turn(monkeypatch):
+    tg.ai_chat_sessions["chat-ai"] = []
+    sent = reply(monkeypatch, lambda: None)
+    assert sent == ["ответ"]
+    assert tg.ai_chat_sessions.pop("chat-ai") == [
+        {"role": "user", "content": "вопрос"},
+        {"role": "assistant", "content": "ответ"},
+    ]
+
+
+def test_stop_during_reply_is_not_undone(monkeypatch):
+    tg.ai_chat_sessions["chat-ai"] = []
+    reply(monkeypatch, lambda: tg.ai_chat_sessions.pop("chat-ai"))
+    assert "chat-ai" not in tg.ai_chat_sessions
@@ -0,0 +1,29 @@
+import pytest
+
+from api import telegram as tg
+
+ANSWER = {"type": "string", "enum": ["A", "B", "C", "D"]}
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("B", "B"),
+    ("b) 4", "B"),
+    ("(C)", "C"),
+    ("Answer: C", "C"),
+    ("Ответ: C", "C"),
+    ("Правильный ответ — D", "D"),
+    ("Вариант ответа: B", "B"),
+    ("Answer is C", "C"),
+])
+def test_enum_accepts_an_isolated_choice(value, expected):
+    assert tg.conform(ANSWER, value) == expected
+
+
+@pytest.mark.parametrize("value", ["ABOUT", "Cat", "A или C", "C, потому что A неверно", "", "в"])
+def test_enum_rejects_missing_or_ambiguous_choice(value):
+    assert tg.conform(ANSWER, value) is None
+
+
+def test_quiz_schema_keeps_answer_letter():
+    schema = tg.object_schema(question={"type": "string"}, answer=ANSWER)
+    assert tg.conform(schema, {"Question": "2+2?", "ANSWER": "Answer: C"}) == {"question": "2+2?", "answer": "C"}
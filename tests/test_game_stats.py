@@ -0,0 +1,98 @@
+import asyncio
+import random
+
+from api import telegram as tg
+
+GAMES = ["Тест", "Шарада", "Найди ложь"]
+
+
+def memory_stats(path="", store=None):
+    store = store or tg.MemoryStateStore({})
+    return store, tg.GameStats(store.view("stats"), store.view("stats_totals"), path, 60, 3, 100)
+
+
+def play(stats, records=2000, chats=60, seed=1):
+    rng = random.Random(seed)
+    for _ in range(records):
+        chat = str(rng.randrange(chats))
+        stats.record(chat, rng.choice(GAMES), rng.random() < 0.4, "n" + chat)
+
+
+def expected(store, game, size=3):
+    rows = []
+    played = players = 0
+    for chat, value in store.scan("stats"):
+        counts = tg.stats_games(value).get(game)
+        if counts:
+            played += counts[0]
+            players += 1
+            if counts[1]:
+                rows.append((-counts[1], counts[2], chat))
+    return [(chat, -wins) for wins, _, chat in sorted(rows)[:size]], played, players
+
+
+def test_totals_and_tops_are_maintained_incrementally():
+    store, stats = memory_stats()
+    play(stats)
+    stats.refresh()
+    for game in GAMES:
+        top, played, players = expected(store, game)
+        assert [(chat, wins) for chat, wins, _, _ in stats.boards[game].top()] == top
+        assert stats.totals[game][0] == played and stats.totals[game][2] == players
+
+
+def test_cached_texts_match_fresh_render():
+    store, stats = memory_stats()
+    rng = random.Random(2)
+    for i in range(500):
+        chat = str(rng.randrange(30))
+        stats.record(chat, rng.choice(GAMES), rng.random() < 0.4, "n" + chat)
+        if i % 25 == 0:
+            texts = {c: stats.chat_text(c) for c in map(str, range(30))}
+            top = stats.top_text()
+            stats.rendered.clear()
+            stats.top_rendered = (None, None)
+            assert texts == {c: stats.chat_text(c) for c in map(str, range(30))} and top == stats.top_text()
+
+
+def test_uncounted_chat_joins_totals_on_next_game():
+    store, stats = memory_stats()
+    store.set("stats", "old", {"Тест": {"played": 4, "wins": 3}})
+    stats.record("new", "Тест", False, "N")
+    stats.record("old", "Тест", True, "O")
+    assert stats.summary()["Тест"] == {"played": 6, "wins": 4, "players": 2}
+    assert stats.boards["Тест"].top()[0][:2] == ("old", 4)
+    stats.record("old", "Тест", False, "O")
+    assert stats.summary()["Тест"] == {"played": 7, "wins": 4, "players": 2}
+
+
+def test_sqlite_workers_share_totals_without_scans(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    stores = [tg.SQLiteStateStore(path), tg.SQLiteStateStore(path)]
+    workers = [tg.GameStats(s.view("stats"), s.view("stats_totals"), "", 60, 3, 100) for s in stores]
+    rng = random.Random(3)
+    for i in range(300):
+        chat = str(rng.randrange(40))
+        workers[i % 2].record(chat, rng.choice(GAMES), rng.random() < 0.4, "n" + chat)
+    assert workers[0].summary() == workers[1].summary()
+    assert workers[0].top_text() == workers[1].top_text()
+    assert sum(t["played"] for t in workers[0].summary().values()) == 300
+    assert workers[0].chat_text("5") == workers[1].chat_text("5")
+
+
+def test_memory_snapshot_survives_restart(tmp_path):
+    path = str(tmp_path / "stats.json")
+
+    async def scenario():
+        store, stats = memory_stats(path)
+        play(stats, records=300)
+        texts = stats.top_text(), stats.chat_text("7"), stats.summary()
+        await stats.stop()
+
+        _, restored = memory_stats(path)
+        assert (restored.top_text(), restored.chat_text("7"), restored.summary()) == texts
+        restored.record("7", "Тест", True, "n7")
+        assert restored.summary()["Тест"]["played"] == texts[2]["Тест"]["played"] + 1
+        await restored.stop()
+
+    asyncio.run(scenario())
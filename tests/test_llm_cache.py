@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+from api import telegram as tg
+
+
+def key(cache, history):
+    return cache.key("Продолжай", history, "model", 0, 100)
+
+
+def test_key_covers_whole_history_including_summary():
+    cache = tg.LLMCache(100, 3600, 1 << 20)
+    turns = [{"role": "user", "content": "Привет"}, {"role": "assistant", "content": "Здравствуй"}]
+    summary_a = {"role": "system", "content": tg.SUMMARY_PREFIX + "говорили о котах"}
+    summary_b = {"role": "system", "content": tg.SUMMARY_PREFIX + "говорили о налогах"}
+    assert key(cache, [summary_a] + turns) != key(cache, [summary_b] + turns)
+    assert key(cache, [{"role": "user", "content": "раньше"}] + turns) != key(cache, turns)
+    assert key(cache, turns) == key(cache, [dict(m) for m in turns])
+
+
+def test_disk_lookup_runs_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        cache = tg.LLMCache(100, 3600, 1 << 20, path)
+        cache.put("k", "ответ")
+        await cache.stop()
+
+        fresh = tg.LLMCache(100, 3600, 1 << 20, path)
+        threads = []
+        read = fresh.read
+        fresh.read = lambda k: threads.append(threading.get_ident()) or read(k)
+        assert await fresh.get("k") == "ответ"
+        assert await fresh.get("missing") is None
+        assert threads and threading.get_ident() not in threads
+        assert fresh.disk_hits == 1 and fresh.misses == 1
+        # Повторное чтение — уже из памяти, без потока
+        assert await fresh.get("k") == "ответ"
+        assert len(threads) == 2
+        await fresh.stop()
+
+    asyncio.run(scenario())
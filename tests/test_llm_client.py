@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from api import telegram as tg
+
+
+def client(**kwargs):
+    options = dict(models=["a", "b"], deadline=5, retries=1, backoff_base=0.001, backoff_max=0.001,
+                   hedge=False, hedge_percentile=95, hedge_min_samples=5, breaker_failures=2, breaker_cooldown=60)
+    options.update(kwargs)
+    return tg.LLMClient(**options)
+
+
+def reply(content):
+    return {"choices": [{"message": {"content": content}}]}
+
+
+@pytest.fixture
+def openrouter(monkeypatch):
+    """Подменяет HTTP-клиент OpenRouter; handler(model, number) -> (задержка, статус, тело)."""
+    calls = []
+    state = {"handler": None}
+
+    async def handle(request):
+        model = httpx.Response(200, content=request.content).json()["model"]
+        calls.append(model)
+        delay, status, body = state["handler"](model, len(calls))
+        await asyncio.sleep(delay)
+        return httpx.Response(status, json=body)
+
+    def install(handler):
+        state["handler"] = handler
+        monkeypatch.setitem(tg.http_clients, "openrouter", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+        return calls
+
+    return install
+
+
+def test_retries_then_falls_back_and_opens_breaker(openrouter):
+    calls = openrouter(lambda model, n: (0, 503, {"error": {"message": "down"}}) if model == "a" else (0, 200, reply("ok")))
+    llm = client()
+
+    async def scenario():
+        first = await llm.complete({"messages": []})
+        second = await llm.complete({"messages": []})
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second == reply("ok")
+    # Две попытки на «a» открыли его предохранитель, второй запрос сразу идёт в «b»
+    assert calls == ["a", "a", "b", "b"]
+    assert llm.breakers["a"].state == "open" and llm.short_circuited == 1 and llm.fallbacks == 1
+
+
+def test_fatal_status_is_not_retried_on_other_models(openrouter):
+    calls = openrouter(lambda model, n: (0, 401, {"error": {"message": "bad key"}}))
+    with pytest.raises(tg.LLMError) as error:
+        asyncio.run(client().complete({"messages": []}))
+    assert error.value.status == 401 and calls == ["a"]
+
+
+def test_slow_request_is_hedged(openrouter):
+    calls = openrouter(lambda model, n: (1.0 if n == 1 else 0, 200, reply(str(n))))
+    llm = client(models=["a"], hedge=True)
+    llm.latencies.extend([0.02] * 10)
+
+    started = time.monotonic()
+    result = asyncio.run(llm.complete({"messages": []}))
+    assert result == reply("2") and time.monotonic() - started < 0.5
+    assert calls == ["a", "a"] and llm.hedged == 1 and llm.hedge_wins == 1
+
+
+def test_breaker_half_open_probe():
+    breaker = tg.CircuitBreaker(2, 0.05)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and not breaker.allow()  # один пробный запрос
+    breaker.failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow()
@@ -0,0 +1,129 @@
+import asyncio
+
+import httpx
+import pytest
+
+from api import telegram as tg
+
+
+def scheduler(**kwargs):
+    options = dict(chat_rate=1000, chat_burst=1000, global_rate=1000, global_burst=1000, max_retries=2)
+    options.update(kwargs)
+    return tg.OutboundScheduler(**options)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Подменённый Bot API: replies — очередь ответов (статус, retry_after), по умолчанию 200."""
+    calls = []
+    replies = []
+
+    async def telegram_api(method, payload, timeout=None):
+        calls.append(payload)
+        await asyncio.sleep(0)
+        status, retry_after = replies.pop(0) if replies else (200, None)
+        body = {"ok": status == 200}
+        if retry_after is not None:
+            body["parameters"] = {"retry_after": retry_after}
+        return httpx.Response(status, json=body)
+
+    monkeypatch.setattr(tg, "telegram_api", telegram_api)
+    return calls, replies
+
+
+def test_messages_keep_order_within_chat(api):
+    calls, _ = api
+
+    async def scenario():
+        outbound = scheduler()
+        for i in range(5):
+            outbound.enqueue(1, f"a{i}")
+            outbound.enqueue(2, f"b{i}")
+        await outbound.stop()
+        return outbound
+
+    outbound = asyncio.run(scenario())
+    assert [c["text"] for c in calls if c["chat_id"] == "1"] == [f"a{i}" for i in range(5)]
+    assert [c["text"] for c in calls if c["chat_id"] == "2"] == [f"b{i}" for i in range(5)]
+    assert outbound.sent == 10
+
+
+def test_wrapped_messages_are_coalesced(api):
+    calls, _ = api
+
+    async def scenario():
+        outbound = scheduler()
+        for i in range(3):
+            outbound.enqueue(1, f"m{i}", wrap="[{}]")
+        await outbound.enqueue(1, "reply", wait=True)
+        await outbound.stop()
+        return outbound
+
+    outbound = asyncio.run(scenario())
+    assert [c["text"] for c in calls] == ["[m0\n\nm1\n\nm2]", "reply"]
+    assert outbound.coalesced == 2
+
+
+def test_rate_limited_message_is_retried_after_retry_after(api):
+    calls, replies = api
+    replies.append((429, 0.05))
+
+    async def scenario():
+        outbound = scheduler()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        res = await outbound.enqueue(1, "hi", wait=True)
+        elapsed = loop.time() - started
+        await outbound.stop()
+        return outbound, res, elapsed
+
+    outbound, res, elapsed = asyncio.run(scenario())
+    assert res.status_code == 200 and elapsed >= 0.05
+    assert len(calls) == 2 and outbound.rate_limited == 1 and outbound.retried == 1
+
+
+def test_rate_limit_wait_is_capped(api):
+    _, replies = api
+    replies.extend([(429, 0.05)] * 10)
+
+    async def scenario():
+        outbound = scheduler(max_rate_limit_wait=0.12)
+        res = await asyncio.wait_for(outbound.enqueue(1, "hi", wait=True), 2)
+        await outbound.stop(timeout=0)
+        return outbound, res
+
+    outbound, res = asyncio.run(scenario())
+    assert res.status_code == 429
+    assert outbound.rate_limited == 3 and outbound.retried == 2 and outbound.failed == 1
+
+
+def test_stop_drains_queue(api):
+    calls, _ = api
+
+    async def scenario():
+        outbound = scheduler(chat_rate=200, chat_burst=1)
+        for i in range(10):
+            outbound.enqueue(1, str(i))
+        await outbound.stop(timeout=5)
+        return outbound
+
+    outbound = asyncio.run(scenario())
+    assert [c["text"] for c in calls] == [str(i) for i in range(10)]
+    assert outbound.pending() == 0 and outbound.dropped == 0
+
+
+def test_stop_resolves_waiters_it_could_not_deliver(api):
+    _, replies = api
+    replies.append((429, 30))
+
+    async def scenario():
+        outbound = scheduler()
+        waiter = outbound.enqueue(1, "hi", wait=True)
+        later = outbound.enqueue(1, "later", wait=True)
+        await asyncio.sleep(0.05)
+        await outbound.stop(timeout=0.1)
+        return outbound, await asyncio.wait_for(waiter, 1), await asyncio.wait_for(later, 1)
+
+    outbound, first, second = asyncio.run(scenario())
+    assert first is None and second is None
+    assert outbound.dropped == 2
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+from api import telegram as tg
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.sqlite3")
+
+
+def lock(path):
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    return other
+
+
+def test_flush_keeps_writes_while_database_is_locked(path):
+    store = tg.SQLiteStateStore(path, busy_timeout=10)
+    store.set("sessions", "1", {"a": 1})
+    other = lock(path)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    assert store.get("sessions", "1") == {"a": 1}
+    other.execute("ROLLBACK")
+    store.flush()
+    assert tg.SQLiteStateStore(path).get("sessions", "1") == {"a": 1}
+
+
+def test_set_defers_flush_while_database_is_locked(path):
+    store = tg.SQLiteStateStore(path, batch_size=1, busy_timeout=10)
+    other = lock(path)
+    store.set("sessions", "1", {"a": 1})
+    assert store.footprint()["dirty"] == 1
+    other.execute("ROLLBACK")
+    store.flush()
+    assert tg.SQLiteStateStore(path).get("sessions", "1") == {"a": 1}
+
+
+def test_failed_update_keeps_buffered_value(path):
+    store = tg.SQLiteStateStore(path, busy_timeout=10)
+    store.set("stats", "1", {"n": 1})
+    other = lock(path)
+    with pytest.raises(sqlite3.OperationalError):
+        store.update("stats", "1", lambda v: {"n": v["n"] + 1})
+    other.execute("ROLLBACK")
+    assert store.get("stats", "1") == {"n": 1}
+    assert store.update("stats", "1", lambda v: {"n": v["n"] + 1}) == {"n": 2}
+    assert tg.SQLiteStateStore(path).get("stats", "1") == {"n": 2}
+
+
+def test_update_is_shared_between_stores(path):
+    a, b = tg.SQLiteStateStore(path), tg.SQLiteStateStore(path)
+    for store in (a, b, a):
+        store.update("stats", "1", lambda v: {"n": v["n"] + 1}, {"n": 0})
+    assert b.get("stats", "1") == {"n": 3}
+
+
+def test_memory_store_never_evicts_stats():
+    store = tg.MemoryStateStore()
+    for i in range(tg.STATE_MAX_ENTRIES * 3):
+        store.set("stats", str(i), {"games": {}})
+    assert store.get("stats", "0") == {"games": {}}
+    assert store.footprint()["stats"]["evicted_lru"] == 0
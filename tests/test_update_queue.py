@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from api import telegram as tg
+
+QUIZ, OTHER_QUIZ = list(tg.QUIZ_TOPICS)[:2]
+GAME = next(iter(tg.GAMES))
+
+
+def upd(i, text, chat=7):
+    return tg.ParsedUpdate({"update_id": i, "message": {"message_id": i, "text": text, "chat": {"id": chat}, "from": {"id": chat}}})
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    yield
+    for view in (tg.sessions, tg.ai_chat_sessions, tg.feedback_sessions):
+        for chat in ("7", "8"):
+            view.pop(chat)
+
+
+class Recorder:
+    def __init__(self):
+        self.seen = []
+        self.gate = asyncio.Event()
+
+    async def __call__(self, update):
+        self.seen.append((update.chat_id, update.text))
+        await self.gate.wait()
+
+
+def run(texts, before=None, chats=None):
+    async def scenario():
+        handler = Recorder()
+        queue = tg.UpdateQueue(handler, 4, 100, action_of=tg.generation_action)
+        for i, text in enumerate(texts):
+            queue.add(upd(i, text, chats[i] if chats else 7))
+            if i == 0:
+                # Первый апдейт уже в обработке, остальные ждут за ним
+                await asyncio.sleep(0)
+                if before:
+                    before()
+        handler.gate.set()
+        await queue.stop()
+        return handler.seen, queue
+
+    return asyncio.run(scenario())
+
+
+def texts(seen):
+    return [text for _, text in seen]
+
+
+def test_keeps_order_within_chat_and_serves_other_chats():
+    seen, queue = run(["1", "2", "a", "3", "b"], chats=[7, 7, 8, 7, 8])
+    assert [t for c, t in seen if c == "7"] == ["1", "2", "3"]
+    assert [t for c, t in seen if c == "8"] == ["a", "b"]
+    assert queue.processed == 5 and queue.depth == 0
+
+
+def test_repeated_generation_taps_are_coalesced():
+    seen, queue = run([QUIZ, QUIZ, QUIZ])
+    assert texts(seen) == [QUIZ]
+    assert queue.coalesced == 2
+
+
+def test_newer_generation_tap_replaces_waiting_one():
+    seen, queue = run([GAME, QUIZ, OTHER_QUIZ])
+    assert texts(seen) == [GAME, OTHER_QUIZ]
+    assert queue.superseded == 1
+
+
+def test_ai_chat_messages_matching_buttons_are_not_coalesced():
+    tg.ai_chat_sessions["7"] = []
+    seen, queue = run([QUIZ, QUIZ, OTHER_QUIZ, QUIZ])
+    assert texts(seen) == [QUIZ, QUIZ, OTHER_QUIZ, QUIZ]
+    assert queue.coalesced == queue.superseded == 0
+
+
+def test_feedback_text_matching_a_button_is_not_dropped():
+    tg.feedback_sessions["7"] = True
+    seen, _ = run([GAME, GAME])
+    assert texts(seen) == [GAME, GAME]
+
+
+def test_taps_after_a_state_changing_update_are_kept():
+    # «ИИ-помощник» ещё не обработан: что станет с кнопками после него, неизвестно
+    seen, _ = run(["/start", "🤖 ИИ-помощник", QUIZ, QUIZ])
+    assert texts(seen) == ["/start", "🤖 ИИ-помощник", QUIZ, QUIZ]
+
+
+def test_game_button_after_quiz_topic_stays_a_quiz_answer():
+    # После темы теста кнопка игры уйдёт в check_quiz_answer — заменять тему нельзя
+    seen, queue = run([QUIZ, GAME], before=lambda: tg.sessions.update("7", lambda s: {"correctAnswer": "A"}, {}))
+    assert texts(seen) == [QUIZ, GAME]
+    assert queue.superseded == 0
+
+
+def test_active_update_action_follows_current_state():
+    # Первый апдейт — ответ на тест, а не запуск темы: повтор кнопки не поглощается
+    tg.sessions["7"] = {"correctAnswer": "A"}
+    seen, _ = run([GAME, GAME])
+    assert texts(seen) == [GAME, GAME]
+
+
+def test_stop_drains_waiting_updates():
+    seen, queue = run([str(i) for i in range(20)])
+    assert len(seen) == 20 and not queue.running